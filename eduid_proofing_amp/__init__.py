@@ -1,11 +1,32 @@
 from __future__ import absolute_import
 
+import functools
+
 from eduid_userdb.proofing import OidcProofingUserDB, LetterProofingUserDB, LookupMobileProofingUserDB
 from eduid_userdb.proofing import EmailProofingUserDB, PhoneProofingUserDB, OrcidProofingUserDB
 from eduid_userdb.proofing import EidasProofingUserDB
 from eduid_userdb.personal_data import PersonalDataUserDB
 from eduid_userdb.security import SecurityUserDB
 from celery.utils.log import get_task_logger
+from pymongo.errors import ConnectionFailure
+
+from eduid_proofing_amp import readiness
+from eduid_proofing_amp.backends import MongoPrivateDB
+from eduid_proofing_amp.causal import get_causal_reader
+from eduid_proofing_amp.coalesce import get_coalescer
+from eduid_proofing_amp.deadline import get_deadline_reader
+from eduid_proofing_amp.driver import BATCH_SIZE, driver_profile, plugin_mongo_uri
+from eduid_proofing_amp.export import get_update_exporter
+from eduid_proofing_amp.health import get_private_db_health
+from eduid_proofing_amp.indexes import ensure_indexes, ensure_indexes_enabled
+from eduid_proofing_amp.memory import get_memory_accounting
+from eduid_proofing_amp.ownership import get_write_ledger
+from eduid_proofing_amp.profiling import get_fetch_profiler
+from eduid_proofing_amp.replica import get_local_replica
+from eduid_proofing_amp.scheduling import current_origin, get_scheduler
+from eduid_proofing_amp.tracing import get_tracer, set_document_size, span
+from eduid_proofing_amp.validation import get_fast_validator
+from eduid_proofing_amp.whitelists import get_whitelist_reloader
 
 logger = get_task_logger(__name__)
 
@@ -34,171 +55,359 @@ def filter_nin(value):
     return result
 
 
-class OidcProofingAMPContext(object):
+def lookup_path(data, path):
+    """
+    :param data: dict
+    :param path: str
+    :return: value or None
+
+    Look up a whitelisted attribute in a user dict. The attribute may be a dotted path,
+    like 'orcid.id', in which case the nested value is returned. Missing keys, or a path
+    that runs into something that is not a dict, gives None.
+    """
+    value = data
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+class AMPContext(object):
+    """
+    Common base for the plugin contexts.
+
+    Subclasses set PLUGIN_NAME to the name of their entry point, and WHITELIST_SET_ATTRS and
+    WHITELIST_UNSET_ATTRS to the attributes they may set and unset in the central database,
+    so that they can be read without creating a context (see relevance.plugin_whitelists).
+    They set private_db when initialized, a backends.PrivateDB, by default a MongoPrivateDB
+    for the plugin's userdb class.
+
+    A context may be used by many threads at once, see concurrency.ThreadedFetcher:
+    attribute_fetcher does not modify it, and the optional features keep their state behind
+    locks or per thread. Only the memory accounting mixes up concurrent calls, as tracemalloc
+    is process wide.
+    """
+
+    PLUGIN_NAME = None
+
+    WHITELIST_SET_ATTRS = ()
+    WHITELIST_UNSET_ATTRS = ()
+
+    # Shared ownership.WriteLedger, set by configure_context when enabled
+    write_ledger = None
+
+    # Callables wrapping attribute_fetcher, outermost first. Each is called as
+    # hook(fetch, context, user_id, stats) and must return the result of
+    # fetch(context, user_id, stats).
+    fetch_hooks = ()
+
+    # deadline.DeadlineReader reading users in place of private_db.get_user_by_id, called as
+    # user_reader(private_db, user_id), or user_reader.get_document(private_db, user_id)
+    user_reader = None
+
+    # causal.CausalReader for fetches given a causal token, if configured
+    causal_reader = None
+
+    # validation.FastValidator accepting raw documents without constructing the user, if configured
+    validator = None
+
+    # replica.LocalReplica consulted before private_db for the fetch origins it serves, if configured
+    replica = None
+
+    # health.PrivateDBHealth of the private database, if configured
+    health = None
+
+    # tracing.Tracer for spans around the fetch stages, if configured
+    tracer = None
+
+    # whitelists.WhitelistPlan in use, if the whitelists are reloadable. Takes precedence over
+    # WHITELIST_SET_ATTRS, WHITELIST_UNSET_ATTRS and validator.
+    whitelist_plan = None
+
+    def warm_up(self, connections=1):
+        """
+        Open pooled connections and run the fetch queries once, see readiness.warm_up.
+
+        :return: Seconds spent
+        :rtype: float
+        """
+        return readiness.warm_up(self, connections)
+
+    def self_test(self, samples=5):
+        """
+        Time server selection and round trips to the private database, see readiness.self_test.
+
+        :rtype: dict
+        """
+        return readiness.self_test(self, samples)
+
+
+def configure_context(context, am_conf):
+    """
+    Enable the optional features configured in the Attribute Manager configuration
+    for a newly created plugin context.
+
+    :param context: Plugin context
+    :param am_conf: Attribute Manager configuration data.
+
+    :type context: AMPContext
+    :type am_conf: dict
+
+    :rtype: AMPContext
+    """
+    batch_size = driver_profile(am_conf, context.PLUGIN_NAME).get(BATCH_SIZE)
+    if batch_size and isinstance(context.private_db, MongoPrivateDB):
+        context.private_db.batch_size = batch_size
+    if ensure_indexes_enabled(am_conf, context):
+        ensure_indexes(context)
+    if am_conf.get('ATTRIBUTE_OWNERSHIP', False):
+        # Experimental, see ownership.WriteLedger
+        context.write_ledger = get_write_ledger(am_conf)
+    context.user_reader = get_deadline_reader(am_conf, context.PLUGIN_NAME)
+    context.causal_reader = get_causal_reader(am_conf)
+    context.replica = get_local_replica(am_conf, context)
+    context.validator = get_fast_validator(am_conf, context)
+    if am_conf.get('WHITELIST_CONFIG'):
+        get_whitelist_reloader(am_conf).register(context)
+    if am_conf.get('SCHEDULER_MAX_CONCURRENT'):
+        # Outermost, so that time spent waiting for a slot is not profiled
+        context.fetch_hooks = (get_scheduler(am_conf),) + context.fetch_hooks
+    context.health = get_private_db_health(am_conf, context)
+    if context.health is not None:
+        # Outermost, so that fetches for an unreachable database do not wait for a slot
+        context.fetch_hooks = (context.health,) + context.fetch_hooks
+    context.tracer = get_tracer(am_conf)
+    if context.tracer is not None:
+        # Outermost, so that the root span covers all other hooks
+        context.fetch_hooks = (context.tracer,) + context.fetch_hooks
+    if am_conf.get('PROFILE_DIR'):
+        context.fetch_hooks = context.fetch_hooks + (get_fetch_profiler(am_conf),)
+    if am_conf.get('COALESCE_WINDOW'):
+        context.fetch_hooks = context.fetch_hooks + (get_coalescer(am_conf),)
+    if am_conf.get('EXPORT_UPDATES_DIR'):
+        context.fetch_hooks = context.fetch_hooks + (get_update_exporter(am_conf),)
+    if am_conf.get('MEMORY_ACCOUNTING_DIR'):
+        context.fetch_hooks = context.fetch_hooks + (get_memory_accounting(am_conf),)
+    if am_conf.get('WARM_UP_CONNECTIONS'):
+        try:
+            context.warm_up(am_conf['WARM_UP_CONNECTIONS'])
+        except ConnectionFailure as e:
+            # Leave it to the fetches, and the health state, to fail
+            logger.error('Could not warm up {}: {}'.format(context.PLUGIN_NAME, e))
+    return context
+
+
+class OidcProofingAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = OidcProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            # TODO: Arrays must use put or pop, not set, but need more deep refacts
-            'nins',  # New format
-            'givenName',
-            'surname',  # New format
-            'displayName',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'norEduPersonNIN',
-            'nins'  # New format
-        ]
+    PLUGIN_NAME = 'eduid_oidc_proofing'
+
+    WHITELIST_SET_ATTRS = [
+        # TODO: Arrays must use put or pop, not set, but need more deep refacts
+        'nins',  # New format
+        'givenName',
+        'surname',  # New format
+        'displayName',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'norEduPersonNIN',
+        'nins'  # New format
+    ]
+
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(OidcProofingUserDB(db_uri))
+        self.private_db = private_db
 
 
-class LetterProofingAMPContext(object):
+class LetterProofingAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = LetterProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            # TODO: Arrays must use put or pop, not set, but need more deep refacts
-            'nins',  # New format
-            'letter_proofing_data',
-            'givenName',
-            'surname',  # New format
-            'displayName',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'norEduPersonNIN',
-            'nins'  # New format
-        ]
+    PLUGIN_NAME = 'eduid_letter_proofing'
 
+    WHITELIST_SET_ATTRS = [
+        # TODO: Arrays must use put or pop, not set, but need more deep refacts
+        'nins',  # New format
+        'letter_proofing_data',
+        'givenName',
+        'surname',  # New format
+        'displayName',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'norEduPersonNIN',
+        'nins'  # New format
+    ]
 
-class LookupMobileProofingAMPContext(object):
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(LetterProofingUserDB(db_uri))
+        self.private_db = private_db
+
+
+class LookupMobileProofingAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = LookupMobileProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            # TODO: Arrays must use put or pop, not set, but need more deep refacts
-            'nins',  # New format
-            'givenName',
-            'surname',  # New format
-            'displayName',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'norEduPersonNIN',
-            'nins'  # New format
-        ]
+    PLUGIN_NAME = 'eduid_lookup_mobile_proofing'
+
+    WHITELIST_SET_ATTRS = [
+        # TODO: Arrays must use put or pop, not set, but need more deep refacts
+        'nins',  # New format
+        'givenName',
+        'surname',  # New format
+        'displayName',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'norEduPersonNIN',
+        'nins'  # New format
+    ]
 
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(LookupMobileProofingUserDB(db_uri))
+        self.private_db = private_db
 
-class EmailProofingAMPContext(object):
+
+class EmailProofingAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = EmailProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            # TODO: Arrays must use put or pop, not set, but need more deep refacts
-            'mailAliases',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'mailAliases',
-            'mail',  # Old format
-        ]
+    PLUGIN_NAME = 'eduid_email'
+
+    WHITELIST_SET_ATTRS = [
+        # TODO: Arrays must use put or pop, not set, but need more deep refacts
+        'mailAliases',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'mailAliases',
+        'mail',  # Old format
+    ]
+
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(EmailProofingUserDB(db_uri))
+        self.private_db = private_db
 
 
-class PhoneProofingAMPContext(object):
+class PhoneProofingAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = PhoneProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            # TODO: Arrays must use put or pop, not set, but need more deep refacts
-            'phone',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'phone',
-            'mobile',  # Old format
-        ]
+    PLUGIN_NAME = 'eduid_phone'
 
+    WHITELIST_SET_ATTRS = [
+        # TODO: Arrays must use put or pop, not set, but need more deep refacts
+        'phone',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'phone',
+        'mobile',  # Old format
+    ]
 
-class PersonalDataAMPContext(object):
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(PhoneProofingUserDB(db_uri))
+        self.private_db = private_db
+
+
+class PersonalDataAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = PersonalDataUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            'givenName',
-            'surname',  # New format
-            'displayName',
-            'preferredLanguage',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'sn',  # Old format
-        ]
+    PLUGIN_NAME = 'eduid_personal_data'
+
+    WHITELIST_SET_ATTRS = [
+        'givenName',
+        'surname',  # New format
+        'displayName',
+        'preferredLanguage',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'sn',  # Old format
+    ]
 
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(PersonalDataUserDB(db_uri))
+        self.private_db = private_db
 
-class SecurityAMPContext(object):
+
+class SecurityAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = SecurityUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            'passwords',
-            'terminated',
-            'nins',             # For AL1 downgrade on password reset
-            'phone',            # For AL1 downgrade on password reset
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'passwords',
-            'terminated',
-            'norEduPersonNIN',  # For AL1 downgrade on password reset
-            'nins',             # For AL1 downgrade on password reset
-            'phone',            # For AL1 downgrade on password reset
-        ]
+    PLUGIN_NAME = 'eduid_security'
+
+    WHITELIST_SET_ATTRS = [
+        'passwords',
+        'terminated',
+        'nins',             # For AL1 downgrade on password reset
+        'phone',            # For AL1 downgrade on password reset
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'passwords',
+        'terminated',
+        'norEduPersonNIN',  # For AL1 downgrade on password reset
+        'nins',             # For AL1 downgrade on password reset
+        'phone',            # For AL1 downgrade on password reset
+    ]
 
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(SecurityUserDB(db_uri))
+        self.private_db = private_db
 
-class OrcidAMPContext(object):
+
+class OrcidAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = OrcidProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            'orcid',
-        ]
-        self.WHITELIST_UNSET_ATTRS = [
-            'orcid',
-        ]
+    PLUGIN_NAME = 'eduid_orcid'
+
+    WHITELIST_SET_ATTRS = [
+        'orcid',
+    ]
+    WHITELIST_UNSET_ATTRS = [
+        'orcid',
+    ]
+
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(OrcidProofingUserDB(db_uri))
+        self.private_db = private_db
 
 
-class EidasAMPContext(object):
+class EidasAMPContext(AMPContext):
     """
     Private data for this AM plugin.
     """
 
-    def __init__(self, db_uri):
-        self.private_db = EidasProofingUserDB(db_uri)
-        self.WHITELIST_SET_ATTRS = [
-            'passwords',
-            'nins',
-            'givenName',
-            'surname',  # New format
-            'displayName',
-        ]
-        self.WHITELIST_UNSET_ATTRS = []
+    PLUGIN_NAME = 'eduid_eidas'
+
+    WHITELIST_SET_ATTRS = [
+        'passwords',
+        'nins',
+        'givenName',
+        'surname',  # New format
+        'displayName',
+    ]
+    WHITELIST_UNSET_ATTRS = []
+
+    def __init__(self, db_uri, private_db=None):
+        if private_db is None:
+            private_db = MongoPrivateDB(EidasProofingUserDB(db_uri))
+        self.private_db = private_db
 
 
 def oidc_plugin_init(am_conf):
@@ -214,7 +423,8 @@ def oidc_plugin_init(am_conf):
 
     :rtype: OidcProofingAMPContext
     """
-    return OidcProofingAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, OidcProofingAMPContext.PLUGIN_NAME)
+    return configure_context(OidcProofingAMPContext(mongo_uri), am_conf)
 
 
 def letter_plugin_init(am_conf):
@@ -230,7 +440,8 @@ def letter_plugin_init(am_conf):
 
     :rtype: LetterProofingAMPContext
     """
-    return LetterProofingAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, LetterProofingAMPContext.PLUGIN_NAME)
+    return configure_context(LetterProofingAMPContext(mongo_uri), am_conf)
 
 
 def lookup_mobile_plugin_init(am_conf):
@@ -246,7 +457,8 @@ def lookup_mobile_plugin_init(am_conf):
 
     :rtype: LetterProofingAMPContext
     """
-    return LookupMobileProofingAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, LookupMobileProofingAMPContext.PLUGIN_NAME)
+    return configure_context(LookupMobileProofingAMPContext(mongo_uri), am_conf)
 
 
 def email_plugin_init(am_conf):
@@ -262,7 +474,8 @@ def email_plugin_init(am_conf):
 
     :rtype: EmailProofingAMPContext
     """
-    return EmailProofingAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, EmailProofingAMPContext.PLUGIN_NAME)
+    return configure_context(EmailProofingAMPContext(mongo_uri), am_conf)
 
 
 def phone_plugin_init(am_conf):
@@ -278,7 +491,8 @@ def phone_plugin_init(am_conf):
 
     :rtype: PhoneProofingAMPContext
     """
-    return PhoneProofingAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, PhoneProofingAMPContext.PLUGIN_NAME)
+    return configure_context(PhoneProofingAMPContext(mongo_uri), am_conf)
 
 
 def personal_data_plugin_init(am_conf):
@@ -294,7 +508,8 @@ def personal_data_plugin_init(am_conf):
 
     :rtype: PersonalDataAMPContext
     """
-    return PersonalDataAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, PersonalDataAMPContext.PLUGIN_NAME)
+    return configure_context(PersonalDataAMPContext(mongo_uri), am_conf)
 
 
 def security_plugin_init(am_conf):
@@ -310,7 +525,8 @@ def security_plugin_init(am_conf):
 
     :rtype: SecurityAMPContext
     """
-    return SecurityAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, SecurityAMPContext.PLUGIN_NAME)
+    return configure_context(SecurityAMPContext(mongo_uri), am_conf)
 
 
 def orcid_plugin_init(am_conf):
@@ -326,7 +542,8 @@ def orcid_plugin_init(am_conf):
 
     :rtype: OrcidAMPContext
     """
-    return OrcidAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, OrcidAMPContext.PLUGIN_NAME)
+    return configure_context(OrcidAMPContext(mongo_uri), am_conf)
 
 
 def eidas_plugin_init(am_conf):
@@ -342,10 +559,29 @@ def eidas_plugin_init(am_conf):
 
     :rtype: EidasAMPContext
     """
-    return EidasAMPContext(am_conf['MONGO_URI'])
+    mongo_uri = plugin_mongo_uri(am_conf, EidasAMPContext.PLUGIN_NAME)
+    return configure_context(EidasAMPContext(mongo_uri), am_conf)
+
 
+PLUGIN_INITS = {
+    OidcProofingAMPContext.PLUGIN_NAME: oidc_plugin_init,
+    LetterProofingAMPContext.PLUGIN_NAME: letter_plugin_init,
+    LookupMobileProofingAMPContext.PLUGIN_NAME: lookup_mobile_plugin_init,
+    EmailProofingAMPContext.PLUGIN_NAME: email_plugin_init,
+    PhoneProofingAMPContext.PLUGIN_NAME: phone_plugin_init,
+    PersonalDataAMPContext.PLUGIN_NAME: personal_data_plugin_init,
+    SecurityAMPContext.PLUGIN_NAME: security_plugin_init,
+    OrcidAMPContext.PLUGIN_NAME: orcid_plugin_init,
+    EidasAMPContext.PLUGIN_NAME: eidas_plugin_init,
+}
 
-def attribute_fetcher(context, user_id):
+PLUGIN_CONTEXTS = dict((context_class.PLUGIN_NAME, context_class) for context_class in [
+    OidcProofingAMPContext, LetterProofingAMPContext, LookupMobileProofingAMPContext, EmailProofingAMPContext,
+    PhoneProofingAMPContext, PersonalDataAMPContext, SecurityAMPContext, OrcidAMPContext, EidasAMPContext,
+])
+
+
+def attribute_fetcher(context, user_id, causal_token=None):
     """
     Read a user from the Dashboard private private_db and return an update
     dict to let the Attribute Manager update the use in the central
@@ -353,30 +589,165 @@ def attribute_fetcher(context, user_id):
 
     :param context: Plugin context, see plugin_init above.
     :param user_id: Unique identifier
+    :param causal_token: Token of the write that triggered the sync, see causal.session_token.
+                         With CAUSAL_READS enabled the user is then read in a causally consistent
+                         session, possibly from a secondary, rather than from the local replica.
 
     :type context: DashboardAMPContext
     :type user_id: ObjectId
+    :type causal_token: str | dict | None
 
     :return: update dict
     :rtype: dict
     """
+    stats = {}
+    if causal_token is not None:
+        stats['causal_token'] = causal_token
+    if not context.fetch_hooks:
+        return fetch_attributes(context, user_id, stats)
 
-    attributes = {}
+    fetch = fetch_attributes
+    for hook in reversed(context.fetch_hooks):
+        fetch = functools.partial(hook, fetch)
+    return fetch(context, user_id, stats)
+
+
+def read_replica_dict(context, user_id, causal_token=None):
+    """
+    Read a user from the local replica of a plugin context, if it has one that serves the
+    origin of the fetch (see scheduling.fetch_origin).
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+    :param causal_token: Token of the write that triggered the sync, if any
+
+    :type context: AMPContext
+    :type user_id: ObjectId
+    :type causal_token: str | dict | None
+
+    :return: Whitelisted user data, or None if the user is to be read from the private database
+    :rtype: dict | None
+    """
+    # The replica may not have the write behind a causal token, or behind any sync triggered
+    # by a proofing application, yet
+    if context.replica is None or causal_token is not None or not context.replica.serves(current_origin()):
+        return None
+    with span(context, 'replica.get'):
+        user_dict = context.replica.get(user_id)
+    if user_dict is not None:
+        logger.debug('User with _id: {} found in {}.'.format(user_id, context.replica.path))
+    return user_dict
+
+
+def read_user_dict(context, user_id, validator=None, causal_token=None):
+    """
+    Read a user from the private database of a plugin context.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+    :param validator: FastValidator for the whitelisted attributes, if fast validation is enabled
+    :param causal_token: Token of the write the user must be read after, used with a causal reader
+
+    :type context: AMPContext
+    :type user_id: ObjectId
+    :type validator: validation.FastValidator | None
+    :type causal_token: str | dict | None
+
+    :return: User data, in the new userdb format
+    :rtype: dict
+    """
+    causal = causal_token is not None and context.causal_reader is not None
     logger.debug('Trying to get user with _id: {} from {}.'.format(user_id, context.private_db))
-    user = context.private_db.get_user_by_id(user_id)
+    if validator is not None or context.tracer is not None or causal:
+        # Read and construct separately, to validate or trace each
+        with span(context, 'private_db.read'):
+            if causal:
+                doc = context.causal_reader.get_document(context.private_db, user_id, causal_token)
+            elif context.user_reader is not None:
+                doc = context.user_reader.get_document(context.private_db, user_id)
+            else:
+                doc = context.private_db.get_document_by_id(user_id)
+        if validator is not None:
+            with span(context, 'validate'):
+                valid = validator(doc) is not None
+            if valid:
+                # Whitelisted attributes are valid, skip constructing the user
+                return doc
+        with span(context, 'user.construct'):
+            user = context.private_db.UserClass(data=doc)
+    elif context.user_reader is not None:
+        user = context.user_reader(context.private_db, user_id)
+    else:
+        user = context.private_db.get_user_by_id(user_id)
     logger.debug('User: {} found.'.format(user))
 
-    user_dict = user.to_dict(old_userdb_format=False)
+    with span(context, 'user.to_dict'):
+        return user.to_dict(old_userdb_format=False)
+
 
-    # white list of valid attributes for security reasons
+def whitelist_filter(user_dict, set_attrs, unset_attrs):
+    """
+    :return: The attributes of user_dict to set, and the whitelisted attributes it lacks to unset
+    :rtype: tuple
+    """
+    # Dotted whitelist entries (e.g. 'orcid.id') end up as dotted keys in the update, so
+    # only that part of a nested attribute is written to the central database.
     attributes_set = {}
     attributes_unset = {}
-    for attr in context.WHITELIST_SET_ATTRS:
-        value = value_filter(attr, user_dict.get(attr, None))
-        if value:
+    for attr in set_attrs:
+        value = value_filter(attr, lookup_path(user_dict, attr))
+        # A nested scalar, like orcid.verified, is written even when False or 0
+        if value or ('.' in attr and value is not None):
             attributes_set[attr] = value
-        elif attr in context.WHITELIST_UNSET_ATTRS:
+        elif attr in unset_attrs:
             attributes_unset[attr] = value
+    return attributes_set, attributes_unset
+
+
+def fetch_attributes(context, user_id, stats):
+    """
+    Do the work of attribute_fetcher, without any fetch hooks.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_id: Unique identifier
+    :param stats: Per call statistics for the fetch hooks, the private user dict is stored as 'user'.
+                  Holds the causal token given to attribute_fetcher, if any, as 'causal_token'.
+
+    :type context: AMPContext
+    :type user_id: ObjectId
+    :type stats: dict
+
+    :return: update dict
+    :rtype: dict
+    """
+    attributes = {}
+    plan = context.whitelist_plan
+    if plan is not None:
+        set_attrs, unset_attrs, validator = plan.set_attrs, plan.unset_attrs, plan.validator
+    else:
+        set_attrs, unset_attrs, validator = context.WHITELIST_SET_ATTRS, context.WHITELIST_UNSET_ATTRS, context.validator
+    causal_token = stats.get('causal_token')
+    user_dict = read_replica_dict(context, user_id, causal_token)
+    if user_dict is not None:
+        # white list of valid attributes for security reasons
+        with span(context, 'whitelist.filter'):
+            attributes_set, attributes_unset = whitelist_filter(user_dict, set_attrs, unset_attrs)
+        if attributes_unset:
+            # The replica row may predate the private data, never unset attributes because of it
+            logger.debug('Replica of user {} lacks {}, reading private data'.format(user_id, list(attributes_unset)))
+            user_dict = None
+    if user_dict is None:
+        user_dict = read_user_dict(context, user_id, validator, causal_token)
+        with span(context, 'whitelist.filter'):
+            attributes_set, attributes_unset = whitelist_filter(user_dict, set_attrs, unset_attrs)
+    stats['user'] = user_dict
+    set_document_size(context, stats)
+
+    if context.write_ledger is not None:
+        with span(context, 'write_ledger.filter'):
+            # Drop values superseded by newer private data or a higher priority plugin
+            attributes_set, attributes_unset = context.write_ledger.filter_update(
+                context.PLUGIN_NAME, user_id, user_dict.get('modified_ts'), attributes_set, attributes_unset)
 
     logger.debug('Will set attributes: {}'.format(attributes_set))
     logger.debug('Will remove attributes: {}'.format(attributes_unset))
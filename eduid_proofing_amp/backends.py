@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from abc import ABC, abstractmethod
+from copy import deepcopy
+
+from eduid_userdb.exceptions import UserDoesNotExist
+
+
+class PrivateDB(ABC):
+    """
+    The private_db of a plugin context. Backends must implement all the abstract methods to
+    be instantiated.
+
+    UserClass is the userdb class the private users are validated with.
+    """
+
+    UserClass = None
+
+    @abstractmethod
+    def get_user_by_id(self, user_id):
+        """
+        :param user_id: Unique identifier
+        :raise UserDoesNotExist: No such user
+        :return: UserClass instance
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_document_by_id(self, user_id):
+        """
+        :param user_id: Unique identifier
+        :raise UserDoesNotExist: No such user
+        :return: The raw, unvalidated, user document
+        :rtype: dict
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_users_by_ids(self, user_ids):
+        """
+        :param user_ids: Unique identifiers
+        :return: UserClass instances for the users found, in no particular order
+        :rtype: list
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def iter_documents_since(self, modified_ts, batch_size=1000, projection=None):
+        """
+        :param modified_ts: Lowest modified_ts to return documents for, None for all documents
+        :param batch_size: Number of documents to read at a time
+        :param projection: Top level keys to include, e.g. {'nins': True}, None for all
+        :return: Raw user documents with modified_ts >= modified_ts, oldest first
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def count(self):
+        """
+        :return: Number of users
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+
+class MongoPrivateDB(PrivateDB):
+    """
+    PrivateDB backed by an eduid_userdb UserDB. Anything not part of PrivateDB, like save(),
+    is passed on to the UserDB.
+
+    batch_size, when set from the driver profile of the plugin, is the cursor batch size of
+    all multi-document reads, in place of the one given by the caller.
+    """
+
+    batch_size = None
+
+    def __init__(self, userdb):
+        self.userdb = userdb
+        self.UserClass = userdb.UserClass
+
+    def __getattr__(self, name):
+        return getattr(self.userdb, name)
+
+    def __str__(self):
+        return str(self.userdb)
+
+    def get_user_by_id(self, user_id):
+        return self.userdb.get_user_by_id(user_id)
+
+    def get_document_by_id(self, user_id):
+        doc = self.userdb._coll.find_one({'_id': user_id})
+        if doc is None:
+            raise UserDoesNotExist('No user matching _id={!r}'.format(user_id))
+        return doc
+
+    def get_users_by_ids(self, user_ids):
+        cursor = self.userdb._coll.find({'_id': {'$in': list(user_ids)}})
+        if self.batch_size:
+            cursor = cursor.batch_size(self.batch_size)
+        return [self.UserClass(data=doc) for doc in cursor]
+
+    def iter_documents_since(self, modified_ts, batch_size=1000, projection=None):
+        spec = {}
+        if modified_ts is not None:
+            spec['modified_ts'] = {'$gte': modified_ts}
+        return self.userdb._coll.find(spec, projection).sort('modified_ts', 1).batch_size(self.batch_size or batch_size)
+
+    def count(self):
+        return self.userdb._coll.count_documents({})
+
+
+class InMemoryPrivateDB(PrivateDB):
+    """
+    PrivateDB keeping user documents in a dict, for tests and benchmarks of the fetch pipeline
+    without a database.
+    """
+
+    def __init__(self, user_class):
+        self.UserClass = user_class
+        self._docs = {}
+
+    def __str__(self):
+        return '<InMemoryPrivateDB {}>'.format(self.UserClass.__name__)
+
+    def save(self, user, check_sync=True):
+        self._docs[user.user_id] = user.to_dict()
+
+    def insert_document(self, doc):
+        """
+        Store a raw document without validating it.
+        """
+        self._docs[doc['_id']] = deepcopy(doc)
+        return doc['_id']
+
+    def _drop_whole_collection(self):
+        self._docs = {}
+
+    def get_user_by_id(self, user_id):
+        return self.UserClass(data=self.get_document_by_id(user_id))
+
+    def get_document_by_id(self, user_id):
+        if user_id not in self._docs:
+            raise UserDoesNotExist('No user matching _id={!r}'.format(user_id))
+        return deepcopy(self._docs[user_id])
+
+    def get_users_by_ids(self, user_ids):
+        return [self.UserClass(data=deepcopy(self._docs[user_id])) for user_id in user_ids if user_id in self._docs]
+
+    def iter_documents_since(self, modified_ts, batch_size=1000, projection=None):
+        docs = [doc for doc in self._docs.values()
+                if modified_ts is None or doc.get('modified_ts') is not None and doc['modified_ts'] >= modified_ts]
+        docs.sort(key=lambda doc: (doc.get('modified_ts') is not None, doc.get('modified_ts') or 0))
+        for doc in docs:
+            if projection is not None:
+                doc = dict((key, value) for key, value in doc.items() if key == '_id' or projection.get(key))
+            yield deepcopy(doc)
+
+    def count(self):
+        return len(self._docs)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import multiprocessing
+import resource
+import time
+import zlib
+from copy import deepcopy
+
+import bson
+from pymongo import MongoClient
+from eduid_userdb.personal_data import PersonalDataUser
+from eduid_userdb.proofing import ProofingUser
+from eduid_userdb.security import SecurityUser
+
+from eduid_proofing_amp import OidcProofingAMPContext, LetterProofingAMPContext, LookupMobileProofingAMPContext
+from eduid_proofing_amp import EmailProofingAMPContext, PhoneProofingAMPContext, PersonalDataAMPContext
+from eduid_proofing_amp import SecurityAMPContext, OrcidAMPContext, EidasAMPContext
+from eduid_proofing_amp import attribute_fetcher
+from eduid_proofing_amp.backends import InMemoryPrivateDB
+from eduid_proofing_amp.concurrency import ThreadedFetcher
+
+SAMPLE_USER = {
+    'givenName': 'Testaren',
+    'surname': 'Testsson',
+    'displayName': 'John',
+    'preferredLanguage': 'sv',
+    'eduPersonPrincipalName': 'test-test',
+    'mailAliases': [{
+        'email': 'john@example.com',
+        'verified': True,
+    }],
+    'mobile': [{
+        'verified': True,
+        'mobile': '+46700011336',
+        'primary': True
+    }],
+    'passwords': [{
+        'credential_id': '112345678901234567890123',
+        'salt': '$NDNv1H1$9c810d852430b62a9a7c6159d5d64c41c3831846f81b6799b54e1e8922f11545$32$32$',
+    }],
+    'nins': [
+        {'number': '123456781235', 'primary': True, 'verified': True}
+    ],
+    'orcid': {
+        'oidc_authz': {
+            'token_type': 'bearer',
+            'refresh_token': 'a_refresh_token',
+            'access_token': 'an_access_token',
+            'id_token': {
+                'nonce': 'a_nonce',
+                'sub': 'sub_id',
+                'iss': 'https://issuer.example.org',
+                'created_by': 'orcid',
+                'exp': 1526890816,
+                'auth_time': 1526890214,
+                'iat': 1526890216,
+                'aud': ['APP-YIAD0N1L4B3Z3W9Q'],
+            },
+            'expires_in': 631138518,
+            'created_by': 'orcid',
+        },
+        'given_name': 'Testaren',
+        'family_name': 'Testsson',
+        'name': None,
+        'id': 'orcid_unique_id',
+        'verified': True,
+        'created_by': 'orcid',
+    },
+}
+
+# Plugin contexts and the user classes of their private databases
+CONTEXTS = [
+    (OidcProofingAMPContext, ProofingUser),
+    (LetterProofingAMPContext, ProofingUser),
+    (LookupMobileProofingAMPContext, ProofingUser),
+    (EmailProofingAMPContext, ProofingUser),
+    (PhoneProofingAMPContext, ProofingUser),
+    (PersonalDataAMPContext, PersonalDataUser),
+    (SecurityAMPContext, SecurityUser),
+    (OrcidAMPContext, ProofingUser),
+    (EidasAMPContext, ProofingUser),
+]
+
+
+def large_user(elements=100):
+    """
+    A user like SAMPLE_USER with `elements' NINs, e-mail addresses, phone numbers, passwords,
+    letter proofing attempts and ORCID audiences, representative of the large documents of the
+    security and letter proofing databases.
+
+    :rtype: dict
+    """
+    user = deepcopy(SAMPLE_USER)
+    user['_id'] = bson.ObjectId()
+    del user['mobile']
+    user['nins'] = [{'number': '1987010{:05d}'.format(i), 'verified': i == 0, 'primary': i == 0,
+                     'created_by': 'eduid-idproofing-letter'} for i in range(elements)]
+    user['mailAliases'] = [{'email': 'user{}@example.com'.format(i), 'verified': True, 'primary': i == 0,
+                            'created_by': 'signup'} for i in range(elements)]
+    user['phone'] = [{'number': '+4670{:07d}'.format(i), 'verified': True, 'primary': i == 0,
+                      'created_by': 'eduid-phone'} for i in range(elements)]
+    user['passwords'] = [{'credential_id': '{:024x}'.format(i), 'salt': SAMPLE_USER['passwords'][0]['salt'],
+                          'is_generated': False, 'created_by': 'eduid-security'} for i in range(elements)]
+    user['letter_proofing_data'] = [{
+        'verification_code': 'code{}'.format(i),
+        'verified': False,
+        'created_by': 'eduid-idproofing-letter',
+        'official_address': {
+            'OfficialAddress': {'PostalCode': '12345', 'City': 'LANDET', 'Address2': 'ÖRGATAN {} LGH 10'.format(i)},
+            'Name': {'GivenName': 'Testaren Test', 'Surname': 'Testsson', 'GivenNameMarking': '20'},
+        },
+    } for i in range(elements)]
+    user['orcid']['oidc_authz']['id_token']['aud'] = ['APP-{:016d}'.format(i) for i in range(elements)]
+    return user
+
+
+def compressed_sizes(doc, levels=(1, 6, 9)):
+    """
+    :return: The BSON size of doc, and its size compressed with zlib per compression level
+    :rtype: tuple
+    """
+    data = bson.BSON.encode(doc)
+    return len(data), dict((level, len(zlib.compress(data, level))) for level in levels)
+
+
+def _bytes_out(db):
+    network = db.command('serverStatus')['network']
+    # physicalBytesOut is what went on the wire after compression, bytesOut is uncompressed
+    return network.get('physicalBytesOut', network['bytesOut'])
+
+
+def time_wire_fetches(mongo_uri, compressors, user_ids, iterations, database):
+    """
+    Read users by _id with a client using some network compressors, like the private database
+    reads of attribute_fetcher. Bytes on the wire are taken from the server's serverStatus,
+    so other clients of the server are counted too.
+
+    :param compressors: Value of the compressors option, '' for no compression
+    :return: Mean seconds per read and bytes sent by the server per read
+    :rtype: tuple
+    """
+    client = MongoClient(mongo_uri, compressors=compressors or None)
+    coll = client[database]['users']
+    try:
+        for user_id in user_ids:
+            coll.find_one({'_id': user_id})
+        before = _bytes_out(client[database])
+        start = time.time()
+        for _ in range(iterations):
+            for user_id in user_ids:
+                coll.find_one({'_id': user_id})
+        elapsed = time.time() - start
+        sent = _bytes_out(client[database]) - before
+    finally:
+        client.close()
+    reads = float(iterations * len(user_ids))
+    return elapsed / reads, sent / reads
+
+
+def wire_benchmark(mongo_uri, compressors, elements, users, iterations, database):
+    """
+    Print fetch latency and bytes on the wire with each of compressors, reading `users' large
+    users stored in a scratch database that is dropped afterwards.
+    """
+    docs = [large_user(elements) for _ in range(users)]
+    size, compressed = compressed_sizes(docs[0])
+    print('Document size {} bytes, zlib estimate: {}'.format(
+        size, ', '.join('level {} {} bytes'.format(level, compressed[level]) for level in sorted(compressed))))
+
+    client = MongoClient(mongo_uri)
+    client.drop_database(database)
+    client[database]['users'].insert_many(docs)
+    try:
+        for name in compressors:
+            latency, sent = time_wire_fetches(mongo_uri, name, [doc['_id'] for doc in docs], iterations, database)
+            print('{:<10} {:>10.1f} us/read {:>10.0f} bytes/read'.format(name or 'none', latency * 1e6, sent))
+    finally:
+        client.drop_database(database)
+        client.close()
+
+
+class SlowPrivateDB(InMemoryPrivateDB):
+    """
+    InMemoryPrivateDB taking `latency' seconds per read, standing in for a database round trip.
+    """
+
+    def __init__(self, user_class, latency):
+        super(SlowPrivateDB, self).__init__(user_class)
+        self.latency = latency
+
+    def get_document_by_id(self, user_id):
+        time.sleep(self.latency)
+        return super(SlowPrivateDB, self).get_document_by_id(user_id)
+
+
+def _slow_context(latency):
+    context = SecurityAMPContext(None, private_db=SlowPrivateDB(SecurityUser, latency))
+    user = SecurityUser(data=deepcopy(SAMPLE_USER))
+    context.private_db.save(user)
+    return context, user.user_id
+
+
+_process_context = None
+
+
+def _process_init(latency):
+    global _process_context
+    _process_context = _slow_context(latency)
+
+
+def _process_fetch(_):
+    context, user_id = _process_context
+    return attribute_fetcher(context, user_id)
+
+
+def concurrency_benchmark(workers, fetches, latency):
+    """
+    Print the throughput and peak memory of `fetches' fetches run by a pool of `workers' threads
+    sharing one context, and by a pool of `workers' processes with a context each. Each read
+    takes `latency' seconds, 0 for a CPU bound comparison.
+    """
+    context, user_id = _slow_context(latency)
+    fetcher = ThreadedFetcher(workers)
+    start = time.time()
+    fetcher.fetch_many(context, [user_id] * fetches)
+    elapsed = time.time() - start
+    fetcher.shutdown()
+    print('{:<10} {:>10.0f} fetches/s {:>10d} kB max RSS, 1 context'.format(
+        'threads', fetches / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    pool = multiprocessing.Pool(workers, initializer=_process_init, initargs=(latency,))
+    try:
+        # Start all processes before timing
+        pool.map(_process_fetch, range(workers))
+        start = time.time()
+        pool.map(_process_fetch, range(fetches), chunksize=max(1, fetches // (workers * 4)))
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    print('{:<10} {:>10.0f} fetches/s {:>10d} kB max RSS per process, {} contexts'.format(
+        'processes', fetches / elapsed, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, workers))
+
+
+def in_memory_context(context_class, user_class, user_data=SAMPLE_USER):
+    """
+    :return: A plugin context with an InMemoryPrivateDB holding one user, and that user's id
+    :rtype: tuple
+    """
+    context = context_class(None, private_db=InMemoryPrivateDB(user_class))
+    user = user_class(data=deepcopy(user_data))
+    context.private_db.save(user)
+    return context, user.user_id
+
+
+def time_fetches(context, user_id, iterations):
+    """
+    :return: Mean seconds per attribute_fetcher call
+    :rtype: float
+    """
+    start = time.time()
+    for _ in range(iterations):
+        attribute_fetcher(context, user_id)
+    return (time.time() - start) / iterations
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CPU cost of attribute_fetcher without a database, '
+                                                 'or with --mongo-uri, private database reads with network compression')
+    parser.add_argument('--iterations', type=int, default=1000, help='Calls per plugin, or reads per user')
+    parser.add_argument('--mongo-uri', help='MongoDB to benchmark reads against, in a scratch database')
+    parser.add_argument('--database', default='eduid_proofing_amp_benchmark', help='Scratch database, dropped')
+    parser.add_argument('--compressors', nargs='+', default=['', 'zlib', 'snappy', 'zstd'],
+                        help="Compressors option values to compare, '' for none")
+    parser.add_argument('--elements', type=int, default=100, help='NINs, e-mail addresses, ... per user')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, metavar='WORKERS',
+                        help='Compare a pool of WORKERS threads with one of WORKERS processes')
+    parser.add_argument('--read-latency', type=float, default=0.002,
+                        help='Seconds per simulated private database read with --concurrency')
+    args = parser.parse_args(args)
+
+    if args.concurrency:
+        concurrency_benchmark(args.concurrency, args.iterations, args.read_latency)
+        return 0
+    if args.mongo_uri:
+        wire_benchmark(args.mongo_uri, args.compressors, args.elements, args.users, args.iterations, args.database)
+        return 0
+    for context_class, user_class in CONTEXTS:
+        context, user_id = in_memory_context(context_class, user_class)
+        mean = time_fetches(context, user_id, args.iterations)
+        print('{:<30} {:>10.1f} us/call'.format(context.PLUGIN_NAME, mean * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import threading
+
+from bson import json_util
+from celery.utils.log import get_task_logger
+from eduid_userdb.exceptions import UserDoesNotExist
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Secondary, SecondaryPreferred
+
+logger = get_task_logger(__name__)
+
+READ_PREFERENCES = {
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def session_token(session):
+    """
+    Make a causal token of the last operation in a pymongo session, for a proofing application
+    to pass along with the sync request after saving a user with w='majority':
+
+        with client.start_session(causal_consistency=True) as session:
+            proofing_userdb._coll.replace_one({'_id': user.user_id}, user.to_dict(), session=session)
+            token = session_token(session)
+
+    The Attribute Manager hands the token to attribute_fetcher(context, user_id, causal_token=token).
+
+    :return: The cluster and operation time of the session, as Extended JSON
+    :rtype: str
+    """
+    return json_util.dumps({'clusterTime': session.cluster_time, 'operationTime': session.operation_time})
+
+
+def load_token(token):
+    """
+    :param token: Causal token made by session_token, or the dict it encodes
+
+    :raise ValueError: The token has no operation time
+    :return: 'clusterTime' and 'operationTime'
+    :rtype: dict
+    """
+    if isinstance(token, str):
+        token = json_util.loads(token)
+    if not isinstance(token, dict) or token.get('operationTime') is None:
+        raise ValueError('Causal token has no operationTime: {!r}'.format(token))
+    return token
+
+
+class CausalReader(object):
+    """
+    Read private users given a causal token in a causally consistent session, so that the
+    read may be served by a secondary, yet reflects at least the write the token was made
+    after: the secondary waits until it has replicated up to the operation time.
+
+    Reads use read concern majority, so the guarantee holds across a primary failover as long
+    as the producing application wrote with w='majority'.
+    """
+
+    def __init__(self, read_preference=None, max_time_ms=None):
+        self.read_preference = read_preference or SecondaryPreferred()
+        self.max_time_ms = max_time_ms
+        self.reads = 0
+        self.fallbacks = 0
+        self._colls = {}
+        self._lock = threading.Lock()
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'reads': self.reads,
+            'fallbacks': self.fallbacks,
+        }
+
+    def _causal_coll(self, coll):
+        # Clusters (see MONGO_URIS) may have databases and collections of the same names. The
+        # cached collection keeps its client alive, so the id is not reused while cached.
+        key = (id(coll.database.client), coll.database.name, coll.name)
+        with self._lock:
+            if key not in self._colls:
+                self._colls[key] = coll.with_options(read_preference=self.read_preference,
+                                                     read_concern=ReadConcern('majority'))
+            return self._colls[key]
+
+    def get_document(self, private_db, user_id, token):
+        """
+        Read a raw user document like private_db.get_document_by_id, no older than token.
+
+        :param private_db: Private user database of a plugin context
+        :param user_id: Unique identifier
+        :param token: Causal token, see load_token
+
+        :raise UserDoesNotExist: No user with that id in the private database
+        :raise ValueError: The token is not valid
+        """
+        token = load_token(token)
+        coll = getattr(private_db, '_coll', None)
+        if coll is None:
+            # Not a MongoDB private database, nothing to be consistent with
+            with self._lock:
+                self.fallbacks += 1
+            return private_db.get_document_by_id(user_id)
+        with self._lock:
+            self.reads += 1
+        kwargs = {}
+        if self.max_time_ms:
+            kwargs['max_time_ms'] = self.max_time_ms
+        with coll.database.client.start_session(causal_consistency=True) as session:
+            if token.get('clusterTime') is not None:
+                session.advance_cluster_time(token['clusterTime'])
+            session.advance_operation_time(token['operationTime'])
+            doc = self._causal_coll(coll).find_one({'_id': user_id}, session=session, **kwargs)
+        if doc is None:
+            raise UserDoesNotExist('No user matching _id={!r}'.format(user_id))
+        return doc
+
+
+_causal_reader = None
+
+
+def get_causal_reader(am_conf):
+    """
+    Return the causal reader shared by all plugin contexts in this process if CAUSAL_READS
+    is True, reading with CAUSAL_READ_PREFERENCE ('secondary', 'secondaryPreferred' (default)
+    or 'nearest') and a server side time limit of CAUSAL_MAX_TIME_MS, if set.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :raise ValueError: Unknown read preference
+    :rtype: CausalReader | None
+    """
+    global _causal_reader
+    if not am_conf.get('CAUSAL_READS'):
+        return None
+    if _causal_reader is None:
+        name = am_conf.get('CAUSAL_READ_PREFERENCE', 'secondaryPreferred')
+        if name not in READ_PREFERENCES:
+            raise ValueError('Unknown CAUSAL_READ_PREFERENCE {!r}'.format(name))
+        _causal_reader = CausalReader(READ_PREFERENCES[name](), max_time_ms=am_conf.get('CAUSAL_MAX_TIME_MS'))
+    return _causal_reader
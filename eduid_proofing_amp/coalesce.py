@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import atexit
+import datetime
+import threading
+import time
+
+from celery.utils.log import get_task_logger
+from pymongo import MongoClient, UpdateOne
+
+from eduid_proofing_amp.ownership import attribute_priority
+
+logger = get_task_logger(__name__)
+
+
+def _overlaps(path, other):
+    return path != other and (path.startswith(other + '.') or other.startswith(path + '.'))
+
+
+def _without(update, attrs):
+    """
+    :return: update without the attributes in attrs, their parents or their children
+    """
+    result = {}
+    for operator, values in update.items():
+        values = dict((attr, value) for attr, value in values.items()
+                      if not any(attr == other or _overlaps(attr, other) for other in attrs))
+        if values:
+            result[operator] = values
+    return result
+
+
+class PendingUpdate(object):
+    """
+    Merged $set and $unset of one user, remembering the priority of the plugin behind each
+    attribute.
+    """
+
+    def __init__(self):
+        self.set = {}
+        self.unset = {}
+        self.priorities = {}
+        self.since = time.time()
+
+    def conflicts(self, update):
+        """
+        Whether update touches a parent or child path of a pending attribute, e.g. 'orcid'
+        and 'orcid.id', which can not be written in the same update.
+        """
+        pending = list(self.set) + list(self.unset)
+        for attrs in (update.get('$set', {}), update.get('$unset', {})):
+            for attr in attrs:
+                if any(_overlaps(attr, other) for other in pending):
+                    return True
+        return False
+
+    def merge(self, plugin_name, update):
+        for operator, target, other in (('$set', self.set, self.unset), ('$unset', self.unset, self.set)):
+            for attr, value in update.get(operator, {}).items():
+                priority = attribute_priority(plugin_name, attr)
+                if self.priorities.get(attr, priority) < priority:
+                    # A higher priority plugin already decided this attribute
+                    continue
+                other.pop(attr, None)
+                target[attr] = value
+                self.priorities[attr] = priority
+
+    def to_update(self):
+        update = {}
+        if self.set:
+            update['$set'] = self.set
+        if self.unset:
+            update['$unset'] = self.unset
+        return update
+
+
+class UpdateCoalescer(object):
+    """
+    Collect updates for a short window and write them with flush(updates), where updates is
+    a list of (user_id, update) with one merged update per user.
+
+    Updates for the same user are merged: for an attribute set or unset by several plugins
+    the highest priority plugin wins (see ownership.ATTRIBUTE_OWNERS), and the latest update
+    at equal priority. Pending updates for a user are flushed first when a new update touches
+    a parent or child path of a pending attribute.
+
+    Updates a flush fails to write are kept, and written before anything else by the next
+    flush, which flush_expired() attempts every window. When max_retry updates are kept, the
+    hook hands new updates back to the Attribute Manager instead, and drops the attributes
+    they write from the kept and pending updates of the user, so that a later retry does not
+    overwrite them with older values. stop() makes stop_retries more attempts to write what
+    is left; pending and failed updates are lost if the process dies before they are written.
+    """
+
+    def __init__(self, flush, window=0.05, max_pending=1000, max_retry=10000, stop_retries=3):
+        self.flush_func = flush
+        self.window = window
+        self.max_pending = max_pending
+        self.max_retry = max_retry
+        self.stop_retries = stop_retries
+        self.received = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.returned = 0
+        self._pending = {}
+        # Updates of failed flushes, in write order, guarded by _flush_lock
+        self._retry = []
+        # Attributes per user written by the Attribute Manager since, guarded by _lock
+        self._superseded = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Flush expired updates from a daemon thread.
+        """
+        def _run():
+            while not self._stop.wait(self.window / 2.0):
+                try:
+                    self.flush_expired()
+                except Exception:
+                    logger.exception('Flushing coalesced updates failed')
+        self._thread = threading.Thread(target=_run, name='amp-coalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush_all()
+        for _ in range(self.stop_retries):
+            if not self._retry:
+                break
+            time.sleep(self.window)
+            self.flush_all()
+        if self._retry:
+            logger.error('Stopped with {} coalesced updates not written'.format(len(self._retry)))
+
+    def add(self, plugin_name, user_id, update):
+        if not update:
+            return
+        flush_now = []
+        with self._lock:
+            self.received += 1
+            pending = self._pending.get(user_id)
+            if pending is not None and pending.conflicts(update):
+                flush_now.append((user_id, self._pending.pop(user_id).to_update()))
+                pending = None
+            if pending is None:
+                pending = self._pending[user_id] = PendingUpdate()
+            pending.merge(plugin_name, update)
+            if len(self._pending) >= self.max_pending:
+                flush_now.extend(self._take(lambda p: True))
+            if flush_now:
+                # Taken before releasing _lock, so updates for a user are flushed in order
+                self._flush_lock.acquire()
+        if flush_now:
+            self._flush(flush_now)
+
+    def _take(self, select):
+        taken = []
+        for user_id, pending in list(self._pending.items()):
+            if select(pending):
+                taken.append((user_id, self._pending.pop(user_id).to_update()))
+        return taken
+
+    def _supersede(self, user_id, update):
+        attrs = [attr for values in update.values() for attr in values]
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                for attr in list(pending.set) + list(pending.unset):
+                    if any(attr == other or _overlaps(attr, other) for other in attrs):
+                        pending.set.pop(attr, None)
+                        pending.unset.pop(attr, None)
+            self._superseded.setdefault(user_id, set()).update(attrs)
+
+    @property
+    def retrying(self):
+        """
+        :return: Number of updates kept from failed flushes
+        :rtype: int
+        """
+        return len(self._retry)
+
+    def _flush(self, updates):
+        """
+        Write the updates of failed flushes and then updates, and release _flush_lock, which
+        the caller must hold. If the write fails, all of them are kept for the next flush.
+        """
+        try:
+            with self._lock:
+                superseded, self._superseded = self._superseded, {}
+            retry = [(user_id, _without(update, superseded[user_id]) if user_id in superseded else update)
+                     for user_id, update in self._retry]
+            updates = [(user_id, update) for user_id, update in retry + updates if update]
+            if updates:
+                try:
+                    self.flush_func(updates)
+                except Exception:
+                    self.failed_flushes += 1
+                    self._retry = updates
+                    logger.exception('Flushing {} coalesced updates failed, will retry'.format(len(updates)))
+                    return
+                self._retry = []
+                self.flushed += len(updates)
+        finally:
+            self._flush_lock.release()
+
+    def flush_expired(self):
+        deadline = time.time() - self.window
+        with self._lock:
+            updates = self._take(lambda pending: pending.since <= deadline)
+            self._flush_lock.acquire()
+        self._flush(updates)
+
+    def flush_all(self):
+        with self._lock:
+            updates = self._take(lambda pending: True)
+            self._flush_lock.acquire()
+        self._flush(updates)
+
+    def __call__(self, fetch, context, user_id, stats):
+        """
+        Fetch hook adding the update to the coalescer, leaving the Attribute Manager nothing to
+        write, unless max_retry updates are waiting to be written again.
+        """
+        update = fetch(context, user_id, stats)
+        if self.retrying >= self.max_retry:
+            self.returned += 1
+            self._supersede(user_id, update)
+            return update
+        self.add(context.PLUGIN_NAME, user_id, update)
+        return {}
+
+
+def collection_flusher(collection):
+    """
+    :param collection: pymongo collection of the central user database
+    :return: A flush function for UpdateCoalescer writing to collection in unordered bulk writes
+
+    The updates are written straight to the collection, not by the Attribute Manager task
+    that would otherwise have written them, so none of the task's own logging or error
+    handling applies; a failed write is retried by the coalescer instead. modified_ts of each
+    user is set to the time of the write. Several updates of one user, e.g. kept from a
+    failed flush, are written in order, in separate bulk writes.
+    """
+    def _write(batch):
+        if batch:
+            collection.bulk_write(batch, ordered=False)
+
+    def flush(updates):
+        now = datetime.datetime.utcnow()
+        batch = []
+        seen = set()
+        for user_id, update in updates:
+            if user_id in seen:
+                _write(batch)
+                batch = []
+                seen = set()
+            seen.add(user_id)
+            update = dict(update)
+            update['$set'] = dict(update.get('$set', {}), modified_ts=now)
+            batch.append(UpdateOne({'_id': user_id}, update))
+        _write(batch)
+    return flush
+
+
+_coalescer = None
+
+
+def get_coalescer(am_conf):
+    """
+    Return the coalescer shared by all plugin contexts in this process, writing to the
+    central user database in COALESCE_MONGO_URI (default MONGO_URI). At most
+    COALESCE_MAX_RETRY updates of failed flushes are kept, and the coalescer writes what it
+    holds when the worker exits.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: UpdateCoalescer
+    """
+    global _coalescer
+    if _coalescer is None:
+        client = MongoClient(am_conf.get('COALESCE_MONGO_URI', am_conf['MONGO_URI']))
+        collection = client[am_conf.get('COALESCE_DATABASE', 'eduid_am')][am_conf.get('COALESCE_COLLECTION',
+                                                                                      'attributes')]
+        _coalescer = UpdateCoalescer(collection_flusher(collection),
+                                     window=am_conf['COALESCE_WINDOW'],
+                                     max_pending=am_conf.get('COALESCE_MAX_PENDING', 1000),
+                                     max_retry=am_conf.get('COALESCE_MAX_RETRY', 10000))
+        _coalescer.start()
+        atexit.register(_coalescer.stop)
+    return _coalescer
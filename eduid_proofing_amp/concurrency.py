@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from concurrent import futures
+
+from eduid_proofing_amp.scheduling import current_origin, fetch_origin
+from eduid_proofing_amp.tracing import current_traceparent, trace_context
+
+
+class ThreadedFetcher(object):
+    """
+    Runs attribute_fetcher calls in a pool of threads, sharing the plugin contexts and so the
+    connection pools of their private databases. Works with gevent monkey patching too, the
+    threads then being greenlets.
+
+    The origin (scheduling.fetch_origin) and trace context (tracing.trace_context) of the
+    submitting thread are carried over to the fetch.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.executor = futures.ThreadPoolExecutor(max_workers)
+
+    def submit(self, context, user_id, causal_token=None):
+        """
+        :param causal_token: Causal token for attribute_fetcher, see causal.session_token
+        :return: A future for the update of one user
+        :rtype: concurrent.futures.Future
+        """
+        from eduid_proofing_amp import attribute_fetcher
+
+        origin = current_origin()
+        traceparent = current_traceparent()
+
+        def _fetch():
+            with fetch_origin(origin), trace_context(traceparent):
+                return attribute_fetcher(context, user_id, causal_token=causal_token)
+        return self.executor.submit(_fetch)
+
+    def fetch_many(self, context, user_ids):
+        """
+        Fetch the updates of many users in parallel.
+
+        :param context: Plugin context
+        :param user_ids: Unique identifiers
+
+        :return: (user_id, update, exception) tuples, in the order of user_ids
+        :rtype: list
+        """
+        submitted = [(user_id, self.submit(context, user_id)) for user_id in user_ids]
+        result = []
+        for user_id, future in submitted:
+            error = future.exception()
+            result.append((user_id, future.result() if error is None else None, error))
+        return result
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_threaded_fetcher = None
+
+
+def get_threaded_fetcher(am_conf):
+    """
+    Return the thread pool shared by all plugin contexts in this process, with FETCH_THREADS
+    threads (default 8).
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: ThreadedFetcher
+    """
+    global _threaded_fetcher
+    if _threaded_fetcher is None:
+        _threaded_fetcher = ThreadedFetcher(am_conf.get('FETCH_THREADS', 8))
+    return _threaded_fetcher
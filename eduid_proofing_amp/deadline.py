@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+from celery.utils.log import get_task_logger
+from eduid_userdb.exceptions import UserDoesNotExist
+from pymongo.read_preferences import Secondary
+
+from eduid_proofing_amp.scheduling import current_origin
+
+logger = get_task_logger(__name__)
+
+# pymongo refuses max_staleness values below this
+MIN_MAX_STALENESS = 90
+
+# Fetch origins (see scheduling.fetch_origin) that may be served stale data by default
+HEDGE_ORIGINS = ('resync', 'backfill', 'audit')
+
+
+class LatencyWindow(object):
+    """
+    The latencies of the last `size' reads, with a percentile that is recomputed every
+    `recompute_every' recorded latency.
+    """
+
+    def __init__(self, percentile, size=1000, recompute_every=100, min_samples=20):
+        self.percentile = percentile
+        self.recompute_every = recompute_every
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+        self._recorded = 0
+        self._value = None
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._recorded += 1
+            if len(self._latencies) >= self.min_samples and (
+                    self._value is None or self._recorded % self.recompute_every == 0):
+                ordered = sorted(self._latencies)
+                index = int(round(self.percentile / 100.0 * (len(ordered) - 1)))
+                self._value = ordered[index]
+
+    @property
+    def value(self):
+        """
+        :return: Latency percentile in seconds, or None until min_samples have been recorded
+        :rtype: float | None
+        """
+        return self._value
+
+
+class DeadlineReader(object):
+    """
+    Read private users with a server side time limit (maxTimeMS), optionally hedging the read
+    with a secondary when the primary has not answered within the hedge percentile of recent
+    primary latencies.
+
+    Hedged reads accept data up to max_staleness seconds old from the secondary, and only a
+    secondary that found the user can win the race. As a sync triggered by a proofing
+    application runs right after the write, a secondary would often return the user as it
+    was before it. Reads are therefore only hedged for fetches with one of the
+    `hedge_origins', like resync jobs, which may be served data that is slightly stale.
+    """
+
+    def __init__(self, max_time_ms, hedge_percentile=None, max_staleness=MIN_MAX_STALENESS, executor=None,
+                 hedge_origins=HEDGE_ORIGINS):
+        self.max_time_ms = max_time_ms
+        self.hedge_percentile = hedge_percentile
+        self.max_staleness = max(max_staleness, MIN_MAX_STALENESS)
+        self.executor = executor
+        self.hedge_origins = frozenset(hedge_origins)
+        self.latencies = LatencyWindow(hedge_percentile) if hedge_percentile else None
+        self.reads = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self._secondary_coll = None
+        self._stats_lock = threading.Lock()
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'reads': self.reads,
+            'hedges_fired': self.hedges_fired,
+            'hedges_won': self.hedges_won,
+            'hedge_delay': self.hedge_delay,
+        }
+
+    @property
+    def hedge_delay(self):
+        """
+        Seconds to wait for the primary before hedging.
+        """
+        if self.latencies is None:
+            return None
+        if self.latencies.value is None:
+            return self.max_time_ms / 2000.0
+        return self.latencies.value
+
+    def _find(self, coll, user_id):
+        return coll.find_one({'_id': user_id}, max_time_ms=self.max_time_ms)
+
+    def _find_primary(self, coll, user_id):
+        start = time.time()
+        doc = self._find(coll, user_id)
+        if self.latencies is not None:
+            self.latencies.record(time.time() - start)
+        return doc
+
+    def _secondary(self, coll):
+        if self._secondary_coll is None:
+            self._secondary_coll = coll.with_options(read_preference=Secondary(max_staleness=self.max_staleness))
+        return self._secondary_coll
+
+    def _hedged_find(self, coll, user_id):
+        primary = self.executor.submit(self._find_primary, coll, user_id)
+        done, _ = futures.wait([primary], timeout=self.hedge_delay)
+        if done:
+            return primary.result()
+
+        with self._stats_lock:
+            self.hedges_fired += 1
+        logger.debug('Primary read of user {} slower than {:.3f}s, hedging with secondary'.format(
+            user_id, self.hedge_delay))
+        secondary = self.executor.submit(self._find, self._secondary(coll), user_id)
+        done, _ = futures.wait([primary, secondary], return_when=futures.FIRST_COMPLETED)
+        if secondary in done and secondary.exception() is None and secondary.result() is not None:
+            with self._stats_lock:
+                self.hedges_won += 1
+            return secondary.result()
+        return primary.result()
+
+    def get_document(self, private_db, user_id):
+        """
+        Read a raw user document like private_db.get_document_by_id.
+
+        :param private_db: Private user database of a plugin context
+        :param user_id: Unique identifier
+
+        :raise UserDoesNotExist: No user with that id in the private database
+        :raise pymongo.errors.ExecutionTimeout: The read took longer than max_time_ms
+        """
+        with self._stats_lock:
+            self.reads += 1
+        if self.latencies is not None and self.executor is not None and current_origin() in self.hedge_origins:
+            doc = self._hedged_find(private_db._coll, user_id)
+        else:
+            doc = self._find(private_db._coll, user_id)
+        if doc is None:
+            raise UserDoesNotExist('No user matching _id={!r}'.format(user_id))
+        return doc
+
+    def __call__(self, private_db, user_id):
+        """
+        Read a user like private_db.get_user_by_id.
+        """
+        return private_db.UserClass(data=self.get_document(private_db, user_id))
+
+
+_hedge_executor = None
+
+
+def get_deadline_reader(am_conf, plugin_name):
+    """
+    Return a DeadlineReader for a plugin from FETCH_DEADLINES in the AM configuration, e.g.
+
+        FETCH_DEADLINES = {
+            'eduid_security': {'max_time_ms': 500, 'hedge_percentile': 95, 'max_staleness': 90},
+        }
+
+    Reads are only hedged for the fetch origins in 'hedge_origins', by default HEDGE_ORIGINS.
+
+    :param am_conf: Attribute Manager configuration data.
+    :param plugin_name: Entry point name of the plugin
+
+    :type am_conf: dict
+    :type plugin_name: str
+
+    :return: A reader, or None if no deadline is configured for the plugin
+    :rtype: DeadlineReader | None
+    """
+    global _hedge_executor
+    settings = am_conf.get('FETCH_DEADLINES', {}).get(plugin_name)
+    if not settings:
+        return None
+    executor = None
+    if settings.get('hedge_percentile'):
+        if _hedge_executor is None:
+            _hedge_executor = futures.ThreadPoolExecutor(am_conf.get('FETCH_HEDGE_THREADS', 8))
+        executor = _hedge_executor
+    return DeadlineReader(settings['max_time_ms'],
+                          hedge_percentile=settings.get('hedge_percentile'),
+                          max_staleness=settings.get('max_staleness', MIN_MAX_STALENESS),
+                          executor=executor,
+                          hedge_origins=settings.get('hedge_origins', HEDGE_ORIGINS))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import json
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Driver options a profile may set, passed to the userdb as MongoDB URI options
+URI_OPTIONS = (
+    'compressors',
+    'zlibCompressionLevel',
+    'maxPoolSize',
+    'minPoolSize',
+    'maxIdleTimeMS',
+    'waitQueueTimeoutMS',
+    'connectTimeoutMS',
+    'socketTimeoutMS',
+    'serverSelectionTimeoutMS',
+    'localThresholdMS',
+)
+
+# Cursor batch size, not a URI option; set on the MongoPrivateDB of the context
+BATCH_SIZE = 'batchSize'
+
+# Attribute Manager configuration keys deciding how a plugin reaches its private database
+CONNECTION_KEYS = ('MONGO_URI', 'MONGO_URIS', 'MONGO_DRIVER_OPTIONS', 'MONGO_DRIVER_PROFILES')
+
+
+def driver_profile(am_conf, plugin_name):
+    """
+    The driver profile of a plugin: MONGO_DRIVER_OPTIONS, updated with the plugin's entry in
+    MONGO_DRIVER_PROFILES, e.g.
+
+        MONGO_DRIVER_OPTIONS = {'compressors': 'zstd,zlib', 'connectTimeoutMS': 2000}
+        MONGO_DRIVER_PROFILES = {'eduid_security': {'maxPoolSize': 200, 'batchSize': 50}}
+
+    :param am_conf: Attribute Manager configuration data.
+    :param plugin_name: Name of the plugin entry point
+
+    :type am_conf: dict
+    :type plugin_name: str
+
+    :raise ValueError: Unknown driver option
+    :rtype: dict
+    """
+    profile = dict(am_conf.get('MONGO_DRIVER_OPTIONS') or {})
+    profile.update((am_conf.get('MONGO_DRIVER_PROFILES') or {}).get(plugin_name) or {})
+    for option in profile:
+        if option not in URI_OPTIONS and option != BATCH_SIZE:
+            raise ValueError('Unknown driver option {!r} for {}'.format(option, plugin_name))
+    return profile
+
+
+def profile_uri(uri, profile):
+    """
+    :param uri: MongoDB URI
+    :param profile: Driver profile, from driver_profile
+    :return: uri with the URI options of the profile added, replacing those already in uri
+    :rtype: str
+    """
+    options = [(key, value) for key, value in profile.items() if key in URI_OPTIONS]
+    if not options:
+        return uri
+    parts = urlsplit(uri)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key not in profile]
+    query.extend(sorted((key, str(value)) for key, value in options))
+    path = parts.path or '/'
+    return urlunsplit((parts.scheme, parts.netloc, path, urlencode(query, safe=','), parts.fragment))
+
+
+def plugin_mongo_uri(am_conf, plugin_name):
+    """
+    :param am_conf: Attribute Manager configuration data.
+    :param plugin_name: Name of the plugin entry point
+
+    :type am_conf: dict
+    :type plugin_name: str
+
+    :return: The plugin's entry in MONGO_URIS, or MONGO_URI, tuned with the driver profile of the plugin
+    :rtype: str
+    """
+    uri = (am_conf.get('MONGO_URIS') or {}).get(plugin_name, am_conf['MONGO_URI'])
+    return profile_uri(uri, driver_profile(am_conf, plugin_name))
+
+
+def add_connection_arguments(parser):
+    """
+    Add the options of connection_conf to the argument parser of a command line tool.
+    """
+    parser.add_argument('--config', help='JSON file with the {} of the AM configuration'.format(
+        ', '.join(CONNECTION_KEYS)))
+    parser.add_argument('--mongo-uri', help='MONGO_URI of the private databases, overriding --config')
+    parser.add_argument('--plugin-uri', action='append', default=[], metavar='PLUGIN=URI',
+                        help='MONGO_URIS entry of a plugin on a cluster of its own, overriding --config')
+
+
+def connection_conf(parser, args):
+    """
+    Build the part of the Attribute Manager configuration that decides how each plugin reaches
+    its private database, from the options added by add_connection_arguments, so that command
+    line tools connect every plugin like the workers do, see plugin_mongo_uri.
+
+    :param parser: The argument parser, to report errors with
+    :param args: Parsed arguments
+
+    :return: Attribute Manager configuration data holding only CONNECTION_KEYS
+    :rtype: dict
+    """
+    am_conf = {}
+    if args.config:
+        with open(args.config) as fd:
+            config = json.load(fd)
+        am_conf.update((key, config[key]) for key in CONNECTION_KEYS if key in config)
+    if args.mongo_uri:
+        am_conf['MONGO_URI'] = args.mongo_uri
+    for item in args.plugin_uri:
+        plugin_name, sep, uri = item.partition('=')
+        if not sep or not uri:
+            parser.error('--plugin-uri must be PLUGIN=URI, not {!r}'.format(item))
+        am_conf['MONGO_URIS'] = dict(am_conf.get('MONGO_URIS') or {}, **{plugin_name: uri})
+    if not am_conf.get('MONGO_URI'):
+        parser.error('MONGO_URI is not set, use --mongo-uri or --config')
+    return am_conf
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import atexit
+import datetime
+import gzip
+import io
+import os
+import struct
+import threading
+import time
+import zlib
+
+import bson
+from bson import json_util
+from bson.errors import InvalidBSON
+from celery.utils.log import get_task_logger
+from pymongo import MongoClient, UpdateOne
+
+logger = get_task_logger(__name__)
+
+BSON = 'bson'
+JSONL = 'jsonl'
+FORMATS = (BSON, JSONL)
+
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Ends the deflate data written up to a Z_SYNC_FLUSH
+SYNC_FLUSH_MARKER = b'\x00\x00\xff\xff'
+# Empty final stored block, to end deflate data at a sync flush point
+FINAL_EMPTY_BLOCK = b'\x01\x00\x00\xff\xff'
+
+
+def _gunzip(fd, state=None):
+    """
+    Decompress a file of one or more gzip members, like gzip.open does, except that a last
+    member cut off by a killed writer ends the data instead of raising EOFError.
+
+    :param fd: File opened for binary reading
+    :param state: Dict to record the 'crc' and 'size' of the data of the last member in, and
+                  whether it is 'complete'
+
+    :return: Chunks of decompressed data
+    """
+    if state is None:
+        state = {}
+    state.update(crc=0, size=0, complete=True)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = b''
+    while True:
+        data = data or fd.read(READ_BUFFER_SIZE)
+        if not data:
+            return
+        state['complete'] = False
+        chunk = decompressor.decompress(data)
+        state['crc'] = zlib.crc32(chunk, state['crc'])
+        state['size'] += len(chunk)
+        if chunk:
+            yield chunk
+        data = b''
+        if decompressor.eof:
+            data = decompressor.unused_data.lstrip(b'\x00')
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            state.update(crc=0, size=0, complete=True)
+
+
+class _ChunkReader(io.RawIOBase):
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._chunk:
+            self._chunk = next(self._chunks, b'')
+            if not self._chunk:
+                return 0
+        size = min(len(buf), len(self._chunk))
+        buf[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def end_update_file(path):
+    """
+    Make an update file left by a killed writer a valid gzip file again, so that it can be
+    appended to. If the writer was killed at a flush point, the last member is completed.
+    Otherwise the file is moved aside, with a '.damaged-<time>' suffix, to be read with
+    read_updates.
+
+    :return: Whether the file was repaired or moved
+    :rtype: bool
+    """
+    state = {}
+    with open(path, 'rb') as fd:
+        for _ in _gunzip(fd, state):
+            pass
+        if state['complete']:
+            return False
+        fd.seek(-len(SYNC_FLUSH_MARKER), os.SEEK_END)
+        at_flush_point = fd.read() == SYNC_FLUSH_MARKER
+    if at_flush_point:
+        with open(path, 'ab') as fd:
+            fd.write(FINAL_EMPTY_BLOCK + struct.pack('<II', state['crc'] & 0xffffffff, state['size'] & 0xffffffff))
+        logger.warning('Completed update file {} of a killed writer'.format(path))
+    else:
+        damaged = '{}.damaged-{}'.format(path, int(time.time()))
+        os.rename(path, damaged)
+        logger.error('Moved update file {} of a killed writer to {}'.format(path, damaged))
+    return True
+
+
+class UpdateWriter(object):
+    """
+    Append-only, gzip compressed stream of updates, one record per update:
+
+        {'user_id': ObjectId, 'plugin': 'eduid_security', 'update': {'$set': {...}, '$unset': {...}}}
+
+    in BSON (concatenated documents, like mongodump) or JSON lines (MongoDB extended JSON).
+    Records are written as they come, so memory use does not grow with the number of updates.
+
+    The compressed stream is flushed to the file every `flush_every' records, so a killed
+    writer loses at most the records since the last flush. read_updates reads such a file,
+    and a new writer completes it before appending, see end_update_file.
+    """
+
+    def __init__(self, path, fmt=BSON, compresslevel=6, flush_every=1):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown update file format: {}'.format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.flush_every = flush_every
+        self.written = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path) and os.path.getsize(path):
+            end_update_file(path)
+        self._fd = gzip.open(path, 'ab', compresslevel=compresslevel)
+
+    def write(self, plugin_name, user_id, update):
+        record = {'user_id': user_id, 'plugin': plugin_name, 'update': update}
+        if self.fmt == BSON:
+            data = bson.BSON.encode(record)
+        else:
+            data = (json_util.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            self._fd.write(data)
+            self.written += 1
+            if self.flush_every and self.written % self.flush_every == 0:
+                self._fd.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        with self._lock:
+            self._fd.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        with self._lock:
+            if not self._fd.closed:
+                self._fd.close()
+
+
+def read_updates(path):
+    """
+    :param path: File written by UpdateWriter, the format is taken from the file name
+    :return: The update records in the file, in order, up to where a killed writer left off
+    """
+    fmt = JSONL if '.jsonl.gz' in os.path.basename(path) else BSON
+    with open(path, 'rb') as raw:
+        fd = io.BufferedReader(_ChunkReader(_gunzip(raw)), buffer_size=READ_BUFFER_SIZE)
+        if fmt == BSON:
+            try:
+                for record in bson.decode_file_iter(fd):
+                    yield record
+            except InvalidBSON as e:
+                logger.warning('Update file {} ends with a partial record: {}'.format(path, e))
+        else:
+            for line in fd:
+                if not line.endswith(b'\n'):
+                    logger.warning('Update file {} ends with a partial record'.format(path))
+                elif line.strip():
+                    yield json_util.loads(line.decode('utf-8'))
+
+
+def update_file_name(directory, plugin_name, fmt=BSON):
+    return os.path.join(directory, 'updates-{}-{}.{}.gz'.format(plugin_name, os.getpid(), fmt))
+
+
+class UpdateExporter(object):
+    """
+    Fetch hook writing the updates produced by attribute_fetcher to an update file per plugin.
+
+    With passthrough False the Attribute Manager gets an empty update, leaving the central
+    write to the apply command.
+    """
+
+    def __init__(self, directory, fmt=BSON, passthrough=True, flush_every=1):
+        self.directory = directory
+        self.fmt = fmt
+        self.passthrough = passthrough
+        self.flush_every = flush_every
+        self.writers = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _writer(self, plugin_name):
+        with self._lock:
+            if plugin_name not in self.writers:
+                self.writers[plugin_name] = UpdateWriter(update_file_name(self.directory, plugin_name, self.fmt),
+                                                         fmt=self.fmt, flush_every=self.flush_every)
+            return self.writers[plugin_name]
+
+    def __call__(self, fetch, context, user_id, stats):
+        update = fetch(context, user_id, stats)
+        if update:
+            self._writer(context.PLUGIN_NAME).write(context.PLUGIN_NAME, user_id, update)
+        if self.passthrough:
+            return update
+        return {}
+
+    def close(self):
+        with self._lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = {}
+
+
+def export_updates(context, user_ids, writer):
+    """
+    Run attribute_fetcher for many users and write the updates, instead of applying them.
+
+    :param context: Plugin context
+    :param user_ids: Iterable of unique identifiers
+    :param writer: UpdateWriter
+
+    :return: Number of updates written
+    :rtype: int
+    """
+    from eduid_proofing_amp import attribute_fetcher
+
+    count = 0
+    for user_id in user_ids:
+        update = attribute_fetcher(context, user_id)
+        if update:
+            writer.write(context.PLUGIN_NAME, user_id, update)
+            count += 1
+    return count
+
+
+def apply_updates(collection, records, batch_size=1000, touch_modified_ts=False):
+    """
+    Apply update records to the central user collection with bulk writes. The writes are
+    ordered, since a file can hold several updates for the same user.
+
+    :param collection: pymongo collection of the central user database
+    :param records: Update records, e.g. from read_updates
+    :param batch_size: Number of updates per bulk write
+    :param touch_modified_ts: Also set modified_ts of the updated users to now
+
+    :return: Number of users modified
+    :rtype: int
+    """
+    modified = 0
+    operations = []
+    for record in records:
+        update = dict(record['update'])
+        if touch_modified_ts:
+            update['$set'] = dict(update.get('$set', {}), modified_ts=datetime.datetime.utcnow())
+        operations.append(UpdateOne({'_id': record['user_id']}, update))
+        if len(operations) >= batch_size:
+            modified += collection.bulk_write(operations, ordered=True).modified_count
+            operations = []
+    if operations:
+        modified += collection.bulk_write(operations, ordered=True).modified_count
+    return modified
+
+
+_exporter = None
+
+
+def get_update_exporter(am_conf):
+    """
+    Return the update exporter shared by all plugin contexts in this process, flushing the
+    update files every EXPORT_UPDATES_FLUSH_EVERY records (default 1, every record) and
+    closing them when the process exits normally.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: UpdateExporter
+    """
+    global _exporter
+    if _exporter is None:
+        _exporter = UpdateExporter(am_conf['EXPORT_UPDATES_DIR'],
+                                   fmt=am_conf.get('EXPORT_UPDATES_FORMAT', BSON),
+                                   passthrough=am_conf.get('EXPORT_UPDATES_PASSTHROUGH', True),
+                                   flush_every=am_conf.get('EXPORT_UPDATES_FLUSH_EVERY', 1))
+        atexit.register(_exporter.close)
+    return _exporter
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Apply exported updates to the central user database')
+    parser.add_argument('--mongo-uri', required=True, help='MONGO_URI of the central user database')
+    parser.add_argument('--database', default='eduid_am')
+    parser.add_argument('--collection', default='attributes')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--touch-modified-ts', action='store_true', help='Set modified_ts of updated users')
+    parser.add_argument('files', nargs='+', help='Update files, applied in the given order')
+    args = parser.parse_args(args)
+
+    collection = MongoClient(args.mongo_uri)[args.database][args.collection]
+    for path in args.files:
+        modified = apply_updates(collection, read_updates(path), batch_size=args.batch_size,
+                                 touch_modified_ts=args.touch_modified_ts)
+        print('{}: {} users modified'.format(path, modified))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
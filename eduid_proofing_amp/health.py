@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import AutoReconnect, ConnectionFailure
+
+from eduid_proofing_amp.indexes import private_collection
+
+logger = get_task_logger(__name__)
+
+HEALTHY = 'healthy'
+UNHEALTHY = 'unhealthy'
+PROBING = 'probing'
+
+
+class PrivateDBUnavailable(AutoReconnect):
+    """
+    The private database of a plugin is marked unhealthy, the fetch was not attempted.
+    """
+
+
+class PrivateDBHealth(object):
+    """
+    Health state of the private database of one plugin, kept apart from that of the other
+    plugins so that a plugin on a cluster that is down does not hold up the others.
+
+    After failure_threshold fetches in a row fail to reach the database, fetches fail at once
+    with PrivateDBUnavailable for retry_after seconds. Then one fetch is let through to probe
+    the database, and its outcome decides whether the plugin is healthy again.
+    """
+
+    def __init__(self, plugin_name, failure_threshold=5, retry_after=30):
+        self.plugin_name = plugin_name
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self.state = HEALTHY
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error = None
+        self.last_ping = None
+        self._unhealthy_since = None
+        self._lock = threading.Lock()
+
+    def _admit(self):
+        with self._lock:
+            if self.state == HEALTHY:
+                return True
+            if self.state == UNHEALTHY and time.time() - self._unhealthy_since >= self.retry_after:
+                self.state = PROBING
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != HEALTHY:
+                logger.info('Private database of {} is healthy again'.format(self.plugin_name))
+            self.state = HEALTHY
+            self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = repr(error)
+            if self.state == PROBING or self.consecutive_failures >= self.failure_threshold:
+                if self.state != UNHEALTHY:
+                    logger.error('Private database of {} is unhealthy: {}'.format(self.plugin_name, error))
+                self.state = UNHEALTHY
+                self._unhealthy_since = time.time()
+
+    def ping(self, context):
+        """
+        Check that the private database of context is reachable, updating the health state.
+
+        :return: Round trip seconds, or None if there is no database to ping or it is unreachable
+        """
+        coll = private_collection(context)
+        if coll is None:
+            return None
+        start = time.time()
+        try:
+            coll.database.command('ping')
+        except ConnectionFailure as e:
+            self.record_failure(e)
+            return None
+        self.last_ping = time.time() - start
+        self.record_success()
+        return self.last_ping
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'last_error': self.last_error,
+            'last_ping': self.last_ping,
+        }
+
+    def __call__(self, fetch, context, user_id, stats):
+        if not self._admit():
+            raise PrivateDBUnavailable('Private database of {} is unhealthy: {}'.format(self.plugin_name,
+                                                                                       self.last_error))
+        try:
+            result = fetch(context, user_id, stats)
+        except ConnectionFailure as e:
+            self.record_failure(e)
+            raise
+        except Exception:
+            # The database answered, e.g. UserDoesNotExist
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+def get_private_db_health(am_conf, context):
+    """
+    Return a PrivateDBHealth of its own for a plugin context if HEALTH_FAILURE_THRESHOLD is set.
+
+    :param am_conf: Attribute Manager configuration data.
+    :param context: Plugin context
+
+    :type am_conf: dict
+
+    :rtype: PrivateDBHealth | None
+    """
+    if not am_conf.get('HEALTH_FAILURE_THRESHOLD'):
+        return None
+    return PrivateDBHealth(context.PLUGIN_NAME, failure_threshold=am_conf['HEALTH_FAILURE_THRESHOLD'],
+                           retry_after=am_conf.get('HEALTH_RETRY_AFTER', 30))
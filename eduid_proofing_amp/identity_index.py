@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import sqlite3
+import threading
+
+import bson
+from celery.utils.log import get_task_logger
+
+from eduid_proofing_amp.driver import add_connection_arguments, connection_conf
+
+logger = get_task_logger(__name__)
+
+NIN = 'nin'
+EMAIL = 'email'
+PHONE = 'phone'
+ORCID = 'orcid'
+
+IDENTIFIER_PROJECTION = {
+    'nins': True,
+    'mailAliases': True,
+    'phone': True,
+    'mobile': True,  # Old format
+    'orcid': True,
+    'modified_ts': True,
+}
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS identifiers ('
+    'kind TEXT NOT NULL, value TEXT NOT NULL, user_id TEXT NOT NULL, plugin TEXT NOT NULL, '
+    'PRIMARY KEY (kind, value, user_id, plugin))',
+    'CREATE INDEX IF NOT EXISTS identifiers_user ON identifiers (user_id, plugin)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB NOT NULL)',
+]
+
+
+def verified_identifiers(doc):
+    """
+    :param doc: User document, in the new or old userdb format
+    :return: The (kind, value) of the verified NINs, e-mail addresses, phone numbers and ORCID of a user
+    :rtype: set
+    """
+    result = set()
+    for kind, attr, key in ((NIN, 'nins', 'number'), (EMAIL, 'mailAliases', 'email'),
+                            (PHONE, 'phone', 'number'), (PHONE, 'mobile', 'mobile')):
+        for item in doc.get(attr) or []:
+            if item.get('verified') is True and item.get(key):
+                value = item[key].lower() if kind == EMAIL else item[key]
+                result.add((kind, value))
+    orcid = doc.get('orcid')
+    if orcid and orcid.get('verified') is True and orcid.get('id'):
+        result.add((ORCID, orcid['id']))
+    return result
+
+
+class IdentityIndex(object):
+    """
+    SQLite index of the verified identifiers found in the private databases of the plugins,
+    answering which users have claimed an identifier without scanning any collection.
+
+    update() brings the index up to date with the users modified in a private database since
+    its previous update. Users deleted from a private database are not noticed, use rebuild=True.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _get_since(self, plugin_name):
+        row = self._conn.execute('SELECT data FROM meta WHERE key = ?', (plugin_name,)).fetchone()
+        if row is None:
+            return None
+        return bson.BSON(row[0]).decode()['modified_ts']
+
+    def _store(self, plugin_name, docs, since):
+        with self._lock:
+            for doc in docs:
+                user_id = str(doc['_id'])
+                self._conn.execute('DELETE FROM identifiers WHERE user_id = ? AND plugin = ?', (user_id, plugin_name))
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO identifiers (kind, value, user_id, plugin) VALUES (?, ?, ?, ?)',
+                    [(kind, value, user_id, plugin_name) for kind, value in verified_identifiers(doc)])
+            if since is not None:
+                self._conn.execute('INSERT OR REPLACE INTO meta (key, data) VALUES (?, ?)',
+                                   (plugin_name, bson.BSON.encode({'modified_ts': since})))
+            self._conn.commit()
+
+    def update(self, context, batch_size=1000, rebuild=False):
+        """
+        Index the users modified in the private database of a plugin context since the last update.
+
+        :param context: Plugin context
+        :param batch_size: Number of documents to read and store at a time
+        :param rebuild: Drop everything indexed for the plugin and read all users
+
+        :return: Number of users indexed
+        :rtype: int
+        """
+        plugin_name = context.PLUGIN_NAME
+        with self._lock:
+            if rebuild:
+                self._conn.execute('DELETE FROM identifiers WHERE plugin = ?', (plugin_name,))
+                self._conn.execute('DELETE FROM meta WHERE key = ?', (plugin_name,))
+                self._conn.commit()
+            since = self._get_since(plugin_name)
+        count = 0
+        batch = []
+        for doc in context.private_db.iter_documents_since(since, batch_size=batch_size,
+                                                           projection=IDENTIFIER_PROJECTION):
+            batch.append(doc)
+            since = doc.get('modified_ts', since)
+            if len(batch) >= batch_size:
+                self._store(plugin_name, batch, since)
+                count += len(batch)
+                batch = []
+        self._store(plugin_name, batch, since)
+        count += len(batch)
+        logger.info('Indexed identifiers of {} users from {}'.format(count, plugin_name))
+        return count
+
+    def lookup(self, kind, value):
+        """
+        :param kind: NIN, EMAIL, PHONE or ORCID
+        :param value: Identifier
+        :return: Ids of the users that have verified the identifier
+        :rtype: set
+        """
+        if kind == EMAIL:
+            value = value.lower()
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT user_id FROM identifiers WHERE kind = ? AND value = ?',
+                                      (kind, value)).fetchall()
+        return set(bson.ObjectId(row[0]) for row in rows)
+
+    def duplicates(self, kind=None):
+        """
+        :param kind: Only this kind of identifier, None for all
+        :return: Identifiers verified by more than one user, as {(kind, value): set of user ids}
+        :rtype: dict
+        """
+        query = 'SELECT kind, value FROM identifiers {} GROUP BY kind, value HAVING COUNT(DISTINCT user_id) > 1'
+        with self._lock:
+            if kind is None:
+                keys = self._conn.execute(query.format('')).fetchall()
+            else:
+                keys = self._conn.execute(query.format('WHERE kind = ?'), (kind,)).fetchall()
+        return dict(((kind, value), self.lookup(kind, value)) for kind, value in keys)
+
+
+def main(args=None):
+    from eduid_proofing_amp import PLUGIN_INITS
+
+    parser = argparse.ArgumentParser(description='Index of verified identifiers in the proofing private databases')
+    parser.add_argument('--index', required=True, help='SQLite file holding the index')
+    subparsers = parser.add_subparsers(dest='command')
+    update = subparsers.add_parser('update', help='Index users modified since the last update')
+    add_connection_arguments(update)
+    update.add_argument('--rebuild', action='store_true', help='Rebuild the index from scratch')
+    update.add_argument('plugins', nargs='*', help='Plugins to index (default: all)')
+    duplicates = subparsers.add_parser('duplicates', help='List identifiers claimed by more than one user')
+    duplicates.add_argument('--kind', choices=[NIN, EMAIL, PHONE, ORCID])
+    lookup = subparsers.add_parser('lookup', help='List the users that have verified an identifier')
+    lookup.add_argument('kind', choices=[NIN, EMAIL, PHONE, ORCID])
+    lookup.add_argument('value')
+    args = parser.parse_args(args)
+
+    index = IdentityIndex(args.index)
+    try:
+        if args.command == 'update':
+            am_conf = connection_conf(update, args)
+            for name in args.plugins or sorted(PLUGIN_INITS):
+                context = PLUGIN_INITS[name](am_conf)
+                print('{}: {} users indexed'.format(name, index.update(context, rebuild=args.rebuild)))
+        elif args.command == 'duplicates':
+            for (kind, value), user_ids in sorted(index.duplicates(args.kind).items()):
+                print('{} {}: {}'.format(kind, value, ' '.join(sorted(str(user_id) for user_id in user_ids))))
+        elif args.command == 'lookup':
+            for user_id in sorted(str(user_id) for user_id in index.lookup(args.kind, args.value)):
+                print(user_id)
+        else:
+            parser.print_help()
+            return 1
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import datetime
+
+import bson
+from celery.utils.log import get_task_logger
+from pymongo import ASCENDING
+
+from eduid_proofing_amp.backends import MongoPrivateDB
+from eduid_proofing_amp.driver import add_connection_arguments, connection_conf
+
+logger = get_task_logger(__name__)
+
+# Indexes every private collection needs: modified_ts for sweeps, exports and the identity
+# index, eduPersonPrincipalName for lookups by eppn. _id is always indexed.
+COMMON_INDEXES = [
+    ('modified_ts', {}),
+    ('eduPersonPrincipalName', {'sparse': True}),
+]
+
+# Indexes of the verified identifiers, created for the plugins that whitelist the attribute
+IDENTIFIER_INDEXES = {
+    'nins': ('nins.number', {'sparse': True}),
+    'mailAliases': ('mailAliases.email', {'sparse': True}),
+    'phone': ('phone.number', {'sparse': True}),
+    'orcid': ('orcid.id', {'sparse': True}),
+}
+
+
+def required_indexes(context):
+    """
+    :param context: Plugin context
+    :return: The (key, options) of the single key indexes the private collection of the plugin needs
+    :rtype: list
+    """
+    indexes = list(COMMON_INDEXES)
+    attrs = set(attr.split('.')[0] for attr in context.WHITELIST_SET_ATTRS + context.WHITELIST_UNSET_ATTRS)
+    indexes.extend(IDENTIFIER_INDEXES[attr] for attr in sorted(attrs) if attr in IDENTIFIER_INDEXES)
+    return indexes
+
+
+def private_collection(context):
+    """
+    :return: The pymongo collection of a context with a MongoPrivateDB, else None
+    """
+    if isinstance(context.private_db, MongoPrivateDB):
+        return context.private_db.userdb._coll
+    return None
+
+
+def ensure_indexes(context):
+    """
+    Create the required indexes missing from the private collection of a plugin context.
+    Indexes are built in the background, so this does not block the collection.
+
+    :param context: Plugin context
+    :return: Keys of the indexes created
+    :rtype: list
+    """
+    coll = private_collection(context)
+    if coll is None:
+        return []
+    # A compound index serves queries on its first key too
+    existing = set(index['key'][0][0] for index in coll.index_information().values())
+    created = []
+    for key, options in required_indexes(context):
+        if key in existing:
+            continue
+        coll.create_index([(key, ASCENDING)], background=True, **options)
+        logger.info('Created index on {} of {}'.format(key, context.PLUGIN_NAME))
+        created.append(key)
+    return created
+
+
+def fetch_queries(user_id=None):
+    """
+    :param user_id: Id of an existing user, to explain realistic plans
+    :return: The (name, filter, sort) of the queries the fetch and sweep paths run
+    :rtype: list
+    """
+    if user_id is None:
+        user_id = bson.ObjectId()
+    return [
+        ('get_user_by_id', {'_id': user_id}, None),
+        ('get_users_by_ids', {'_id': {'$in': [user_id]}}, None),
+        ('iter_documents_since', {'modified_ts': {'$gte': datetime.datetime.utcnow()}}, [('modified_ts', ASCENDING)]),
+        ('iter_documents_since(all)', {}, [('modified_ts', ASCENDING)]),
+    ]
+
+
+def plan_stages(plan):
+    """
+    :param plan: winningPlan of an explain result
+    :return: All stages in the plan, outermost first
+    :rtype: list
+    """
+    plan = plan.get('queryPlan', plan)  # Slot based execution engine
+    stages = [plan['stage']]
+    for child in plan.get('inputStages', []) + ([plan['inputStage']] if 'inputStage' in plan else []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def explain_queries(context):
+    """
+    Explain the fetch queries against the private collection of a plugin context.
+
+    :param context: Plugin context
+    :return: (name, stages, collscan) per query, where collscan tells if the plan scans the collection
+    :rtype: list
+    """
+    coll = private_collection(context)
+    if coll is None:
+        return []
+    sample = coll.find_one({}, {'_id': True})
+    result = []
+    for name, spec, sort in fetch_queries(sample['_id'] if sample else None):
+        cursor = coll.find(spec)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        collscan = 'COLLSCAN' in stages
+        if collscan:
+            logger.warning('Query {} of {} scans the whole collection'.format(name, context.PLUGIN_NAME))
+        result.append((name, stages, collscan))
+    return result
+
+
+def ensure_indexes_enabled(am_conf, context):
+    """
+    Whether ENSURE_INDEXES is True, or a list of plugin names including the plugin of context.
+    """
+    enabled = am_conf.get('ENSURE_INDEXES', False)
+    return enabled is True or (isinstance(enabled, (list, tuple, set)) and context.PLUGIN_NAME in enabled)
+
+
+def main(args=None):
+    from eduid_proofing_amp import PLUGIN_INITS
+
+    parser = argparse.ArgumentParser(description='Check the indexes and query plans of the proofing private databases')
+    add_connection_arguments(parser)
+    parser.add_argument('--ensure', action='store_true', help='Create missing indexes first')
+    parser.add_argument('plugins', nargs='*', help='Plugins to check (default: all)')
+    args = parser.parse_args(args)
+    am_conf = connection_conf(parser, args)
+
+    scans = 0
+    for name in args.plugins or sorted(PLUGIN_INITS):
+        context = PLUGIN_INITS[name](am_conf)
+        if args.ensure:
+            for key in ensure_indexes(context):
+                print('{}: created index on {}'.format(name, key))
+        for query, stages, collscan in explain_queries(context):
+            print('{}: {:<26} {}{}'.format(name, query, ' <- '.join(stages), '  COLLSCAN' if collscan else ''))
+            scans += collscan
+    return 1 if scans else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
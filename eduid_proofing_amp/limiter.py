@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import threading
+import time
+from concurrent import futures
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import AutoReconnect, ExecutionTimeout, WTimeoutError
+
+from eduid_proofing_amp import attribute_fetcher
+from eduid_proofing_amp.scheduling import fetch_origin
+
+logger = get_task_logger(__name__)
+
+# Errors taken as a sign that the replica set is overloaded
+CONGESTION_ERRORS = (AutoReconnect, ExecutionTimeout, WTimeoutError)
+
+
+class AIMDLimiter(object):
+    """
+    Concurrency limit adjusted by additive increase, multiplicative decrease.
+
+    Every call finishing within latency_target seconds grows the limit by 1/limit, so about
+    one per limit calls. A slower call, or one failing with one of CONGESTION_ERRORS,
+    multiplies the limit by backoff, at most once per latency_target.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, latency_target=0.1, backoff=0.7):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self.waiting = 0
+        self.decreases = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'queue_depth': self.waiting,
+                'decreases': self.decreases,
+            }
+
+    def acquire(self):
+        with self._condition:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, latency, congested=False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.time()
+            if congested or latency > self.latency_target:
+                if now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+                    logger.debug('Concurrency limit decreased to {:.1f} (latency {:.3f}s, congested {})'.format(
+                        self.limit, latency, congested))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call func within the limit, and adjust the limit from its latency and errors.
+        """
+        self.acquire()
+        start = time.time()
+        congested = False
+        try:
+            return func(*args, **kwargs)
+        except CONGESTION_ERRORS:
+            congested = True
+            raise
+        finally:
+            self.release(time.time() - start, congested)
+
+
+def bulk_fetch(context, user_ids, apply_update=None, limiter=None, threads=16, origin='backfill'):
+    """
+    Run attribute_fetcher for many users in parallel, with the private database reads, and
+    the central writes done by apply_update, limited by an AIMDLimiter.
+
+    :param context: Plugin context
+    :param user_ids: Iterable of unique identifiers
+    :param apply_update: Called as apply_update(user_id, update) to write an update, if given
+    :param limiter: Limiter for reads and writes, default a new AIMDLimiter with max_limit=threads
+    :param threads: Number of worker threads, the upper bound of the concurrency
+    :param origin: Origin of the fetches, see scheduling.fetch_origin
+
+    :return: (user_id, update, exception) tuples in completion order
+    """
+    if limiter is None:
+        limiter = AIMDLimiter(max_limit=threads)
+
+    def _sync(user_id):
+        with fetch_origin(origin):
+            update = limiter.run(attribute_fetcher, context, user_id)
+            if apply_update is not None and update:
+                limiter.run(apply_update, user_id, update)
+            return update
+
+    executor = futures.ThreadPoolExecutor(threads)
+    pending = {}
+    user_ids = iter(user_ids)
+    try:
+        while True:
+            # Keep a bounded number of submitted tasks, so user_ids can be a large stream
+            for user_id in user_ids:
+                pending[executor.submit(_sync, user_id)] = user_id
+                if len(pending) >= threads * 2:
+                    break
+            if not pending:
+                break
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                user_id = pending.pop(future)
+                yield user_id, future.result() if future.exception() is None else None, future.exception()
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+REPORT_GLOB = 'memory-*.json'
+
+
+class PluginMemoryStats(object):
+    """
+    Memory use of attribute_fetcher calls for one plugin.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.peak_calls = 0
+        self.peak_max = 0
+        self.peak_total = 0
+        self.retained_total = 0
+        self.sites = Counter()
+
+    def add(self, peak, retained):
+        """
+        :param peak: Peak allocations of the call, or None if not measured
+        :param retained: Allocations still alive after the call
+        """
+        self.calls += 1
+        if peak is not None:
+            self.peak_calls += 1
+            self.peak_max = max(self.peak_max, peak)
+            self.peak_total += peak
+        self.retained_total += retained
+
+    def to_dict(self, top):
+        return {
+            'calls': self.calls,
+            'peak_calls': self.peak_calls,
+            'peak_max': self.peak_max,
+            'peak_total': self.peak_total,
+            'retained_total': self.retained_total,
+            'sites': self.sites.most_common(top),
+        }
+
+
+class MemoryAccounting(object):
+    """
+    Fetch hook measuring, with tracemalloc, the peak and retained allocations of each
+    attribute_fetcher call, aggregated per plugin.
+
+    Every snapshot_every call for a plugin is also bracketed by tracemalloc snapshots, adding
+    the allocations still alive after the call to that plugin's allocation sites.
+
+    The statistics are written to a memory-<pid>.json file in directory, for the report
+    command, after every write_every calls and at least every write_interval seconds of
+    calls, whether snapshots are taken or not.
+
+    Peaks are process wide, so calls running concurrently in other threads are included. On
+    Python < 3.9 the peak can not be reset between calls, so only the retained allocations
+    are measured.
+    """
+
+    def __init__(self, directory, frames=1, snapshot_every=100, top=20, write_every=100, write_interval=60):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.top = top
+        self.write_every = write_every
+        self.write_interval = write_interval
+        self.plugins = defaultdict(PluginMemoryStats)
+        self._calls = 0
+        self._last_write = None
+        self._lock = threading.Lock()
+        self.measure_peak = hasattr(tracemalloc, 'reset_peak')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def __call__(self, fetch, context, user_id, stats):
+        with self._lock:
+            plugin_stats = self.plugins[context.PLUGIN_NAME]
+            take_snapshot = self.snapshot_every and plugin_stats.calls % self.snapshot_every == 0
+
+        before_snapshot = tracemalloc.take_snapshot() if take_snapshot else None
+        if self.measure_peak:
+            tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            return fetch(context, user_id, stats)
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                plugin_stats.add(max(0, peak - before) if self.measure_peak else None, after - before)
+            if before_snapshot is not None:
+                self._add_sites(plugin_stats, before_snapshot)
+            if self._write_due():
+                self.write_stats()
+
+    def _write_due(self):
+        with self._lock:
+            self._calls += 1
+            if self.write_every and self._calls % self.write_every == 0:
+                return True
+            if self.write_interval is not None and (
+                    self._last_write is None or time.time() - self._last_write >= self.write_interval):
+                return True
+            return False
+
+    def _add_sites(self, plugin_stats, before_snapshot):
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        before_snapshot = before_snapshot.filter_traces(filters)
+        with self._lock:
+            for diff in snapshot.compare_to(before_snapshot, 'lineno')[:self.top]:
+                if diff.size_diff > 0:
+                    frame = diff.traceback[0]
+                    plugin_stats.sites['{}:{}'.format(frame.filename, frame.lineno)] += diff.size_diff
+
+    def write_stats(self):
+        """
+        Write the statistics gathered so far by this process.
+        """
+        with self._lock:
+            self._last_write = time.time()
+            data = {
+                'pid': os.getpid(),
+                'plugins': dict((name, plugin_stats.to_dict(self.top))
+                                for name, plugin_stats in self.plugins.items()),
+            }
+        path = os.path.join(self.directory, 'memory-{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(data, fd)
+        os.rename(path + '.tmp', path)
+
+
+_memory_accounting = None
+
+
+def get_memory_accounting(am_conf):
+    """
+    Return the memory accounting hook shared by all plugin contexts in this process, writing
+    its statistics every MEMORY_ACCOUNTING_WRITE_EVERY calls (default 100), every
+    MEMORY_ACCOUNTING_WRITE_INTERVAL seconds (default 60) and when the process exits normally.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: MemoryAccounting
+    """
+    global _memory_accounting
+    if _memory_accounting is None:
+        _memory_accounting = MemoryAccounting(am_conf['MEMORY_ACCOUNTING_DIR'],
+                                              frames=am_conf.get('MEMORY_ACCOUNTING_FRAMES', 1),
+                                              snapshot_every=am_conf.get('MEMORY_ACCOUNTING_SNAPSHOT_EVERY', 100),
+                                              write_every=am_conf.get('MEMORY_ACCOUNTING_WRITE_EVERY', 100),
+                                              write_interval=am_conf.get('MEMORY_ACCOUNTING_WRITE_INTERVAL', 60))
+        atexit.register(_memory_accounting.write_stats)
+    return _memory_accounting
+
+
+def merge_reports(directory):
+    """
+    :param directory: Directory with memory-<pid>.json files
+    :return: Statistics per plugin, summed over all processes
+    :rtype: dict
+    """
+    plugins = {}
+    for path in glob.glob(os.path.join(directory, REPORT_GLOB)):
+        with open(path) as fd:
+            data = json.load(fd)
+        for name, stats in data['plugins'].items():
+            merged = plugins.setdefault(name, {'calls': 0, 'peak_calls': 0, 'peak_max': 0, 'peak_total': 0,
+                                               'retained_total': 0, 'sites': Counter()})
+            merged['calls'] += stats['calls']
+            merged['peak_calls'] += stats['peak_calls']
+            merged['peak_max'] = max(merged['peak_max'], stats['peak_max'])
+            merged['peak_total'] += stats['peak_total']
+            merged['retained_total'] += stats['retained_total']
+            merged['sites'].update(dict(stats['sites']))
+    return plugins
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Report attribute_fetcher memory use per plugin')
+    parser.add_argument('directory', help='MEMORY_ACCOUNTING_DIR of the workers')
+    parser.add_argument('--top', type=int, default=10, help='Number of allocation sites to show per plugin')
+    args = parser.parse_args(args)
+
+    plugins = merge_reports(args.directory)
+    if not plugins:
+        print('No memory statistics found in {}'.format(args.directory))
+        return 1
+    for name in sorted(plugins):
+        stats = plugins[name]
+        calls = max(stats['calls'], 1)
+        if stats['peak_calls']:
+            peak = 'peak max {} B, peak mean {} B'.format(stats['peak_max'],
+                                                          stats['peak_total'] // stats['peak_calls'])
+        else:
+            peak = 'peak not measured'
+        print('{}: {} calls, {}, retained mean {} B'.format(name, stats['calls'], peak,
+                                                           stats['retained_total'] // calls))
+        for site, size in stats['sites'].most_common(args.top):
+            print('    {:>12} B  {}'.format(size, site))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
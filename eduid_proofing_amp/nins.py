@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+# Plugins whose private databases hold verified NINs
+NIN_PLUGINS = ('eduid_letter_proofing', 'eduid_oidc_proofing', 'eduid_lookup_mobile_proofing', 'eduid_eidas')
+
+NIN_PROJECTION = {'nins': True}
+
+
+def extract_verified_nins(docs):
+    """
+    :param docs: Iterable of user documents, only _id and nins are used
+    :return: Verified NINs per user id, and the user ids per verified NIN
+    :rtype: tuple
+
+    Compile the verified NINs of many users in one pass. Like filter_nin, a NIN only counts
+    as verified if `verified' is the boolean True.
+    """
+    nins_by_user = {}
+    users_by_nin = defaultdict(set)
+    for doc in docs:
+        items = doc.get('nins')
+        if not items:
+            continue
+        numbers = [item.get('number') for item in items if item.get('verified') is True]
+        if not numbers:
+            continue
+        user_id = doc['_id']
+        nins_by_user[user_id] = numbers
+        for number in numbers:
+            users_by_nin[number].add(user_id)
+    return nins_by_user, users_by_nin
+
+
+def duplicate_nins(users_by_nin):
+    """
+    :param users_by_nin: User ids per verified NIN, from extract_verified_nins
+    :return: The NINs verified by more than one user, with their user ids
+    :rtype: dict
+    """
+    return dict((nin, user_ids) for nin, user_ids in users_by_nin.items() if len(user_ids) > 1)
+
+
+def scan_verified_nins(contexts, batch_size=1000):
+    """
+    Read the NINs of all users in the private databases of some plugin contexts, e.g. those of
+    NIN_PLUGINS. The same user has the same user id in all private databases.
+
+    :param contexts: Plugin contexts
+    :param batch_size: Number of documents to read at a time
+
+    :return: Verified NINs per user id, and the user ids per verified NIN, over all contexts
+    :rtype: tuple
+    """
+    nins_by_user = {}
+    users_by_nin = defaultdict(set)
+    for context in contexts:
+        docs = context.private_db.iter_documents_since(None, batch_size=batch_size, projection=NIN_PROJECTION)
+        context_nins, context_users = extract_verified_nins(docs)
+        for user_id, numbers in context_nins.items():
+            nins_by_user.setdefault(user_id, [])
+            nins_by_user[user_id].extend(number for number in numbers if number not in nins_by_user[user_id])
+        for number, user_ids in context_users.items():
+            users_by_nin[number].update(user_ids)
+    return nins_by_user, users_by_nin
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Plugins that may write an attribute to the central database, highest priority first.
+# When two plugins produce a value for the same attribute from private data with the same
+# modification time, the plugin listed first wins. Plugins not listed for an attribute
+# rank below all listed ones.
+ATTRIBUTE_OWNERS = {
+    'givenName': ('eduid_eidas', 'eduid_letter_proofing', 'eduid_oidc_proofing',
+                  'eduid_lookup_mobile_proofing', 'eduid_personal_data'),
+    'surname': ('eduid_eidas', 'eduid_letter_proofing', 'eduid_oidc_proofing',
+                'eduid_lookup_mobile_proofing', 'eduid_personal_data'),
+    'displayName': ('eduid_eidas', 'eduid_letter_proofing', 'eduid_oidc_proofing',
+                    'eduid_lookup_mobile_proofing', 'eduid_personal_data'),
+    'nins': ('eduid_security',  # AL1 downgrade on password reset wins over proofing
+             'eduid_eidas', 'eduid_letter_proofing', 'eduid_oidc_proofing', 'eduid_lookup_mobile_proofing'),
+    'norEduPersonNIN': ('eduid_security', 'eduid_letter_proofing', 'eduid_oidc_proofing',
+                        'eduid_lookup_mobile_proofing'),
+    'phone': ('eduid_security', 'eduid_phone'),
+    'passwords': ('eduid_security', 'eduid_eidas'),
+}
+
+DEFAULT_LEDGER_SIZE = 100000
+
+
+def attribute_priority(plugin_name, attr):
+    """
+    :param plugin_name: Entry point name of the plugin, e.g. 'eduid_security'
+    :param attr: Whitelisted attribute, possibly a dotted path
+    :return: Priority, lower is more important
+    :rtype: int
+    """
+    owners = ATTRIBUTE_OWNERS.get(attr.split('.')[0], ())
+    try:
+        return owners.index(plugin_name)
+    except ValueError:
+        return len(owners)
+
+
+class WriteLedger(object):
+    """
+    Experimental, off by default (see ATTRIBUTE_OWNERSHIP). Remembers, per user and attribute,
+    the version (private data modified_ts) and the priority of the plugin behind the last
+    update handed to the Attribute Manager by any plugin in this process.
+
+    Updates from older private data, or from a lower priority plugin at the same version,
+    than the last update are dropped. An update repeating the last one is never dropped:
+    the ledger does not know whether the Attribute Manager managed to write it, and a retry
+    of a failed write produces the same update.
+
+    The ledger only knows about updates produced in this process, not what the central
+    database holds or what other Attribute Manager plugins wrote, and the versions it compares
+    are modified_ts values of different private databases. Under a prefork worker every
+    process has a ledger of its own, so which updates are dropped depends on which process
+    happens to handle which sync; routing syncs per user (see routing.UserRouter) does not
+    change that, as a worker spreads the tasks of a queue over all its processes. It is only
+    meaningful with a single Attribute Manager worker process.
+    """
+
+    def __init__(self, max_entries=DEFAULT_LEDGER_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_superseded(self, key, version, priority):
+        previous = self._entries.get(key)
+        if previous is None:
+            return False
+        prev_version, prev_priority = previous
+        if version is None or prev_version is None:
+            return False
+        if prev_version > version:
+            return True
+        return prev_version == version and prev_priority < priority
+
+    def _record(self, key, version, priority):
+        self._entries.pop(key, None)
+        self._entries[key] = (version, priority)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def filter_update(self, plugin_name, user_id, version, attributes_set, attributes_unset):
+        """
+        Drop superseded attributes from an update and record the remaining ones as handed
+        to the Attribute Manager.
+
+        :param plugin_name: Entry point name of the plugin producing the update
+        :param user_id: Unique identifier
+        :param version: modified_ts of the private user, or None if unknown
+        :param attributes_set: Attributes to $set
+        :param attributes_unset: Attributes to $unset
+
+        :type attributes_set: dict
+        :type attributes_unset: dict
+
+        :return: Filtered attributes_set and attributes_unset
+        :rtype: tuple
+        """
+        result_set = {}
+        result_unset = {}
+        with self._lock:
+            for attributes, result in ((attributes_set, result_set), (attributes_unset, result_unset)):
+                for attr, value in attributes.items():
+                    key = (user_id, attr)
+                    priority = attribute_priority(plugin_name, attr)
+                    if self._is_superseded(key, version, priority):
+                        logger.debug('Skipping superseded write of {} for user {} from {}'.format(
+                            attr, user_id, plugin_name))
+                        continue
+                    self._record(key, version, priority)
+                    result[attr] = value
+        return result_set, result_unset
+
+
+_write_ledger = None
+
+
+def get_write_ledger(am_conf):
+    """
+    Return the write ledger shared by all plugin contexts in this process. Experimental, see
+    WriteLedger for its limitations.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: WriteLedger
+    """
+    global _write_ledger
+    if _write_ledger is None:
+        logger.warning('ATTRIBUTE_OWNERSHIP is experimental: the write ledger only sees the updates of this process')
+        _write_ledger = WriteLedger(am_conf.get('ATTRIBUTE_OWNERSHIP_LEDGER_SIZE', DEFAULT_LEDGER_SIZE))
+    return _write_ledger
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import cProfile
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import bson
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+PROFILE_SUFFIXES = ('.prof', '.stacks', '.json')
+
+
+def document_size(stats):
+    """
+    :param stats: Per call statistics filled in by attribute_fetcher
+    :type stats: dict
+
+    :return: BSON size of the fetched private user document, or None if no user was read
+    :rtype: int | None
+    """
+    user_dict = stats.get('user')
+    if user_dict is None:
+        return None
+    return len(bson.BSON.encode(user_dict))
+
+
+class StackSampler(object):
+    """
+    Sample the stack of one thread at a fixed interval from a background thread, counting
+    collapsed stacks (root first, separated by ';') as used by flame graph tools.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='amp-stack-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, and wait for the sampling thread to finish, so that samples can be read.
+        Must not be called before a start() in progress returns.
+        """
+        self._stop.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            del frame
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            self._stop.wait(self.interval)
+
+
+class FetchProfiler(object):
+    """
+    Fetch hook that profiles selected attribute_fetcher calls and writes the profiles,
+    together with plugin name and document size, to a local directory holding at most
+    max_files profiles.
+
+    Every `every' call is run under cProfile. When slow_threshold (seconds) is set, any other
+    call still running after that time gets its stack sampled until it returns, and the samples
+    are written if the call ended up slower than the threshold.
+    """
+
+    def __init__(self, directory, every=0, slow_threshold=None, max_files=100, sample_interval=0.005):
+        self.directory = directory
+        self.every = every
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        self.sample_interval = sample_interval
+        self._calls = itertools.count(1)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self, fetch, context, user_id, stats):
+        call_number = next(self._calls)
+        if self.every and call_number % self.every == 0:
+            return self._run_cprofile(call_number, fetch, context, user_id, stats)
+        if self.slow_threshold is not None:
+            return self._run_sampled(call_number, fetch, context, user_id, stats)
+        return fetch(context, user_id, stats)
+
+    def _run_cprofile(self, call_number, fetch, context, user_id, stats):
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(fetch, context, user_id, stats)
+        finally:
+            duration = time.time() - start
+            path = self._write_metadata(call_number, context, user_id, stats, duration, 'cprofile')
+            profile.dump_stats(path + '.prof')
+            self._rotate()
+
+    def _run_sampled(self, call_number, fetch, context, user_id, stats):
+        sampler = StackSampler(threading.current_thread().ident, self.sample_interval)
+        timer = threading.Timer(self.slow_threshold, sampler.start)
+        timer.daemon = True
+        start = time.time()
+        timer.start()
+        try:
+            return fetch(context, user_id, stats)
+        finally:
+            timer.cancel()
+            # Either the sampler was started, or it never will be
+            timer.join()
+            sampler.stop()
+            duration = time.time() - start
+            if duration >= self.slow_threshold:
+                path = self._write_metadata(call_number, context, user_id, stats, duration, 'stack-samples')
+                with open(path + '.stacks', 'w') as fd:
+                    for stack, count in sampler.samples.most_common():
+                        fd.write('{} {}\n'.format(stack, count))
+                self._rotate()
+
+    def _write_metadata(self, call_number, context, user_id, stats, duration, kind):
+        name = '{}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(), call_number, context.PLUGIN_NAME)
+        path = os.path.join(self.directory, name)
+        metadata = {
+            'plugin': context.PLUGIN_NAME,
+            'user_id': str(user_id),
+            'duration': duration,
+            'document_size': document_size(stats),
+            'kind': kind,
+        }
+        with open(path + '.json', 'w') as fd:
+            json.dump(metadata, fd, indent=2, sort_keys=True)
+        logger.info('Wrote {} profile of attribute_fetcher for {} ({:.3f}s) to {}'.format(
+            kind, context.PLUGIN_NAME, duration, path))
+        return path
+
+    def _rotate(self):
+        profiles = {}
+        for filename in os.listdir(self.directory):
+            base, ext = os.path.splitext(filename)
+            if ext in PROFILE_SUFFIXES:
+                path = os.path.join(self.directory, filename)
+                profiles[base] = max(profiles.get(base, 0), os.path.getmtime(path))
+        for base in sorted(profiles, key=profiles.get)[:max(0, len(profiles) - self.max_files)]:
+            for ext in PROFILE_SUFFIXES:
+                try:
+                    os.remove(os.path.join(self.directory, base + ext))
+                except OSError:
+                    pass
+
+
+_fetch_profiler = None
+
+
+def get_fetch_profiler(am_conf):
+    """
+    Return the fetch profiler shared by all plugin contexts in this process.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: FetchProfiler
+    """
+    global _fetch_profiler
+    if _fetch_profiler is None:
+        _fetch_profiler = FetchProfiler(am_conf['PROFILE_DIR'],
+                                        every=am_conf.get('PROFILE_EVERY', 0),
+                                        slow_threshold=am_conf.get('PROFILE_SLOW_THRESHOLD'),
+                                        max_files=am_conf.get('PROFILE_MAX_FILES', 100),
+                                        sample_interval=am_conf.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+    return _fetch_profiler
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import datetime
+import time
+from concurrent import futures
+
+import bson
+from celery.utils.log import get_task_logger
+from pymongo import ASCENDING
+from pymongo.errors import ConnectionFailure, InvalidOperation
+
+from eduid_proofing_amp.driver import add_connection_arguments, connection_conf
+from eduid_proofing_amp.indexes import private_collection
+
+logger = get_task_logger(__name__)
+
+
+def _ping(coll):
+    start = time.time()
+    coll.database.command('ping')
+    return time.time() - start
+
+
+def warm_up(context, connections=1):
+    """
+    Prepare a plugin context for its first fetch: open `connections' pooled connections to the
+    private database, run the indexed fetch and sweep queries once so the server has their plans
+    cached, and build the fast validator of the whitelist plan in use.
+
+    :param context: Plugin context
+    :param connections: Number of connections to open concurrently
+
+    :raise pymongo.errors.ConnectionFailure: The private database is not reachable
+    :return: Seconds spent
+    :rtype: float
+    """
+    start = time.time()
+    if context.whitelist_plan is not None and context.whitelist_plan.validator is not None:
+        context.whitelist_plan.validator.validate({'_id': bson.ObjectId()})
+    elif context.validator is not None:
+        context.validator.validate({'_id': bson.ObjectId()})
+    coll = private_collection(context)
+    if coll is not None:
+        with futures.ThreadPoolExecutor(max(1, connections)) as executor:
+            list(executor.map(lambda _: _ping(coll), range(max(1, connections))))
+        coll.find_one({'_id': bson.ObjectId()})
+        list(coll.find({'modified_ts': {'$gte': datetime.datetime.utcnow()}}).sort('modified_ts', ASCENDING).limit(1))
+    elapsed = time.time() - start
+    logger.info('Warmed up {} in {:.3f}s'.format(context.PLUGIN_NAME, elapsed))
+    return elapsed
+
+
+def self_test(context, samples=5):
+    """
+    Measure how long it takes to reach the private database of a plugin context.
+
+    :param context: Plugin context
+    :param samples: Number of round trips to time
+
+    :return: 'reachable', 'server_selection' and 'round_trip' seconds (median) and
+             'round_trip_max', and 'error' if not reachable. Latencies are None for a
+             context without a MongoDB private database.
+    :rtype: dict
+    """
+    result = {'plugin': context.PLUGIN_NAME, 'reachable': True, 'server_selection': None, 'round_trip': None,
+              'round_trip_max': None, 'error': None}
+    coll = private_collection(context)
+    if coll is None:
+        return result
+    try:
+        start = time.time()
+        try:
+            # Blocks until a server is selected
+            coll.database.client.address
+        except InvalidOperation:
+            # Several mongos, selection happens per operation
+            pass
+        result['server_selection'] = time.time() - start
+        round_trips = sorted(_ping(coll) for _ in range(max(1, samples)))
+    except ConnectionFailure as e:
+        result.update(reachable=False, error=repr(e))
+        if context.health is not None:
+            context.health.record_failure(e)
+        return result
+    if context.health is not None:
+        context.health.record_success()
+    result['round_trip'] = round_trips[len(round_trips) // 2]
+    result['round_trip_max'] = round_trips[-1]
+    return result
+
+
+def main(args=None):
+    from eduid_proofing_amp import PLUGIN_INITS
+
+    parser = argparse.ArgumentParser(description='Warm up and time the proofing private databases')
+    add_connection_arguments(parser)
+    parser.add_argument('--samples', type=int, default=5, help='Round trips to time per plugin')
+    parser.add_argument('plugins', nargs='*', help='Plugins to test (default: all)')
+    args = parser.parse_args(args)
+    am_conf = connection_conf(parser, args)
+
+    unreachable = 0
+    for name in args.plugins or sorted(PLUGIN_INITS):
+        context = PLUGIN_INITS[name](am_conf)
+        try:
+            warm_up_time = context.warm_up()
+        except ConnectionFailure as e:
+            print('{:<30} unreachable: {!r}'.format(name, e))
+            unreachable += 1
+            continue
+        result = context.self_test(samples=args.samples)
+        if not result['reachable']:
+            print('{:<30} unreachable: {}'.format(name, result['error']))
+            unreachable += 1
+            continue
+        print('{:<30} warm-up {:>8.1f} ms  selection {:>8.1f} ms  round trip {:>8.1f} ms (max {:.1f} ms)'.format(
+            name, warm_up_time * 1e3, result['server_selection'] * 1e3, result['round_trip'] * 1e3,
+            result['round_trip_max'] * 1e3))
+    return 1 if unreachable else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import threading
+
+from celery.utils.log import get_task_logger
+
+from eduid_proofing_amp.whitelists import WhitelistPlan, read_whitelist_config
+
+logger = get_task_logger(__name__)
+
+
+def whitelisted_attributes(context):
+    """
+    :param context: Plugin context
+    :return: The attributes the plugin may set or unset in the central database, possibly dotted
+    :rtype: frozenset
+    """
+    plan = context.whitelist_plan
+    if plan is not None:
+        return frozenset(plan.set_attrs) | plan.unset_attrs
+    return frozenset(context.WHITELIST_SET_ATTRS) | frozenset(context.WHITELIST_UNSET_ATTRS)
+
+
+def plugin_whitelists(whitelist_config=None):
+    """
+    The whitelists of all plugins, for the proofing applications to decide which of their
+    writes need a sync: the built-in ones published by the context classes, replaced by those
+    in whitelist_config, the WHITELIST_CONFIG the Attribute Manager reloads (see whitelists.py),
+    if given.
+
+    :param whitelist_config: Whitelist configuration file, see whitelists.read_whitelist_config
+
+    :raise IOError: whitelist_config can not be read
+    :raise ValueError: whitelist_config is not valid
+    :return: {plugin name: {'set': [...], 'unset': [...]}}
+    :rtype: dict
+    """
+    from eduid_proofing_amp import PLUGIN_CONTEXTS
+
+    result = {}
+    for name, context_class in PLUGIN_CONTEXTS.items():
+        result[name] = {
+            'set': list(context_class.WHITELIST_SET_ATTRS),
+            'unset': list(context_class.WHITELIST_UNSET_ATTRS),
+        }
+    if whitelist_config is not None:
+        version, whitelists = read_whitelist_config(whitelist_config)
+        for name, (set_attrs, unset_attrs) in whitelists.items():
+            if name in result:
+                # Rejected by the Attribute Manager as well if not valid
+                plan = WhitelistPlan(name, version, set_attrs, unset_attrs)
+                result[name] = {'set': list(plan.set_attrs), 'unset': sorted(plan.unset_attrs)}
+    return result
+
+
+def _overlaps(path, attr):
+    return path == attr or path.startswith(attr + '.') or attr.startswith(path + '.')
+
+
+class ChangeFilter(object):
+    """
+    Decides from the field names changed by a write to a private database whether the write
+    can change what attribute_fetcher returns for the user, i.e. whether the central database
+    needs a sync. A changed field is relevant if it is, is within, or contains a whitelisted
+    attribute: 'nins.0.verified' for 'nins', and 'orcid' for 'orcid.id'.
+
+    Whether the private document is valid is not considered; a write making it invalid only
+    makes the next relevant sync fail.
+    """
+
+    def __init__(self, attributes):
+        self.attributes = frozenset(attributes)
+        self._top_level = frozenset(attr.split('.')[0] for attr in self.attributes)
+
+    @classmethod
+    def for_context(cls, context):
+        return cls(whitelisted_attributes(context))
+
+    def is_relevant(self, field):
+        if field.split('.')[0] not in self._top_level:
+            return False
+        return any(_overlaps(field, attr) for attr in self.attributes)
+
+    def __call__(self, changed_fields):
+        """
+        :param changed_fields: Dotted names of the changed fields, or None if not known, e.g. for
+                               an insert or a replacement of the whole document
+
+        :return: Whether a sync is needed
+        :rtype: bool
+        """
+        if changed_fields is None:
+            return True
+        return any(self.is_relevant(field) for field in changed_fields)
+
+
+def update_fields(update):
+    """
+    :param update: A MongoDB update document, like {'$set': {'nins.0.verified': True}}
+    :return: The fields it changes, or None for a replacement document
+    :rtype: set | None
+    """
+    if not update or not all(key.startswith('$') for key in update):
+        return None
+    fields = set()
+    for operator, arguments in update.items():
+        if operator == '$rename':
+            fields.update(arguments.keys())
+            fields.update(arguments.values())
+        else:
+            fields.update(arguments.keys())
+    return fields
+
+
+def change_event_fields(event):
+    """
+    :param event: A change stream event of a private collection
+    :return: The fields changed by an update event, None for other events
+    :rtype: set | None
+    """
+    if event.get('operationType') != 'update':
+        return None
+    description = event['updateDescription']
+    fields = set(description.get('updatedFields', {}))
+    fields.update(description.get('removedFields', []))
+    fields.update(item['field'] for item in description.get('truncatedArrays', []))
+    return fields
+
+
+# (plugin name, whitelist configuration) -> (configuration file stamp, ChangeFilter)
+_change_filters = {}
+_change_filters_lock = threading.Lock()
+
+
+def _config_stamp(path):
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def sync_needed(plugin_name, changed_fields, whitelist_config=None):
+    """
+    Whether a write to the private database of a plugin, changing changed_fields, needs a sync,
+    according to the whitelists of the plugin, see plugin_whitelists. The filter is built again
+    when whitelist_config changes. A sync is needed whenever whitelist_config can not be read.
+
+    :param plugin_name: Entry point name of the plugin
+    :param changed_fields: Dotted names of the changed fields, or None if not known
+    :param whitelist_config: WHITELIST_CONFIG of the Attribute Manager, if it uses one
+
+    :rtype: bool
+    """
+    key = (plugin_name, whitelist_config)
+    with _change_filters_lock:
+        try:
+            stamp = _config_stamp(whitelist_config)
+            cached = _change_filters.get(key)
+            if cached is None or cached[0] != stamp:
+                whitelist = plugin_whitelists(whitelist_config)[plugin_name]
+                cached = _change_filters[key] = (stamp, ChangeFilter(whitelist['set'] + whitelist['unset']))
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Can not read whitelists from {}, assuming a sync is needed: {}'.format(whitelist_config, e))
+            _change_filters.pop(key, None)
+            return True
+    return cached[1](changed_fields)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Print the whitelisted attributes of the proofing plugins as JSON')
+    parser.add_argument('--whitelist-config', help='WHITELIST_CONFIG of the Attribute Manager, if any')
+    parser.add_argument('plugins', nargs='*', help='Plugins to print (default: all)')
+    args = parser.parse_args(args)
+
+    whitelists = plugin_whitelists(args.whitelist_config)
+    if args.plugins:
+        whitelists = dict((name, whitelists[name]) for name in args.plugins)
+    print(json.dumps(whitelists, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
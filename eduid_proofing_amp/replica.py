@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import bson
+from celery.utils.log import get_task_logger
+
+from eduid_proofing_amp.driver import add_connection_arguments, connection_conf
+
+logger = get_task_logger(__name__)
+
+# Fetch origins (see scheduling.fetch_origin) the replica serves by default
+REPLICA_ORIGINS = ('resync', 'backfill', 'audit')
+
+# Seconds after a sweep that a replica is used when not swept by the workers themselves
+DEFAULT_MAX_AGE = 3600
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB NOT NULL)',
+]
+
+
+def whitelisted_dict(user_dict, paths):
+    """
+    :param user_dict: User data
+    :param paths: Whitelisted attributes, possibly dotted paths
+
+    :type user_dict: dict
+    :type paths: list
+
+    :return: A copy of user_dict with only the whitelisted attributes, and modified_ts
+    :rtype: dict
+    """
+    result = {}
+    for path in list(paths) + ['modified_ts']:
+        keys = path.split('.')
+        value = user_dict
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        target = result
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return result
+
+
+def whitelist_fingerprint(paths):
+    """
+    :return: Identifies the whitelisted attributes of replicated users
+    :rtype: str
+    """
+    return json.dumps(sorted(paths))
+
+
+class LocalReplica(object):
+    """
+    Local SQLite copy of the whitelisted attributes of a plugin's private users.
+
+    The copy is brought up to date by sweep(), which reads all users modified since the
+    previous sweep. Users are validated by constructing the private database's user class
+    before they are stored, just like attribute_fetcher does.
+
+    The replica does not see deleted users, and is only as fresh as the last sweep: it is
+    only used for fetches with one of the `origins', like resync and audit jobs, never for
+    the syncs triggered by the proofing applications right after their writes, and not at
+    all more than max_age seconds after the last sweep. attribute_fetcher reads the private
+    database instead whenever a replicated user lacks an attribute it would otherwise unset.
+
+    The database file is shared by the worker processes. It records the fingerprint of the
+    whitelist its users were filtered with, and is only used by, and only swept into by,
+    processes with the same whitelist; use_whitelist() empties it for a different one.
+    """
+
+    def __init__(self, context, path, max_age=DEFAULT_MAX_AGE, mmap_size=256 * 1024 * 1024, origins=REPLICA_ORIGINS):
+        """
+        :param context: Plugin context to replicate
+        :param path: SQLite database file
+        :param max_age: Seconds after a sweep that the replica is used by get()
+        :param mmap_size: Bytes of the database file to memory map
+        :param origins: Fetch origins the replica is used for, see serves()
+        """
+        self.context = context
+        self.path = path
+        self.max_age = max_age
+        self.origins = frozenset(origins)
+        self.hits = 0
+        self.misses = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def invalidate(self, fingerprint=None):
+        """
+        Drop all replicated users. The replica is not used until the next complete sweep, and
+        sweeps in progress are abandoned.
+
+        :param fingerprint: Whitelist fingerprint to record for the next sweep
+        """
+        with self._lock:
+            self._invalidate(fingerprint)
+            self._conn.commit()
+
+    def _invalidate(self, fingerprint):
+        self._generation += 1
+        self._conn.execute('DELETE FROM users')
+        self._conn.execute('DELETE FROM meta')
+        if fingerprint is not None:
+            self._set_meta('whitelist', fingerprint)
+
+    def use_whitelist(self, paths):
+        """
+        Empty the replica unless its users were filtered with the whitelist `paths'.
+
+        :return: Whether the replica was emptied
+        :rtype: bool
+        """
+        fingerprint = whitelist_fingerprint(paths)
+        with self._lock:
+            # Checked and changed in one transaction, the file is shared between processes
+            self._conn.execute('BEGIN IMMEDIATE')
+            changed = self._get_meta('whitelist') != fingerprint
+            if changed:
+                logger.info('Emptying replica {} for whitelist {}'.format(self.path, fingerprint))
+                self._invalidate(fingerprint)
+            self._conn.commit()
+        return changed
+
+    def _get_meta(self, key):
+        row = self._conn.execute('SELECT data FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return bson.BSON(row[0]).decode()['value']
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, data) VALUES (?, ?)',
+                           (key, bson.BSON.encode({'value': value})))
+
+    @property
+    def last_sweep(self):
+        """
+        :return: time.time() of the last completed sweep, or None
+        """
+        with self._lock:
+            return self._get_meta('last_sweep')
+
+    def is_fresh(self):
+        """
+        :return: Whether the replica was swept within max_age, with the whitelist of the context
+        :rtype: bool
+        """
+        fingerprint = whitelist_fingerprint(self.context.WHITELIST_SET_ATTRS)
+        with self._lock:
+            last_sweep = self._get_meta('last_sweep')
+            if last_sweep is None or self._get_meta('whitelist') != fingerprint:
+                return False
+        return time.time() - last_sweep <= self.max_age
+
+    def serves(self, origin):
+        """
+        :param origin: Origin of a fetch, see scheduling.fetch_origin
+        :return: Whether attribute_fetcher may read users with that origin from the replica
+        :rtype: bool
+        """
+        return origin is not None and origin in self.origins
+
+    def get(self, user_id):
+        """
+        :param user_id: Unique identifier
+        :return: Whitelisted user data, or None if the user is not in a fresh replica
+        :rtype: dict | None
+        """
+        if not self.is_fresh():
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM users WHERE user_id = ?', (str(user_id),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bson.BSON(row[0]).decode()
+
+    def sweep(self, batch_size=1000):
+        """
+        Copy users modified since the last sweep from the private database.
+
+        :return: Number of users copied
+        :rtype: int
+        """
+        private_db = self.context.private_db
+        paths = list(self.context.WHITELIST_SET_ATTRS)
+        fingerprint = whitelist_fingerprint(paths)
+        with self._lock:
+            since = self._get_meta('modified_ts')
+            generation = self._generation
+        started = time.time()
+        count = 0
+        rows = []
+        invalid = []
+        # Users saved in the same tick as the last one seen are read again
+        for doc in private_db.iter_documents_since(since, batch_size=batch_size):
+            since = doc.get('modified_ts', since)
+            try:
+                user_dict = private_db.UserClass(data=doc).to_dict(old_userdb_format=False)
+            except Exception as e:
+                # Leave it to attribute_fetcher to read, and reject, the user from private_db
+                logger.warning('Not replicating invalid user {}: {}'.format(doc['_id'], e))
+                invalid.append((str(doc['_id']),))
+                continue
+            rows.append((str(doc['_id']),
+                         bson.BSON.encode(whitelisted_dict(user_dict, paths))))
+            count += 1
+            if len(rows) >= batch_size:
+                if not self._store(generation, fingerprint, rows, invalid, since):
+                    return count
+                rows = []
+                invalid = []
+        if not self._store(generation, fingerprint, rows, invalid, since, last_sweep=started):
+            return count
+        logger.info('Swept {} users from {} into {}'.format(count, private_db, self.path))
+        return count
+
+    def _store(self, generation, fingerprint, rows, invalid, since, last_sweep=None):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            stored = self._get_meta('whitelist')
+            if generation != self._generation or stored not in (None, fingerprint):
+                self._conn.rollback()
+                logger.info('Replica {} invalidated during sweep'.format(self.path))
+                return False
+            if stored is None:
+                self._set_meta('whitelist', fingerprint)
+            self._conn.executemany('INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)', rows)
+            self._conn.executemany('DELETE FROM users WHERE user_id = ?', invalid)
+            if since is not None:
+                self._set_meta('modified_ts', since)
+            if last_sweep is not None:
+                self._set_meta('last_sweep', last_sweep)
+            self._conn.commit()
+        return True
+
+    def start_sweeping(self, interval):
+        """
+        Sweep every `interval' seconds in a daemon thread.
+        """
+        def _run():
+            while True:
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception('Sweep of {} failed'.format(self.path))
+                time.sleep(interval)
+        thread = threading.Thread(target=_run, name='amp-replica-sweep')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def get_local_replica(am_conf, context):
+    """
+    Return a LocalReplica for a plugin context if REPLICA_DIR is set and the plugin is listed
+    in REPLICA_PLUGINS (all plugins if not set). The replica is used for fetches with an
+    origin in REPLICA_ORIGINS (default 'resync', 'backfill' and 'audit'), for REPLICA_MAX_AGE
+    seconds after a sweep: by default twice REPLICA_SWEEP_INTERVAL, or DEFAULT_MAX_AGE if the
+    workers do not sweep themselves.
+
+    :param am_conf: Attribute Manager configuration data.
+    :param context: Plugin context
+
+    :type am_conf: dict
+
+    :rtype: LocalReplica | None
+    """
+    directory = am_conf.get('REPLICA_DIR')
+    plugins = am_conf.get('REPLICA_PLUGINS')
+    if not directory or (plugins is not None and context.PLUGIN_NAME not in plugins):
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    interval = am_conf.get('REPLICA_SWEEP_INTERVAL')
+    max_age = am_conf.get('REPLICA_MAX_AGE') or (2 * interval if interval else DEFAULT_MAX_AGE)
+    replica = LocalReplica(context, os.path.join(directory, '{}.sqlite'.format(context.PLUGIN_NAME)),
+                           max_age=max_age,
+                           origins=am_conf.get('REPLICA_ORIGINS', REPLICA_ORIGINS))
+    if interval:
+        replica.start_sweeping(interval)
+    return replica
+
+
+def main(args=None):
+    from eduid_proofing_amp import PLUGIN_INITS
+
+    parser = argparse.ArgumentParser(description='Update local replicas of proofing private databases')
+    add_connection_arguments(parser)
+    parser.add_argument('--directory', required=True, help='REPLICA_DIR of the workers')
+    parser.add_argument('plugins', nargs='*', help='Plugins to sweep (default: all)')
+    args = parser.parse_args(args)
+    am_conf = connection_conf(parser, args)
+
+    for name in args.plugins or sorted(PLUGIN_INITS):
+        context = PLUGIN_INITS[name](am_conf)
+        replica = get_local_replica({'REPLICA_DIR': args.directory}, context)
+        print('{}: {} users swept'.format(name, replica.sweep()))
+        replica.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+
+DEFAULT_VNODES = 160
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping user ids to nodes (workers or queues).
+
+    Every node is placed on the ring at `vnodes' points, so users are spread evenly and
+    adding or removing a node only moves the users of that node.
+    """
+
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes.values()))
+
+    def add_node(self, node):
+        for i in range(self.vnodes):
+            point = _hash('{}#{}'.format(node, i))
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove_node(self, node):
+        for i in range(self.vnodes):
+            point = _hash('{}#{}'.format(node, i))
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                del self._points[bisect.bisect_left(self._points, point)]
+
+    def get_node(self, user_id):
+        """
+        :param user_id: Unique identifier
+        :return: The node responsible for user_id
+        """
+        if not self._points:
+            raise ValueError('No nodes in hash ring')
+        index = bisect.bisect(self._points, _hash(str(user_id))) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+class UserRouter(object):
+    """
+    Celery router sending tasks with a user id to a queue chosen by consistent hashing, so that
+    all syncs for one user go through the same queue. Use it in the AM configuration as
+
+        task_routes = (UserRouter(HashRing(['am_0', 'am_1', 'am_2'])),)
+
+    A worker consuming a queue still runs its tasks in as many processes as its concurrency,
+    so syncs for one user are only handled by one process with a single consumer process
+    (celery worker -c 1) per queue.
+
+    The user id is taken from the `user_id' keyword argument, or else from the positional
+    argument at user_id_position, matching the AM update_attributes tasks.
+    """
+
+    def __init__(self, ring, task_names=None, user_id_position=1):
+        self.ring = ring
+        self.task_names = task_names
+        self.user_id_position = user_id_position
+
+    def __call__(self, name, args, kwargs, options, task=None, **kw):
+        if self.task_names is not None and name not in self.task_names:
+            return None
+        user_id = (kwargs or {}).get('user_id')
+        if user_id is None and args is not None and len(args) > self.user_id_position:
+            user_id = args[self.user_id_position]
+        if user_id is None:
+            return None
+        return {'queue': self.ring.get_node(user_id)}
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+PRIORITY_NAMES = {
+    INTERACTIVE: 'interactive',
+    NORMAL: 'normal',
+    BULK: 'bulk',
+}
+
+# Default priority of syncs from each plugin
+PLUGIN_PRIORITIES = {
+    'eduid_security': INTERACTIVE,       # Password reset and AL1 downgrade
+    'eduid_oidc_proofing': NORMAL,
+    'eduid_letter_proofing': NORMAL,
+    'eduid_lookup_mobile_proofing': NORMAL,
+    'eduid_eidas': NORMAL,
+    'eduid_orcid': NORMAL,
+    'eduid_phone': NORMAL,
+    'eduid_personal_data': NORMAL,
+    'eduid_email': BULK,                 # Mail alias updates
+}
+
+# Priority of syncs by origin, overriding the plugin priority
+ORIGIN_PRIORITIES = {
+    'interactive': INTERACTIVE,
+    'resync': BULK,
+    'backfill': BULK,
+    'audit': BULK,
+}
+
+_origin = threading.local()
+
+
+@contextmanager
+def fetch_origin(origin):
+    """
+    Set the origin of the attribute_fetcher calls made by this thread within the block,
+    e.g. `with fetch_origin('resync'):'.
+    """
+    previous = getattr(_origin, 'value', None)
+    _origin.value = origin
+    try:
+        yield
+    finally:
+        _origin.value = previous
+
+
+def current_origin():
+    """
+    :return: Origin set with fetch_origin, or None
+    """
+    return getattr(_origin, 'value', None)
+
+
+def fetch_priority(plugin_name, origin=None):
+    """
+    :param plugin_name: Entry point name of the plugin
+    :param origin: Origin of the call, see ORIGIN_PRIORITIES
+
+    :return: INTERACTIVE, NORMAL or BULK
+    :rtype: int
+    """
+    if origin in ORIGIN_PRIORITIES:
+        return ORIGIN_PRIORITIES[origin]
+    return PLUGIN_PRIORITIES.get(plugin_name, NORMAL)
+
+
+class PriorityRouter(object):
+    """
+    Celery router sending the sync tasks of a priority to a queue of its own, so that a
+    password reset does not wait behind a resync backlog in the broker. Give the queues
+    their own workers, e.g. `celery worker -Q am_interactive', and use it in the
+    configuration of the applications sending syncs as
+
+        task_routes = (PriorityRouter({INTERACTIVE: 'am_interactive', BULK: 'am_bulk'}),)
+
+    The plugin name is taken from the `app_name' keyword argument, or else from the
+    positional argument at app_name_position, matching the AM update_attributes tasks, and
+    the origin from fetch_origin in the sending thread. Tasks of a priority without a queue
+    are left to the next router, e.g. a routing.UserRouter.
+    """
+
+    def __init__(self, queues, task_names=None, app_name_position=0):
+        self.queues = dict(queues)
+        self.task_names = task_names
+        self.app_name_position = app_name_position
+
+    def __call__(self, name, args, kwargs, options, task=None, **kw):
+        if self.task_names is not None and name not in self.task_names:
+            return None
+        app_name = (kwargs or {}).get('app_name')
+        if app_name is None and args is not None and len(args) > self.app_name_position:
+            app_name = args[self.app_name_position]
+        if app_name is None:
+            return None
+        queue = self.queues.get(fetch_priority(app_name, current_origin()))
+        if queue is None:
+            return None
+        return {'queue': queue}
+
+
+class PriorityScheduler(object):
+    """
+    Fetch hook admitting at most max_concurrent attribute_fetcher calls at a time. Waiting
+    calls are admitted highest priority first, in arrival order within a priority.
+
+    Bulk calls are throttled to at most max_bulk at a time, leaving the rest of the slots to
+    interactive and normal calls, and optionally to bulk_rate calls per second.
+
+    The scheduler only orders the calls made concurrently in one process, like those of a
+    concurrency.ThreadedFetcher or limiter.bulk_fetch. A prefork worker runs one task per
+    process, so tasks waiting in the broker are not reordered; route them to queues per
+    priority with PriorityRouter for that.
+    """
+
+    def __init__(self, max_concurrent, max_bulk=None, bulk_rate=None):
+        self.max_concurrent = max_concurrent
+        self.max_bulk = max_bulk if max_bulk is not None else max(1, max_concurrent // 2)
+        self.bulk_rate = bulk_rate
+        self.in_flight = 0
+        self.bulk_in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._bulk_tokens = 1.0
+        self._bulk_tokens_ts = time.time()
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        with self._condition:
+            waiting = dict((name, 0) for name in PRIORITY_NAMES.values())
+            for priority, _ in self._waiting:
+                waiting[PRIORITY_NAMES[priority]] += 1
+            return {
+                'in_flight': self.in_flight,
+                'bulk_in_flight': self.bulk_in_flight,
+                'waiting': waiting,
+            }
+
+    def _bulk_wait(self):
+        """
+        Seconds until a bulk call may be admitted, 0 if it may be admitted now.
+        """
+        if self.bulk_in_flight >= self.max_bulk:
+            return None
+        if self.bulk_rate is None:
+            return 0
+        now = time.time()
+        self._bulk_tokens = min(1.0, self._bulk_tokens + (now - self._bulk_tokens_ts) * self.bulk_rate)
+        self._bulk_tokens_ts = now
+        if self._bulk_tokens >= 1.0:
+            return 0
+        return (1.0 - self._bulk_tokens) / self.bulk_rate
+
+    def acquire(self, priority):
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            while True:
+                timeout = None
+                if self._waiting[0] == entry and self.in_flight < self.max_concurrent:
+                    if priority != BULK:
+                        break
+                    timeout = self._bulk_wait()
+                    if timeout == 0:
+                        if self.bulk_rate is not None:
+                            self._bulk_tokens -= 1.0
+                        break
+                self._condition.wait(timeout)
+            heapq.heappop(self._waiting)
+            self.in_flight += 1
+            if priority == BULK:
+                self.bulk_in_flight += 1
+            # The next waiter may be admittable too
+            self._condition.notify_all()
+
+    def release(self, priority):
+        with self._condition:
+            self.in_flight -= 1
+            if priority == BULK:
+                self.bulk_in_flight -= 1
+            self._condition.notify_all()
+
+    def __call__(self, fetch, context, user_id, stats):
+        priority = fetch_priority(context.PLUGIN_NAME, current_origin())
+        self.acquire(priority)
+        try:
+            return fetch(context, user_id, stats)
+        finally:
+            self.release(priority)
+
+
+_scheduler = None
+
+
+def get_scheduler(am_conf):
+    """
+    Return the scheduler shared by all plugin contexts in this process.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: PriorityScheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = PriorityScheduler(am_conf['SCHEDULER_MAX_CONCURRENT'],
+                                       max_bulk=am_conf.get('SCHEDULER_MAX_BULK'),
+                                       bulk_rate=am_conf.get('SCHEDULER_BULK_RATE'))
+    return _scheduler
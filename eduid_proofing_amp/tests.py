@@ -1,16 +1,62 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import bson
+import datetime
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
 from copy import deepcopy
+from concurrent import futures
+from unittest import TestCase
+
+from pymongo.errors import AutoReconnect
 
 from eduid_userdb.exceptions import UserDoesNotExist, UserHasUnknownData
-from eduid_userdb.testing import MongoTestCase
 from eduid_userdb.proofing import ProofingUser
 from eduid_userdb.personal_data import PersonalDataUser
 from eduid_userdb.security import SecurityUser
-from eduid_proofing_amp import attribute_fetcher, oidc_plugin_init, letter_plugin_init, lookup_mobile_plugin_init
-from eduid_proofing_amp import email_plugin_init, phone_plugin_init, personal_data_plugin_init, security_plugin_init
-from eduid_proofing_amp import orcid_plugin_init
+from eduid_proofing_amp import attribute_fetcher, OidcProofingAMPContext, LookupMobileProofingAMPContext
+from eduid_proofing_amp import OrcidAMPContext
+from eduid_proofing_amp import lookup_path
+from eduid_proofing_amp.ownership import WriteLedger, attribute_priority
+from eduid_proofing_amp.profiling import FetchProfiler
+from eduid_proofing_amp.memory import MemoryAccounting, merge_reports
+from eduid_proofing_amp.deadline import DeadlineReader, LatencyWindow
+from eduid_proofing_amp.replica import DEFAULT_MAX_AGE, LocalReplica, get_local_replica, whitelisted_dict
+from eduid_proofing_amp.backends import InMemoryPrivateDB, MongoPrivateDB, PrivateDB
+from eduid_proofing_amp import EmailProofingAMPContext, LetterProofingAMPContext, PersonalDataAMPContext
+from eduid_proofing_amp.limiter import AIMDLimiter, bulk_fetch
+from eduid_proofing_amp.routing import HashRing, UserRouter
+from eduid_proofing_amp.validation import FastValidator
+from eduid_proofing_amp.coalesce import UpdateCoalescer, collection_flusher
+from eduid_proofing_amp.driver import add_connection_arguments, connection_conf, driver_profile, plugin_mongo_uri
+from eduid_proofing_amp.driver import profile_uri
+from eduid_proofing_amp.indexes import ensure_indexes, explain_queries, plan_stages, required_indexes
+from eduid_proofing_amp.whitelists import WhitelistPlan, WhitelistReloader, apply_plan
+from eduid_proofing_amp.health import HEALTHY, UNHEALTHY, PrivateDBHealth, PrivateDBUnavailable
+from eduid_proofing_amp.tracing import STATUS_ERROR, FileSpanExporter, InMemorySpanExporter, Tracer
+from eduid_proofing_amp.tracing import key_values, parse_traceparent, trace_context, user_id_hash
+from eduid_proofing_amp.concurrency import ThreadedFetcher
+from eduid_proofing_amp.scheduling import current_origin
+from eduid_proofing_amp.tracing import current_traceparent
+from eduid_proofing_amp.relevance import ChangeFilter, change_event_fields, plugin_whitelists, sync_needed
+from eduid_proofing_amp.relevance import update_fields
+from eduid_proofing_amp.causal import CausalReader, load_token, session_token
+from eduid_proofing_amp.benchmark import CONTEXTS, SAMPLE_USER, compressed_sizes, large_user
+from eduid_proofing_amp import PhoneProofingAMPContext, SecurityAMPContext, configure_context
+from eduid_proofing_amp.export import JSONL, UpdateExporter, UpdateWriter, apply_updates, export_updates, read_updates
+from eduid_proofing_amp.identity_index import EMAIL, NIN, ORCID, PHONE, IdentityIndex, verified_identifiers
+from eduid_proofing_amp.nins import duplicate_nins, extract_verified_nins, scan_verified_nins
+from eduid_proofing_amp.scheduling import BULK, INTERACTIVE, NORMAL, PriorityRouter, PriorityScheduler, fetch_origin
+from eduid_proofing_amp.scheduling import fetch_priority
 
 USER_DATA = {
     'givenName': 'Testaren',
@@ -64,31 +110,25 @@ USER_DATA = {
 }
 
 
-class AttributeFetcherOldToNewUsersTests(MongoTestCase):
+def in_memory_context(context_class, user_class):
+    """
+    A plugin context like its plugin_init creates, with an in-memory private database.
+    """
+    return configure_context(context_class(None, private_db=InMemoryPrivateDB(user_class)), {})
+
+
+class AttributeFetcherOldToNewUsersTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherOldToNewUsersTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            oidc_plugin_init(self.am_settings),
-            letter_plugin_init(self.am_settings),
-            lookup_mobile_plugin_init(self.am_settings)
+            in_memory_context(OidcProofingAMPContext, ProofingUser),
+            in_memory_context(LetterProofingAMPContext, ProofingUser),
+            in_memory_context(LookupMobileProofingAMPContext, ProofingUser),
         ]
-        for userdoc in self.amdb._get_all_docs():
-            proofing_user = ProofingUser(data=userdoc)
-            for context in self.plugin_contexts:
-                context.private_db.save(proofing_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherOldToNewUsersTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -121,7 +161,7 @@ class AttributeFetcherOldToNewUsersTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -176,7 +216,7 @@ class AttributeFetcherOldToNewUsersTests(MongoTestCase):
             ],
         })
         proofing_user = ProofingUser(data=self.user_data)
-        letter_plugin_context = letter_plugin_init(self.am_settings)
+        letter_plugin_context = in_memory_context(LetterProofingAMPContext, ProofingUser)
         letter_plugin_context.private_db.save(proofing_user)
 
         actual_update = attribute_fetcher(letter_plugin_context, proofing_user.user_id)
@@ -337,31 +377,18 @@ class AttributeFetcherOldToNewUsersTests(MongoTestCase):
             )
 
 
-class AttributeFetcherNINProofingTests(MongoTestCase):
+class AttributeFetcherNINProofingTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherNINProofingTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            oidc_plugin_init(self.am_settings),
-            letter_plugin_init(self.am_settings),
-            lookup_mobile_plugin_init(self.am_settings)
+            in_memory_context(OidcProofingAMPContext, ProofingUser),
+            in_memory_context(LetterProofingAMPContext, ProofingUser),
+            in_memory_context(LookupMobileProofingAMPContext, ProofingUser),
         ]
-        for userdoc in self.amdb._get_all_docs():
-            proofing_user = ProofingUser(data=userdoc)
-            for context in self.plugin_contexts:
-                context.private_db.save(proofing_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherNINProofingTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -394,7 +421,7 @@ class AttributeFetcherNINProofingTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -446,7 +473,7 @@ class AttributeFetcherNINProofingTests(MongoTestCase):
             ],
         })
         proofing_user = ProofingUser(data=self.user_data)
-        letter_plugin_context = letter_plugin_init(self.am_settings)
+        letter_plugin_context = in_memory_context(LetterProofingAMPContext, ProofingUser)
         letter_plugin_context.private_db.save(proofing_user)
 
         actual_update = attribute_fetcher(letter_plugin_context, proofing_user.user_id)
@@ -586,29 +613,16 @@ class AttributeFetcherNINProofingTests(MongoTestCase):
         )
 
 
-class AttributeFetcherEmailProofingTests(MongoTestCase):
+class AttributeFetcherEmailProofingTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherEmailProofingTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            email_plugin_init(self.am_settings),
+            in_memory_context(EmailProofingAMPContext, ProofingUser),
         ]
-        #for userdoc in self.amdb._get_all_docs():
-        #    proofing_user = ProofingUser(data=userdoc)
-        #    for context in self.plugin_contexts:
-        #        context.private_db.save(proofing_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherEmailProofingTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -640,7 +654,7 @@ class AttributeFetcherEmailProofingTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -687,29 +701,16 @@ class AttributeFetcherEmailProofingTests(MongoTestCase):
             )
 
 
-class AttributeFetcherPhoneProofingTests(MongoTestCase):
+class AttributeFetcherPhoneProofingTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherPhoneProofingTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            phone_plugin_init(self.am_settings),
+            in_memory_context(PhoneProofingAMPContext, ProofingUser),
         ]
-        for userdoc in self.amdb._get_all_docs():
-            proofing_user = ProofingUser(data=userdoc)
-            for context in self.plugin_contexts:
-                context.private_db.save(proofing_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherPhoneProofingTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -740,7 +741,7 @@ class AttributeFetcherPhoneProofingTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -764,29 +765,16 @@ class AttributeFetcherPhoneProofingTests(MongoTestCase):
             )
 
 
-class AttributeFetcherPersonalDataTests(MongoTestCase):
+class AttributeFetcherPersonalDataTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherPersonalDataTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            personal_data_plugin_init(self.am_settings),
+            in_memory_context(PersonalDataAMPContext, PersonalDataUser),
         ]
-        #for userdoc in self.amdb._get_all_docs():
-        #    personal_data_user = PersonalDataUser(data=userdoc)
-        #    for context in self.plugin_contexts:
-        #        context.private_db.save(personal_data_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherPersonalDataTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -816,7 +804,7 @@ class AttributeFetcherPersonalDataTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -839,29 +827,16 @@ class AttributeFetcherPersonalDataTests(MongoTestCase):
             )
 
 
-class AttributeFetcherSecurityTests(MongoTestCase):
+class AttributeFetcherSecurityTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherSecurityTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            security_plugin_init(self.am_settings),
+            in_memory_context(SecurityAMPContext, SecurityUser),
         ]
-        #for userdoc in self.amdb._get_all_docs():
-        #    security_user = SecurityUser(data=userdoc)
-        #    for context in self.plugin_contexts:
-        #        context.private_db.save(security_user, check_sync=False)
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherSecurityTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -904,7 +879,7 @@ class AttributeFetcherSecurityTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -940,25 +915,16 @@ class AttributeFetcherSecurityTests(MongoTestCase):
             )
 
 
-class AttributeFetcherOrcidTests(MongoTestCase):
+class AttributeFetcherOrcidTests(TestCase):
 
     def setUp(self):
-        am_settings = {
-            'WANT_MONGO_URI': True
-        }
-        super(AttributeFetcherOrcidTests, self).setUp(init_am=True, am_settings=am_settings)
         self.user_data = deepcopy(USER_DATA)
         self.plugin_contexts = [
-            orcid_plugin_init(self.am_settings),
+            in_memory_context(OrcidAMPContext, ProofingUser),
         ]
 
         self.maxDiff = None
 
-    def tearDown(self):
-        for context in self.plugin_contexts:
-            context.private_db._drop_whole_collection()
-        super(AttributeFetcherOrcidTests, self).tearDown()
-
     def test_invalid_user(self):
         for context in self.plugin_contexts:
             with self.assertRaises(UserDoesNotExist):
@@ -1011,7 +977,7 @@ class AttributeFetcherOrcidTests(MongoTestCase):
 
         for context in self.plugin_contexts:
             # Write bad entry into database
-            user_id = context.private_db._coll.insert(self.user_data)
+            user_id = context.private_db.insert_document(dict(self.user_data, _id=bson.ObjectId()))
 
             with self.assertRaises(UserHasUnknownData):
                 attribute_fetcher(context, user_id)
@@ -1030,3 +996,1831 @@ class AttributeFetcherOrcidTests(MongoTestCase):
                     }
                 }
             )
+
+    def test_dotted_whitelist(self):
+        for context in self.plugin_contexts:
+            context.WHITELIST_SET_ATTRS = ['orcid.id', 'orcid.verified', 'orcid.name']
+            context.WHITELIST_UNSET_ATTRS = ['orcid.name']
+            proofing_user = ProofingUser(data=self.user_data)
+            context.private_db.save(proofing_user)
+
+            self.assertDictEqual(
+                attribute_fetcher(context, proofing_user.user_id),
+                {
+                    '$set': {
+                        'orcid.id': 'orcid_unique_id',
+                        'orcid.verified': True,
+                    },
+                    '$unset': {
+                        'orcid.name': None
+                    }
+                }
+            )
+
+
+class LookupPathTests(TestCase):
+
+    def test_top_level(self):
+        self.assertEqual(lookup_path(USER_DATA, 'givenName'), 'Testaren')
+        self.assertIsNone(lookup_path(USER_DATA, 'missing'))
+
+    def test_nested(self):
+        self.assertEqual(lookup_path(USER_DATA, 'orcid.id'), 'orcid_unique_id')
+        self.assertEqual(lookup_path(USER_DATA, 'orcid.oidc_authz.token_type'), 'bearer')
+        self.assertIsNone(lookup_path(USER_DATA, 'orcid.missing'))
+
+    def test_through_non_dict(self):
+        self.assertIsNone(lookup_path(USER_DATA, 'givenName.first'))
+        self.assertIsNone(lookup_path(USER_DATA, 'nins.number'))
+
+
+class WriteLedgerTests(TestCase):
+
+    def setUp(self):
+        self.ledger = WriteLedger()
+        self.user_id = bson.ObjectId()
+
+    def test_priority(self):
+        self.assertLess(attribute_priority('eduid_security', 'nins'), attribute_priority('eduid_eidas', 'nins'))
+        self.assertEqual(attribute_priority('eduid_orcid', 'nins'), attribute_priority('eduid_orcid', 'nins.number'))
+
+    def test_retry_written_again(self):
+        # The write of the first update may have failed, the retry must not be dropped
+        update = {'givenName': 'Testaren'}
+        self.assertEqual(self.ledger.filter_update('eduid_personal_data', self.user_id, 1, update, {}),
+                         (update, {}))
+        self.assertEqual(self.ledger.filter_update('eduid_personal_data', self.user_id, 1, update, {}),
+                         (update, {}))
+        self.assertEqual(self.ledger.filter_update('eduid_eidas', self.user_id, 2, update, {}), (update, {}))
+
+    def test_older_version_not_written(self):
+        self.ledger.filter_update('eduid_personal_data', self.user_id, 2, {'givenName': 'New'}, {})
+        self.assertEqual(self.ledger.filter_update('eduid_eidas', self.user_id, 1, {'givenName': 'Old'}, {}),
+                         ({}, {}))
+
+    def test_lower_priority_not_written(self):
+        self.ledger.filter_update('eduid_eidas', self.user_id, 1, {'givenName': 'Official'}, {})
+        self.assertEqual(self.ledger.filter_update('eduid_personal_data', self.user_id, 1, {'givenName': 'Own'}, {}),
+                         ({}, {}))
+        self.assertEqual(self.ledger.filter_update('eduid_personal_data', self.user_id, 2, {'givenName': 'Own'}, {}),
+                         ({'givenName': 'Own'}, {}))
+
+    def test_unset(self):
+        self.ledger.filter_update('eduid_letter_proofing', self.user_id, 1, {'nins': [{'number': '1'}]}, {})
+        self.assertEqual(self.ledger.filter_update('eduid_security', self.user_id, 2, {}, {'nins': None}),
+                         ({}, {'nins': None}))
+        self.assertEqual(self.ledger.filter_update('eduid_letter_proofing', self.user_id, 1,
+                                                   {'nins': [{'number': '1'}]}, {}), ({}, {}))
+
+    def test_max_entries(self):
+        ledger = WriteLedger(max_entries=2)
+        for attr in ['givenName', 'surname', 'displayName']:
+            ledger.filter_update('eduid_personal_data', self.user_id, 1, {attr: 'x'}, {})
+        self.assertEqual(len(ledger), 2)
+
+
+class FakeContext(object):
+    PLUGIN_NAME = 'eduid_test'
+
+
+def fake_fetch(context, user_id, stats, delay=0):
+    stats['user'] = {'_id': user_id, 'givenName': 'Testaren'}
+    time.sleep(delay)
+    return {'$set': {'givenName': 'Testaren'}}
+
+
+class FetchProfilerTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every_nth_call(self):
+        profiler = FetchProfiler(self.directory, every=2)
+        for _ in range(4):
+            self.assertEqual(profiler(fake_fetch, FakeContext(), bson.ObjectId(), {}),
+                             {'$set': {'givenName': 'Testaren'}})
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith('.prof')]), 2)
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith('.json')]), 2)
+
+    def test_slow_calls(self):
+        profiler = FetchProfiler(self.directory, slow_threshold=0.05, sample_interval=0.001)
+        profiler(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(os.listdir(self.directory), [])
+        profiler(lambda *args: fake_fetch(*args, delay=0.1), FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith('.stacks')]), 1)
+
+    def test_sampler_stopped_before_reading(self):
+        # The sampler is started around when the call returns, or not at all
+        profiler = FetchProfiler(self.directory, slow_threshold=0.001, sample_interval=0.0001, max_files=1000)
+        for _ in range(50):
+            profiler(lambda *args: fake_fetch(*args, delay=0.001), FakeContext(), bson.ObjectId(), {})
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name == 'amp-stack-sampler'])
+
+    def test_rotation(self):
+        profiler = FetchProfiler(self.directory, every=1, max_files=2)
+        for _ in range(5):
+            profiler(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith('.prof')]), 2)
+
+
+class MemoryAccountingTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_per_plugin_stats(self):
+        accounting = MemoryAccounting(self.directory, snapshot_every=2, write_every=3)
+        retained = []
+
+        def leaky_fetch(context, user_id, stats):
+            retained.append(bytearray(100000))
+            return fake_fetch(context, user_id, stats)
+
+        for _ in range(3):
+            self.assertEqual(accounting(leaky_fetch, FakeContext(), bson.ObjectId(), {}),
+                             {'$set': {'givenName': 'Testaren'}})
+
+        plugins = merge_reports(self.directory)
+        self.assertEqual(list(plugins.keys()), ['eduid_test'])
+        self.assertEqual(plugins['eduid_test']['calls'], 3)
+        self.assertGreaterEqual(plugins['eduid_test']['peak_max'], 100000)
+        self.assertGreaterEqual(plugins['eduid_test']['retained_total'], 300000)
+        self.assertTrue(plugins['eduid_test']['sites'])
+
+    def test_written_without_snapshots(self):
+        accounting = MemoryAccounting(self.directory, snapshot_every=0, write_every=2, write_interval=None)
+        accounting(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(merge_reports(self.directory), {})
+        accounting(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        plugins = merge_reports(self.directory)
+        self.assertEqual(plugins['eduid_test']['calls'], 2)
+        self.assertFalse(plugins['eduid_test']['sites'])
+
+    def test_peak_not_measured(self):
+        # As on Python < 3.9, without tracemalloc.reset_peak
+        accounting = MemoryAccounting(self.directory, snapshot_every=0, write_every=1)
+        accounting.measure_peak = False
+        accounting(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        stats = merge_reports(self.directory)['eduid_test']
+        self.assertEqual((stats['calls'], stats['peak_calls'], stats['peak_max']), (1, 0, 0))
+
+
+class FakeCollection(object):
+
+    def __init__(self, docs, delay=0, secondary=None):
+        self.docs = dict((doc['_id'], doc) for doc in docs)
+        self.delay = delay
+        self.secondary = secondary
+        self.calls = []
+
+    def find_one(self, spec, **kwargs):
+        self.calls.append((spec, kwargs))
+        time.sleep(self.delay)
+        return self.docs.get(spec['_id'])
+
+    def with_options(self, **kwargs):
+        return self.secondary
+
+
+class FakeUser(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.user_id = data['_id']
+
+    def to_dict(self, old_userdb_format=False):
+        return dict(self.data)
+
+
+class FakePrivateDB(object):
+    UserClass = staticmethod(lambda data: data)
+
+    def __init__(self, coll):
+        self._coll = coll
+
+
+class DeadlineReaderTests(TestCase):
+
+    def setUp(self):
+        self.user_id = bson.ObjectId()
+        self.doc = {'_id': self.user_id, 'givenName': 'Testaren'}
+        self.executor = futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_max_time_ms(self):
+        coll = FakeCollection([self.doc])
+        reader = DeadlineReader(100)
+        self.assertEqual(reader(FakePrivateDB(coll), self.user_id), self.doc)
+        self.assertEqual(coll.calls, [({'_id': self.user_id}, {'max_time_ms': 100})])
+
+    def test_missing_user(self):
+        reader = DeadlineReader(100)
+        with self.assertRaises(UserDoesNotExist):
+            reader(FakePrivateDB(FakeCollection([])), self.user_id)
+
+    def test_hedge_won(self):
+        secondary = FakeCollection([self.doc])
+        coll = FakeCollection([self.doc], delay=0.2, secondary=secondary)
+        reader = DeadlineReader(100, hedge_percentile=95, executor=self.executor)
+        with fetch_origin('resync'):
+            self.assertEqual(reader(FakePrivateDB(coll), self.user_id), self.doc)
+        self.assertEqual(reader.metrics()['hedges_fired'], 1)
+        self.assertEqual(reader.metrics()['hedges_won'], 1)
+
+    def test_no_hedge_after_write(self):
+        # The secondary has not replicated the write the sync was triggered by
+        secondary = FakeCollection([{'_id': self.user_id, 'givenName': 'Before'}])
+        coll = FakeCollection([self.doc], delay=0.1, secondary=secondary)
+        reader = DeadlineReader(40, hedge_percentile=95, executor=self.executor)
+        self.assertEqual(reader(FakePrivateDB(coll), self.user_id), self.doc)
+        self.assertEqual(reader.metrics()['hedges_fired'], 0)
+
+    def test_hedge_secondary_missing_user(self):
+        secondary = FakeCollection([])
+        coll = FakeCollection([self.doc], delay=0.1, secondary=secondary)
+        reader = DeadlineReader(40, hedge_percentile=95, executor=self.executor)
+        with fetch_origin('resync'):
+            self.assertEqual(reader(FakePrivateDB(coll), self.user_id), self.doc)
+        self.assertEqual(reader.metrics()['hedges_fired'], 1)
+        self.assertEqual(reader.metrics()['hedges_won'], 0)
+
+    def test_latency_window(self):
+        window = LatencyWindow(90, min_samples=10, recompute_every=1)
+        for latency in range(9):
+            window.record(latency)
+        self.assertIsNone(window.value)
+        for latency in range(9, 100):
+            window.record(latency)
+        self.assertEqual(window.value, 89)
+
+
+class LocalReplicaTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.context = FakeContext()
+        self.context.WHITELIST_SET_ATTRS = ['givenName', 'orcid.id']
+        self.context.private_db = InMemoryPrivateDB(FakeUser)
+        self.user_ids = [
+            self.context.private_db.insert_document(
+                {'_id': bson.ObjectId(), 'givenName': 'Testaren', 'surname': 'Testsson', 'modified_ts': 1}),
+            self.context.private_db.insert_document(
+                {'_id': bson.ObjectId(), 'orcid': {'id': 'orcid_id', 'oidc_authz': {}}, 'modified_ts': 2}),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_whitelisted_dict(self):
+        self.assertEqual(whitelisted_dict(USER_DATA, ['givenName', 'orcid.id', 'terminated']),
+                         {'givenName': 'Testaren', 'orcid': {'id': 'orcid_unique_id'}})
+
+    def test_sweep_and_get(self):
+        replica = LocalReplica(self.context, os.path.join(self.directory, 'test.sqlite'))
+        user_id = self.user_ids[1]
+        self.assertIsNone(replica.get(user_id))
+        self.assertEqual(replica.sweep(), 2)
+        self.assertEqual(replica.get(user_id), {'orcid': {'id': 'orcid_id'}, 'modified_ts': 2})
+        self.assertEqual(replica.sweep(), 1)
+        replica.close()
+
+    def test_invalid_user_removed(self):
+        replica = LocalReplica(self.context, os.path.join(self.directory, 'test.sqlite'))
+        replica.sweep()
+        user_id = self.user_ids[1]
+
+        def user_class(data):
+            if data['_id'] == user_id:
+                raise UserHasUnknownData('malicious')
+            return FakeUser(data)
+
+        self.context.private_db.UserClass = user_class
+        self.assertEqual(replica.sweep(), 0)
+        self.assertIsNone(replica.get(user_id))
+        replica.close()
+
+    def test_max_age(self):
+        replica = LocalReplica(self.context, os.path.join(self.directory, 'test.sqlite'), max_age=0)
+        replica.sweep()
+        time.sleep(0.01)
+        self.assertIsNone(replica.get(self.user_ids[0]))
+        replica.close()
+
+    def test_invalidate(self):
+        replica = LocalReplica(self.context, os.path.join(self.directory, 'test.sqlite'))
+        replica.sweep()
+        replica.invalidate()
+        self.assertIsNone(replica.last_sweep)
+        self.assertIsNone(replica.get(self.user_ids[0]))
+        self.assertEqual(replica.sweep(), 2)
+        replica.close()
+
+    def test_only_serves_bulk_origins(self):
+        context = LetterProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        user_id = context.private_db.insert_document({'_id': bson.ObjectId(), 'modified_ts': 1})
+        context.replica = LocalReplica(context, os.path.join(self.directory, 'test.sqlite'))
+        context.replica.sweep()
+        nins = [{'number': '190102031234', 'verified': True}]
+        context.private_db.insert_document({'_id': user_id, 'nins': nins, 'modified_ts': 2})
+        # A sync triggered by the write must see it
+        self.assertEqual(attribute_fetcher(context, user_id), {'$set': {'nins': nins}})
+        with fetch_origin('resync'):
+            # The stale replica row lacks nins, so the resync reads the private data
+            self.assertEqual(attribute_fetcher(context, user_id), {'$set': {'nins': nins}})
+        self.assertEqual(context.replica.hits, 1)
+        context.replica.sweep()
+        with fetch_origin('resync'):
+            self.assertEqual(attribute_fetcher(context, user_id), {'$set': {'nins': nins}})
+        self.assertEqual(context.replica.hits, 2)
+        context.replica.close()
+
+    def test_max_age_from_sweep_interval(self):
+        replica = get_local_replica({'REPLICA_DIR': self.directory}, self.context)
+        self.assertEqual(replica.max_age, DEFAULT_MAX_AGE)
+        replica.close()
+        replica = get_local_replica({'REPLICA_DIR': self.directory, 'REPLICA_SWEEP_INTERVAL': 600}, self.context)
+        self.assertEqual(replica.max_age, 1200)
+        while replica.last_sweep is None:
+            time.sleep(0.01)
+        replica.close()
+
+
+class InMemoryPrivateDBTests(TestCase):
+
+    def setUp(self):
+        self.private_db = InMemoryPrivateDB(FakeUser)
+        self.user_ids = [self.private_db.insert_document({'_id': bson.ObjectId(), 'modified_ts': ts})
+                         for ts in [3, 1, 2]]
+
+    def test_get_user_by_id(self):
+        self.assertEqual(self.private_db.get_user_by_id(self.user_ids[0]).data['modified_ts'], 3)
+        with self.assertRaises(UserDoesNotExist):
+            self.private_db.get_user_by_id(bson.ObjectId())
+
+    def test_get_users_by_ids(self):
+        users = self.private_db.get_users_by_ids([self.user_ids[1], bson.ObjectId()])
+        self.assertEqual([user.user_id for user in users], [self.user_ids[1]])
+
+    def test_iter_documents_since(self):
+        self.assertEqual([doc['modified_ts'] for doc in self.private_db.iter_documents_since(None)], [1, 2, 3])
+        self.assertEqual([doc['modified_ts'] for doc in self.private_db.iter_documents_since(2)], [2, 3])
+
+    def test_iter_documents_projection(self):
+        docs = list(self.private_db.iter_documents_since(None, projection={'nins': True}))
+        self.assertEqual(docs, [{'_id': user_id} for user_id in [self.user_ids[1], self.user_ids[2], self.user_ids[0]]])
+
+    def test_count(self):
+        self.assertEqual(self.private_db.count(), 3)
+
+    def test_incomplete_backend(self):
+        class ReadOnlyPrivateDB(PrivateDB):
+            def get_user_by_id(self, user_id):
+                return None
+
+        with self.assertRaises(TypeError):
+            ReadOnlyPrivateDB()
+        self.private_db._drop_whole_collection()
+        self.assertEqual(self.private_db.count(), 0)
+
+
+class InMemoryAttributeFetcherTests(TestCase):
+
+    def setUp(self):
+        self.context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(PersonalDataUser))
+        self.maxDiff = None
+
+    def test_invalid_user(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.context, bson.ObjectId('0' * 24))
+
+    def test_existing_user(self):
+        personal_data_user = PersonalDataUser(data=deepcopy(USER_DATA))
+        self.context.private_db.save(personal_data_user)
+
+        self.assertDictEqual(
+            attribute_fetcher(self.context, personal_data_user.user_id),
+            {
+                '$set': {
+                    'givenName': u'Testaren',
+                    'surname': u'Testsson',
+                    'displayName': u'John',
+                    'preferredLanguage': u'sv',
+                },
+            }
+        )
+
+    def test_malicious_attributes(self):
+        user_data = deepcopy(USER_DATA)
+        user_data.update({
+            '_id': bson.ObjectId(),
+            'malicious': 'hacker',
+        })
+        user_id = self.context.private_db.insert_document(user_data)
+
+        with self.assertRaises(UserHasUnknownData):
+            attribute_fetcher(self.context, user_id)
+
+
+class PrioritySchedulerTests(TestCase):
+
+    def test_fetch_priority(self):
+        self.assertEqual(fetch_priority('eduid_security'), INTERACTIVE)
+        self.assertEqual(fetch_priority('eduid_letter_proofing'), NORMAL)
+        self.assertEqual(fetch_priority('eduid_email'), BULK)
+        self.assertEqual(fetch_priority('eduid_security', 'resync'), BULK)
+
+    def test_router(self):
+        router = PriorityRouter({INTERACTIVE: 'am_interactive', BULK: 'am_bulk'},
+                                task_names=['eduid_am.tasks.update_attributes_keep_result'])
+        task = 'eduid_am.tasks.update_attributes_keep_result'
+        user_id = bson.ObjectId()
+        self.assertEqual(router(task, ('eduid_security', user_id), {}, {}), {'queue': 'am_interactive'})
+        self.assertEqual(router(task, (), {'app_name': 'eduid_email', 'user_id': user_id}, {}), {'queue': 'am_bulk'})
+        self.assertIsNone(router(task, ('eduid_letter_proofing', user_id), {}, {}))
+        self.assertIsNone(router('eduid_am.tasks.other', ('eduid_security', user_id), {}, {}))
+        with fetch_origin('resync'):
+            self.assertEqual(router(task, ('eduid_security', user_id), {}, {}), {'queue': 'am_bulk'})
+
+    def test_origin(self):
+        scheduler = PriorityScheduler(1)
+        priorities = []
+
+        def fetch(context, user_id, stats):
+            priorities.append(scheduler.metrics())
+            return {}
+
+        with fetch_origin('resync'):
+            scheduler(fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(priorities[0]['bulk_in_flight'], 1)
+
+    def test_interactive_first(self):
+        scheduler = PriorityScheduler(1)
+        scheduler.acquire(NORMAL)
+        admitted = []
+
+        def wait_for_slot(priority):
+            scheduler.acquire(priority)
+            admitted.append(priority)
+            scheduler.release(priority)
+
+        threads = []
+        for priority in [BULK, NORMAL, INTERACTIVE]:
+            thread = threading.Thread(target=wait_for_slot, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            while sum(scheduler.metrics()['waiting'].values()) < len(threads):
+                time.sleep(0.001)
+
+        scheduler.release(NORMAL)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, [INTERACTIVE, NORMAL, BULK])
+
+    def test_bulk_throttled(self):
+        scheduler = PriorityScheduler(2, max_bulk=1)
+        scheduler.acquire(BULK)
+        scheduler.acquire(INTERACTIVE)
+        self.assertEqual(scheduler.metrics()['in_flight'], 2)
+        scheduler.release(INTERACTIVE)
+
+        thread = threading.Thread(target=scheduler.acquire, args=(BULK,))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(scheduler.metrics()['waiting']['bulk'], 1)
+        scheduler.acquire(NORMAL)
+        scheduler.release(BULK)
+        thread.join()
+        self.assertEqual(scheduler.metrics()['bulk_in_flight'], 1)
+
+
+class AIMDLimiterTests(TestCase):
+
+    def test_increase(self):
+        limiter = AIMDLimiter(initial_limit=2, latency_target=1)
+        for _ in range(10):
+            limiter.run(lambda: None)
+        self.assertGreater(limiter.metrics()['limit'], 2)
+
+    def test_decrease_on_latency(self):
+        limiter = AIMDLimiter(initial_limit=10, latency_target=0.01, backoff=0.5)
+        limiter.run(time.sleep, 0.02)
+        self.assertEqual(limiter.metrics()['limit'], 5)
+        self.assertEqual(limiter.metrics()['decreases'], 1)
+
+    def test_decrease_on_congestion(self):
+        limiter = AIMDLimiter(initial_limit=10, backoff=0.5)
+
+        def fail():
+            raise AutoReconnect('overloaded')
+
+        with self.assertRaises(AutoReconnect):
+            limiter.run(fail)
+        self.assertEqual(limiter.metrics()['limit'], 5)
+        self.assertEqual(limiter.metrics()['in_flight'], 0)
+
+    def test_min_limit(self):
+        limiter = AIMDLimiter(initial_limit=1, min_limit=1, latency_target=0, backoff=0.5)
+        limiter.run(time.sleep, 0.001)
+        self.assertEqual(limiter.metrics()['limit'], 1)
+
+    def test_bulk_fetch(self):
+        context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        user_ids = [context.private_db.insert_document({'_id': bson.ObjectId(), 'givenName': str(i)})
+                    for i in range(50)]
+        user_ids.append(bson.ObjectId())
+        written = {}
+
+        results = list(bulk_fetch(context, user_ids, apply_update=written.__setitem__, threads=4))
+        self.assertEqual(len(results), 51)
+        self.assertEqual(len(written), 50)
+        self.assertEqual(written[user_ids[3]], {'$set': {'givenName': '3'}})
+        failed = [exception for _, _, exception in results if exception is not None]
+        self.assertEqual(len(failed), 1)
+        self.assertIsInstance(failed[0], UserDoesNotExist)
+
+
+class HashRingTests(TestCase):
+
+    def setUp(self):
+        self.user_ids = [bson.ObjectId() for _ in range(1000)]
+
+    def test_stable(self):
+        ring = HashRing(['am_0', 'am_1', 'am_2'])
+        other = HashRing(['am_2', 'am_1', 'am_0'])
+        for user_id in self.user_ids:
+            self.assertEqual(ring.get_node(user_id), other.get_node(user_id))
+
+    def test_balanced(self):
+        ring = HashRing(['am_0', 'am_1', 'am_2', 'am_3'])
+        counts = Counter(ring.get_node(user_id) for user_id in self.user_ids)
+        self.assertEqual(sorted(counts.keys()), ring.nodes)
+        self.assertLess(max(counts.values()), 2 * min(counts.values()))
+
+    def test_minimal_reshuffle(self):
+        ring = HashRing(['am_0', 'am_1', 'am_2'])
+        before = dict((user_id, ring.get_node(user_id)) for user_id in self.user_ids)
+        ring.add_node('am_3')
+        moved = [user_id for user_id in self.user_ids if ring.get_node(user_id) != before[user_id]]
+        self.assertTrue(all(ring.get_node(user_id) == 'am_3' for user_id in moved))
+        self.assertLess(len(moved), len(self.user_ids) / 2)
+        ring.remove_node('am_3')
+        self.assertEqual(before, dict((user_id, ring.get_node(user_id)) for user_id in self.user_ids))
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            HashRing().get_node(self.user_ids[0])
+
+    def test_user_router(self):
+        ring = HashRing(['am_0', 'am_1'])
+        router = UserRouter(ring, task_names=['eduid_am.tasks.update_attributes_keep_result'])
+        user_id = self.user_ids[0]
+        self.assertEqual(router('eduid_am.tasks.update_attributes_keep_result', ('eduid_security', user_id), {}, {}),
+                         {'queue': ring.get_node(user_id)})
+        self.assertIsNone(router('eduid_am.tasks.other', ('eduid_security', user_id), {}, {}))
+
+
+class FastValidatorTests(TestCase):
+
+    def setUp(self):
+        self.doc = {
+            '_id': bson.ObjectId(),
+            'eduPersonPrincipalName': 'test-test',
+            'givenName': 'Testaren',
+            'surname': 'Testsson',
+            'nins': [
+                {'number': '123456781235', 'primary': True, 'verified': True},
+                {'number': '123456781236', 'primary': False, 'verified': False},
+            ],
+            'phone': [{'number': '+46700011336', 'primary': True, 'verified': True}],
+            'passwords': [{'credential_id': '112345678901234567890123', 'salt': 'salt', 'is_generated': False}],
+            'orcid': deepcopy(USER_DATA['orcid']),
+        }
+        self.validator = FastValidator(['nins', 'givenName', 'surname', 'displayName', 'phone', 'passwords',
+                                        'orcid'])
+
+    def test_valid(self):
+        self.assertIs(self.validator(self.doc), self.doc)
+        self.assertEqual(self.validator.accepted, 1)
+
+    def test_unknown_attribute(self):
+        self.doc['malicious'] = 'hacker'
+        self.assertIsNone(self.validator(self.doc))
+        self.assertEqual(self.validator.fallbacks, 1)
+
+    def test_old_format(self):
+        self.doc['mobile'] = [{'mobile': '+46700011336', 'verified': True, 'primary': True}]
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_scalar_type(self):
+        self.doc['givenName'] = {'$ne': None}
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_element_unknown_key(self):
+        self.doc['nins'][0]['malicious'] = 'hacker'
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_two_primaries(self):
+        self.doc['nins'][1].update({'primary': True, 'verified': True})
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_unverified_primary(self):
+        self.doc['phone'][0]['verified'] = False
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_duplicate_element(self):
+        self.doc['nins'][1]['number'] = self.doc['nins'][0]['number']
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_orcid(self):
+        self.doc['orcid']['oidc_authz']['id_token']['aud'] = [{'$gt': ''}]
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_not_whitelisted_attributes_not_checked(self):
+        validator = FastValidator(['givenName'])
+        self.doc['nins'][0]['malicious'] = 'hacker'
+        self.assertIs(validator(self.doc), self.doc)
+
+    def test_unsupported_attribute(self):
+        validator = FastValidator(['letter_proofing_data'])
+        self.assertIs(validator(self.doc), self.doc)
+        self.doc['letter_proofing_data'] = []
+        self.assertIsNone(validator(self.doc))
+
+    def test_timestamp_type(self):
+        self.doc['nins'][0]['created_ts'] = datetime.datetime.utcnow()
+        self.assertIs(self.validator(self.doc), self.doc)
+        self.doc['nins'][0]['created_ts'] = True
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_required_keys(self):
+        del self.doc['eduPersonPrincipalName']
+        self.assertIsNone(self.validator(self.doc))
+
+    def test_same_update_as_user_class(self):
+        now = datetime.datetime.utcnow()
+        user = deepcopy(SAMPLE_USER)
+        del user['mobile']
+        user.update(_id=bson.ObjectId(), modified_ts=now)
+        for element in user['nins'] + user['mailAliases'] + user['passwords']:
+            element.update(created_by='test', created_ts=now)
+        # Elements without the flags the user class fills in with defaults
+        incomplete = dict(deepcopy(user), _id=bson.ObjectId())
+        user['mailAliases'][0]['primary'] = True
+        user['passwords'][0]['is_generated'] = False
+        del incomplete['nins'][0]['verified']
+        incomplete['phone'] = [{'number': '+46700011336', 'verified': True}]
+        del incomplete['orcid']['verified']
+        docs = [user, incomplete, large_user(3), {'_id': bson.ObjectId(), 'eduPersonPrincipalName': 'test-test'}]
+        accepted = 0
+        for context_class, user_class in CONTEXTS:
+            context = context_class(None, private_db=InMemoryPrivateDB(user_class))
+            validator = FastValidator(context.WHITELIST_SET_ATTRS)
+            for doc in docs:
+                context.private_db.insert_document(doc)
+                context.validator = None
+                expected = attribute_fetcher(context, doc['_id'])
+                context.validator = validator
+                self.assertEqual(attribute_fetcher(context, doc['_id']), expected)
+            if set(validator.checks) & {'nins', 'mailAliases', 'phone', 'passwords', 'orcid'}:
+                self.assertIsNone(validator(incomplete))
+            accepted += validator.accepted
+        self.assertGreater(accepted, len(CONTEXTS))
+
+    def test_attribute_fetcher(self):
+        def user_class(data):
+            if 'malicious' in data:
+                raise UserHasUnknownData('malicious')
+            return FakeUser(data)
+
+        context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(user_class))
+        context.validator = FastValidator(context.WHITELIST_SET_ATTRS)
+        context.private_db.insert_document(self.doc)
+        self.assertEqual(attribute_fetcher(context, self.doc['_id']),
+                         {'$set': {'givenName': 'Testaren', 'surname': 'Testsson'}})
+        self.assertEqual(context.validator.accepted, 1)
+
+        self.doc['malicious'] = 'hacker'
+        context.private_db.insert_document(self.doc)
+        with self.assertRaises(UserHasUnknownData):
+            attribute_fetcher(context, self.doc['_id'])
+
+
+class VerifiedNinsTests(TestCase):
+
+    def setUp(self):
+        self.user_ids = [bson.ObjectId() for _ in range(3)]
+        self.docs = [
+            {'_id': self.user_ids[0], 'nins': [{'number': '1', 'verified': True}, {'number': '2', 'verified': False}]},
+            {'_id': self.user_ids[1], 'nins': [{'number': '1', 'verified': True}, {'number': '3', 'verified': 'yes'}]},
+            {'_id': self.user_ids[2]},
+        ]
+
+    def test_extract_verified_nins(self):
+        nins_by_user, users_by_nin = extract_verified_nins(self.docs)
+        self.assertEqual(nins_by_user, {self.user_ids[0]: ['1'], self.user_ids[1]: ['1']})
+        self.assertEqual(dict(users_by_nin), {'1': {self.user_ids[0], self.user_ids[1]}})
+
+    def test_duplicate_nins(self):
+        self.docs[1]['nins'][0]['number'] = '4'
+        self.docs[2]['nins'] = [{'number': '1', 'verified': True}]
+        _, users_by_nin = extract_verified_nins(self.docs)
+        self.assertEqual(duplicate_nins(users_by_nin), {'1': {self.user_ids[0], self.user_ids[2]}})
+
+    def test_scan_verified_nins(self):
+        contexts = []
+        for doc in self.docs:
+            context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+            context.private_db.insert_document(doc)
+            contexts.append(context)
+        contexts[2].private_db.insert_document({'_id': self.user_ids[0], 'nins': [{'number': '5', 'verified': True}]})
+
+        nins_by_user, users_by_nin = scan_verified_nins(contexts)
+        self.assertEqual(nins_by_user, {self.user_ids[0]: ['1', '5'], self.user_ids[1]: ['1']})
+        self.assertEqual(duplicate_nins(users_by_nin), {'1': {self.user_ids[0], self.user_ids[1]}})
+
+
+class IdentityIndexTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = IdentityIndex(os.path.join(self.directory, 'index.sqlite'))
+        self.user_ids = [bson.ObjectId() for _ in range(2)]
+        self.letter = LetterProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.email = EmailProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.letter.private_db.insert_document({
+            '_id': self.user_ids[0], 'modified_ts': 1,
+            'nins': [{'number': '123456781235', 'verified': True}],
+        })
+        self.email.private_db.insert_document({
+            '_id': self.user_ids[1], 'modified_ts': 1,
+            'nins': [{'number': '123456781235', 'verified': True}],
+            'mailAliases': [{'email': 'John@example.com', 'verified': True}],
+        })
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_verified_identifiers(self):
+        self.assertEqual(verified_identifiers(USER_DATA), {
+            (NIN, '123456781235'),
+            (EMAIL, 'john@example.com'),
+            (PHONE, '+46700011336'),
+            (ORCID, 'orcid_unique_id'),
+        })
+
+    def test_lookup_and_duplicates(self):
+        self.assertEqual(self.index.update(self.letter), 1)
+        self.assertEqual(self.index.update(self.email), 1)
+        self.assertEqual(self.index.lookup(EMAIL, 'john@EXAMPLE.com'), {self.user_ids[1]})
+        self.assertEqual(self.index.duplicates(), {(NIN, '123456781235'): set(self.user_ids)})
+        self.assertEqual(self.index.duplicates(EMAIL), {})
+
+    def test_incremental_update(self):
+        self.index.update(self.letter)
+        self.letter.private_db.insert_document({'_id': self.user_ids[0], 'modified_ts': 2, 'nins': []})
+        self.assertEqual(self.index.update(self.letter), 1)
+        self.assertEqual(self.index.lookup(NIN, '123456781235'), set())
+        self.assertEqual(self.index.update(self.letter, rebuild=True), 1)
+
+
+class FakeBulkWriteResult(object):
+
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class FakeUserCollection(object):
+
+    def __init__(self):
+        self.operations = []
+
+    def bulk_write(self, operations, ordered=True):
+        self.operations.append([(operation._filter, operation._doc) for operation in operations])
+        return FakeBulkWriteResult(len(operations))
+
+
+def export_and_die(directory, count):
+    exporter = UpdateExporter(directory, passthrough=False)
+    for _ in range(count):
+        exporter(fake_fetch, FakeContext(), bson.ObjectId(), {})
+    # Like a killed worker, without closing the update file
+    os._exit(0)
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_id = bson.ObjectId()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bson_roundtrip(self):
+        path = os.path.join(self.directory, 'updates.bson.gz')
+        writer = UpdateWriter(path)
+        writer.write('eduid_test', self.user_id, {'$set': {'givenName': 'Testaren'}})
+        writer.close()
+        # Appending to an existing file
+        writer = UpdateWriter(path)
+        writer.write('eduid_test', self.user_id, {'$unset': {'givenName': None}})
+        writer.close()
+
+        self.assertEqual(list(read_updates(path)), [
+            {'user_id': self.user_id, 'plugin': 'eduid_test', 'update': {'$set': {'givenName': 'Testaren'}}},
+            {'user_id': self.user_id, 'plugin': 'eduid_test', 'update': {'$unset': {'givenName': None}}},
+        ])
+
+    def test_jsonl_roundtrip(self):
+        path = os.path.join(self.directory, 'updates.jsonl.gz')
+        writer = UpdateWriter(path, fmt=JSONL)
+        writer.write('eduid_test', self.user_id, {'$set': {'givenName': 'Testaren'}})
+        writer.close()
+        self.assertEqual([record['update'] for record in read_updates(path)], [{'$set': {'givenName': 'Testaren'}}])
+
+    def test_exporter(self):
+        exporter = UpdateExporter(self.directory, passthrough=False)
+        self.assertEqual(exporter(fake_fetch, FakeContext(), self.user_id, {}), {})
+        exporter.close()
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 1)
+        self.assertEqual([record['update'] for record in read_updates(os.path.join(self.directory, files[0]))],
+                         [{'$set': {'givenName': 'Testaren'}}])
+
+    def test_killed_writer(self):
+        process = multiprocessing.Process(target=export_and_die, args=(self.directory, 100))
+        process.start()
+        process.join()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        self.assertEqual(len(list(read_updates(path))), 100)
+        # A new writer completes the file before appending to it
+        writer = UpdateWriter(path)
+        writer.write('eduid_test', self.user_id, {'$unset': {'givenName': None}})
+        writer.close()
+        self.assertEqual(len(list(read_updates(path))), 101)
+        with gzip.open(path, 'rb') as fd:
+            self.assertTrue(fd.read())
+
+    def test_damaged_file_moved(self):
+        path = os.path.join(self.directory, 'updates.jsonl.gz')
+        writer = UpdateWriter(path, fmt=JSONL)
+        for i in range(50):
+            writer.write('eduid_test', self.user_id, {'$set': {'givenName': str(i)}})
+        writer.close()
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        with open(path, 'wb') as fd:
+            fd.write(data[:len(data) // 2])
+        writer = UpdateWriter(path, fmt=JSONL)
+        writer.close()
+        damaged = [name for name in os.listdir(self.directory) if '.damaged-' in name]
+        self.assertEqual(len(damaged), 1)
+        self.assertLess(len(list(read_updates(os.path.join(self.directory, damaged[0])))), 50)
+        self.assertEqual(list(read_updates(path)), [])
+
+    def test_export_and_apply(self):
+        context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        user_ids = [context.private_db.insert_document({'_id': bson.ObjectId(), 'givenName': str(i)})
+                    for i in range(5)]
+        path = os.path.join(self.directory, 'updates.bson.gz')
+        writer = UpdateWriter(path)
+        self.assertEqual(export_updates(context, user_ids, writer), 5)
+        writer.close()
+
+        collection = FakeUserCollection()
+        self.assertEqual(apply_updates(collection, read_updates(path), batch_size=2), 5)
+        self.assertEqual([len(batch) for batch in collection.operations], [2, 2, 1])
+        self.assertEqual(collection.operations[0][1], ({'_id': user_ids[1]}, {'$set': {'givenName': '1'}}))
+
+
+class UpdateCoalescerTests(TestCase):
+
+    def setUp(self):
+        self.flushed = []
+        self.coalescer = UpdateCoalescer(self.flushed.append, window=10)
+        self.user_id = bson.ObjectId()
+
+    def test_merge(self):
+        self.coalescer.add('eduid_personal_data', self.user_id, {'$set': {'givenName': 'Own', 'preferredLanguage': 'sv'}})
+        self.coalescer.add('eduid_letter_proofing', self.user_id, {'$set': {'givenName': 'Official'},
+                                                                   '$unset': {'nins': None}})
+        self.coalescer.flush_all()
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'givenName': 'Official', 'preferredLanguage': 'sv'},
+                                                         '$unset': {'nins': None}})]])
+
+    def test_priority(self):
+        self.coalescer.add('eduid_security', self.user_id, {'$unset': {'nins': None}})
+        self.coalescer.add('eduid_letter_proofing', self.user_id, {'$set': {'nins': [{'number': '1'}]}})
+        self.coalescer.flush_all()
+        self.assertEqual(self.flushed, [[(self.user_id, {'$unset': {'nins': None}})]])
+
+    def test_set_after_unset(self):
+        self.coalescer.add('eduid_orcid', self.user_id, {'$unset': {'orcid': None}})
+        self.coalescer.add('eduid_orcid', self.user_id, {'$set': {'orcid': {'id': 'orcid_id'}}})
+        self.coalescer.flush_all()
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'orcid': {'id': 'orcid_id'}}})]])
+
+    def test_path_conflict(self):
+        self.coalescer.add('eduid_orcid', self.user_id, {'$set': {'orcid.id': 'orcid_id'}})
+        self.coalescer.add('eduid_orcid', self.user_id, {'$unset': {'orcid': None}})
+        self.coalescer.flush_all()
+        self.assertEqual(self.flushed, [
+            [(self.user_id, {'$set': {'orcid.id': 'orcid_id'}})],
+            [(self.user_id, {'$unset': {'orcid': None}})],
+        ])
+
+    def test_window(self):
+        coalescer = UpdateCoalescer(self.flushed.append, window=0.01)
+        coalescer.add('eduid_phone', self.user_id, {'$set': {'phone': []}})
+        coalescer.flush_expired()
+        self.assertEqual(self.flushed, [])
+        time.sleep(0.02)
+        coalescer.flush_expired()
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_max_pending(self):
+        coalescer = UpdateCoalescer(self.flushed.append, max_pending=2)
+        coalescer.add('eduid_phone', bson.ObjectId(), {'$set': {'phone': []}})
+        self.assertEqual(self.flushed, [])
+        coalescer.add('eduid_phone', bson.ObjectId(), {'$set': {'phone': []}})
+        self.assertEqual(len(self.flushed[0]), 2)
+
+    def test_hook(self):
+        self.assertEqual(self.coalescer(fake_fetch, FakeContext(), self.user_id, {}), {})
+        self.coalescer.stop()
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'givenName': 'Testaren'}})]])
+
+    def test_failed_flush_retried(self):
+        failures = [AutoReconnect('primary stepped down')]
+
+        def flush(updates):
+            if failures:
+                raise failures.pop()
+            self.flushed.append(updates)
+
+        coalescer = UpdateCoalescer(flush, window=10)
+        coalescer.add('eduid_security', self.user_id, {'$set': {'passwords': [{'id': 1}]}})
+        coalescer.flush_all()
+        self.assertEqual((coalescer.retrying, coalescer.failed_flushes, self.flushed), (1, 1, []))
+        coalescer.add('eduid_security', self.user_id, {'$set': {'passwords': [{'id': 2}]}})
+        coalescer.flush_expired()
+        # The failed update is written first, nothing newer is pending yet
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'passwords': [{'id': 1}]}})]])
+        coalescer.flush_all()
+        self.assertEqual(self.flushed[1], [(self.user_id, {'$set': {'passwords': [{'id': 2}]}})])
+        self.assertEqual((coalescer.retrying, coalescer.flushed), (0, 2))
+
+    def test_stop_retries(self):
+        failures = [AutoReconnect('primary stepped down')] * 2
+
+        def flush(updates):
+            if failures:
+                raise failures.pop()
+            self.flushed.append(updates)
+
+        coalescer = UpdateCoalescer(flush, window=0.001)
+        coalescer.add('eduid_phone', self.user_id, {'$set': {'phone': []}})
+        coalescer.stop()
+        self.assertEqual((coalescer.retrying, coalescer.failed_flushes), (0, 2))
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'phone': []}})]])
+
+    def test_max_retry(self):
+        failures = [AutoReconnect('primary stepped down')]
+
+        def flush(updates):
+            if failures:
+                raise failures.pop()
+            self.flushed.append(updates)
+
+        coalescer = UpdateCoalescer(flush, window=10, max_retry=1)
+        coalescer.add('eduid_personal_data', self.user_id, {'$set': {'givenName': 'Old', 'surname': 'Old'}})
+        coalescer.flush_all()
+        self.assertEqual(coalescer.retrying, 1)
+        # The Attribute Manager writes the update, and the retry leaves givenName alone
+        self.assertEqual(coalescer(fake_fetch, FakeContext(), self.user_id, {}), {'$set': {'givenName': 'Testaren'}})
+        self.assertEqual(coalescer.returned, 1)
+        coalescer.flush_all()
+        self.assertEqual(self.flushed, [[(self.user_id, {'$set': {'surname': 'Old'}})]])
+
+    def test_collection_flusher(self):
+        collection = FakeUserCollection()
+        other_id = bson.ObjectId()
+        collection_flusher(collection)([(self.user_id, {'$unset': {'orcid': None}}),
+                                        (other_id, {'$set': {'givenName': 'Testaren'}}),
+                                        (self.user_id, {'$set': {'orcid.id': 'orcid_id'}})])
+        self.assertEqual([[(spec['_id'], sorted(doc)) for spec, doc in batch] for batch in collection.operations], [
+            [(self.user_id, ['$set', '$unset']), (other_id, ['$set'])],
+            [(self.user_id, ['$set'])],
+        ])
+        self.assertEqual(sorted(collection.operations[1][0][1]['$set']), ['modified_ts', 'orcid.id'])
+
+
+class FakeUserDB(object):
+    UserClass = FakeUser
+
+
+class DriverProfileTests(TestCase):
+
+    am_conf = {
+        'MONGO_URI': 'mongodb://db.example.org:27017/?replicaSet=rs0&maxPoolSize=10',
+        'MONGO_DRIVER_OPTIONS': {'compressors': 'zstd,zlib', 'maxPoolSize': 50},
+        'MONGO_DRIVER_PROFILES': {'eduid_security': {'maxPoolSize': 200, 'batchSize': 20}},
+    }
+
+    def test_driver_profile(self):
+        self.assertEqual(driver_profile(self.am_conf, 'eduid_security'),
+                         {'compressors': 'zstd,zlib', 'maxPoolSize': 200, 'batchSize': 20})
+        self.assertEqual(driver_profile(self.am_conf, 'eduid_orcid'), {'compressors': 'zstd,zlib', 'maxPoolSize': 50})
+        self.assertEqual(driver_profile({'MONGO_URI': 'mongodb://localhost'}, 'eduid_orcid'), {})
+
+    def test_unknown_option(self):
+        with self.assertRaises(ValueError):
+            driver_profile({'MONGO_DRIVER_OPTIONS': {'maxPoolsize': 10}}, 'eduid_orcid')
+
+    def test_profile_uri(self):
+        self.assertEqual(plugin_mongo_uri(self.am_conf, 'eduid_security'),
+                         'mongodb://db.example.org:27017/?replicaSet=rs0&compressors=zstd,zlib&maxPoolSize=200')
+        self.assertEqual(profile_uri('mongodb://localhost', {}), 'mongodb://localhost')
+        self.assertEqual(profile_uri('mongodb://localhost', {'batchSize': 10}), 'mongodb://localhost')
+        self.assertEqual(profile_uri('mongodb://localhost/eduid_am', {'socketTimeoutMS': 500}),
+                         'mongodb://localhost/eduid_am?socketTimeoutMS=500')
+
+    def test_connection_conf(self):
+        parser = argparse.ArgumentParser()
+        add_connection_arguments(parser)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'am.json')
+            with open(path, 'w') as fd:
+                json.dump(dict(self.am_conf, MONGO_URIS={'eduid_orcid': 'mongodb://orcid.example.org'},
+                               REPLICA_DIR=directory), fd)
+            args = parser.parse_args(['--config', path, '--plugin-uri', 'eduid_security=mongodb://security.example.org'])
+            am_conf = connection_conf(parser, args)
+        finally:
+            shutil.rmtree(directory)
+        # Only how to connect, no optional features
+        self.assertNotIn('REPLICA_DIR', am_conf)
+        self.assertEqual(plugin_mongo_uri(am_conf, 'eduid_security'),
+                         'mongodb://security.example.org/?compressors=zstd,zlib&maxPoolSize=200')
+        self.assertEqual(plugin_mongo_uri(am_conf, 'eduid_orcid'),
+                         'mongodb://orcid.example.org/?compressors=zstd,zlib&maxPoolSize=50')
+        self.assertTrue(plugin_mongo_uri(am_conf, 'eduid_email').startswith('mongodb://db.example.org:27017/'))
+
+    def test_connection_conf_without_uri(self):
+        parser = argparse.ArgumentParser()
+        add_connection_arguments(parser)
+        with self.assertRaises(SystemExit):
+            connection_conf(parser, parser.parse_args(['--plugin-uri', 'eduid_orcid=mongodb://localhost']))
+
+    def test_batch_size(self):
+        context = configure_context(SecurityAMPContext(None, private_db=MongoPrivateDB(FakeUserDB())), self.am_conf)
+        self.assertEqual(context.private_db.batch_size, 20)
+        context = configure_context(EmailProofingAMPContext(None, private_db=MongoPrivateDB(FakeUserDB())),
+                                    self.am_conf)
+        self.assertIsNone(context.private_db.batch_size)
+
+    def test_large_user(self):
+        user = large_user(elements=50)
+        self.assertEqual(len(user['nins']), 50)
+        self.assertEqual(len(set(phone['number'] for phone in user['phone'])), 50)
+        size, compressed = compressed_sizes(user)
+        self.assertLess(compressed[6], size)
+
+
+class FakeExplainCursor(object):
+
+    def __init__(self, coll, spec):
+        self.coll = coll
+        self.spec = spec
+        self.sort_keys = None
+
+    def sort(self, keys, direction=None):
+        self.sort_keys = keys if direction is None else [(keys, direction)]
+        return self
+
+    def limit(self, count):
+        return self
+
+    def __iter__(self):
+        self.coll.queries.append(self.spec)
+        return iter([])
+
+    def explain(self):
+        keys = set(self.spec) | set(key for key, _ in self.sort_keys or [])
+        if keys & self.coll.indexed:
+            plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+        else:
+            plan = {'stage': 'COLLSCAN'}
+        return {'queryPlanner': {'winningPlan': plan}}
+
+
+class FakeIndexedCollection(object):
+
+    def __init__(self):
+        self.indexed = {'_id'}
+        self.options = {}
+
+    def index_information(self):
+        return dict(('{}_1'.format(key), {'key': [(key, 1)]}) for key in self.indexed)
+
+    def create_index(self, keys, **options):
+        self.indexed.add(keys[0][0])
+        self.options[keys[0][0]] = options
+
+    def find_one(self, spec, projection=None):
+        return None
+
+    def find(self, spec):
+        return FakeExplainCursor(self, spec)
+
+
+class IndexesTests(TestCase):
+
+    def setUp(self):
+        self.coll = FakeIndexedCollection()
+        userdb = FakeUserDB()
+        userdb._coll = self.coll
+        self.context = SecurityAMPContext(None, private_db=MongoPrivateDB(userdb))
+
+    def test_required_indexes(self):
+        keys = [key for key, _ in required_indexes(self.context)]
+        self.assertEqual(keys, ['modified_ts', 'eduPersonPrincipalName', 'nins.number', 'phone.number'])
+
+    def test_ensure_indexes(self):
+        self.assertEqual(ensure_indexes(self.context), ['modified_ts', 'eduPersonPrincipalName', 'nins.number',
+                                                        'phone.number'])
+        self.assertTrue(self.coll.options['nins.number']['sparse'])
+        self.assertEqual(ensure_indexes(self.context), [])
+
+    def test_in_memory(self):
+        context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.assertEqual(ensure_indexes(context), [])
+        self.assertEqual(explain_queries(context), [])
+
+    def test_explain_queries(self):
+        scans = dict((name, collscan) for name, _, collscan in explain_queries(self.context))
+        self.assertEqual(scans, {'get_user_by_id': False, 'get_users_by_ids': False,
+                                 'iter_documents_since': True, 'iter_documents_since(all)': True})
+        ensure_indexes(self.context)
+        self.assertFalse(any(collscan for _, _, collscan in explain_queries(self.context)))
+
+    def test_plan_stages(self):
+        plan = {'queryPlan': {'stage': 'SORT', 'inputStages': [{'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}]}}
+        self.assertEqual(plan_stages(plan), ['SORT', 'FETCH', 'IXSCAN'])
+
+
+class WhitelistReloaderTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'whitelists.json')
+        self.context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.user_id = self.context.private_db.insert_document(dict(deepcopy(USER_DATA), _id=bson.ObjectId()))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, version, set_attrs, unset_attrs=()):
+        with open(self.path, 'w') as fd:
+            json.dump({'version': version, 'plugins': {'eduid_personal_data': {'set': list(set_attrs),
+                                                                               'unset': list(unset_attrs)}}}, fd)
+
+    def test_invalid_plans(self):
+        for set_attrs in [['_id'], ['eduPersonPrincipalName'], ['$set'], ['orcid..id'], ['givenName', 'givenName'],
+                          ['malicious'], 'givenName', ['orcid', 'orcid.id'], ['orcid.id', 'orcid']]:
+            with self.assertRaises(ValueError):
+                WhitelistPlan('eduid_personal_data', 1, set_attrs, [])
+        with self.assertRaises(ValueError):
+            WhitelistPlan('eduid_personal_data', 1, [], ['modified_ts'])
+        plan = WhitelistPlan('eduid_personal_data', 1, ['orcid.id'], ['sn'])
+        self.assertEqual(plan.set_attrs, ('orcid.id',))
+
+    def test_reload(self):
+        self.write_config(1, ['givenName'])
+        reloader = WhitelistReloader(self.path)
+        reloader.register(self.context)
+        self.assertEqual(attribute_fetcher(self.context, self.user_id), {'$set': {'givenName': 'Testaren'}})
+
+        self.write_config(2, ['givenName', 'surname', 'terminated'], ['terminated'])
+        self.assertTrue(reloader.reload())
+        self.assertEqual(self.context.whitelist_plan.version, 2)
+        self.assertEqual(self.context.WHITELIST_SET_ATTRS, ['givenName', 'surname', 'terminated'])
+        self.assertEqual(attribute_fetcher(self.context, self.user_id), {'$set': {'givenName': 'Testaren',
+                                                                                  'surname': 'Testsson'},
+                                                                         '$unset': {'terminated': None}})
+        # Same version again
+        self.assertFalse(reloader.reload())
+
+    def test_invalid_reload(self):
+        self.write_config(1, ['givenName'])
+        reloader = WhitelistReloader(self.path)
+        reloader.register(self.context)
+        plan = self.context.whitelist_plan
+        self.write_config(2, ['_id'])
+        self.assertFalse(reloader.reload())
+        with open(self.path, 'w') as fd:
+            fd.write('{"version": 3, ')
+        self.assertFalse(reloader.reload())
+        self.assertIs(self.context.whitelist_plan, plan)
+        self.assertEqual(reloader.version, 1)
+
+    def test_falsy_nested_value(self):
+        user_id = self.context.private_db.insert_document(dict(deepcopy(USER_DATA), _id=bson.ObjectId(),
+                                                               orcid={'id': 'orcid_id', 'verified': False}))
+        apply_plan(self.context, WhitelistPlan('eduid_personal_data', 1, ['orcid.verified', 'orcid.name'],
+                                               ['orcid.verified', 'orcid.name']))
+        self.assertEqual(attribute_fetcher(self.context, user_id), {'$set': {'orcid.verified': False},
+                                                                    '$unset': {'orcid.name': None}})
+
+    def test_unlisted_plugin(self):
+        self.write_config(1, ['givenName'])
+        context = EmailProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        WhitelistReloader(self.path).register(context)
+        self.assertEqual(context.whitelist_plan.set_attrs, ('mailAliases',))
+
+    def test_apply_plan(self):
+        path = os.path.join(self.tmpdir, 'eduid_personal_data.sqlite')
+        self.context.replica = LocalReplica(self.context, path)
+        self.context.validator = FastValidator(self.context.WHITELIST_SET_ATTRS)
+        apply_plan(self.context, WhitelistPlan.from_context(self.context, version=1))
+        self.context.replica.sweep()
+        self.assertIsNotNone(self.context.replica.get(self.user_id))
+        # Another worker process starting with the same whitelist keeps the shared replica
+        other = PersonalDataAMPContext(None, private_db=self.context.private_db)
+        other.replica = LocalReplica(other, path)
+        apply_plan(other, WhitelistPlan.from_context(other, version=1))
+        self.assertIsNotNone(other.replica.get(self.user_id))
+
+        apply_plan(self.context, WhitelistPlan('eduid_personal_data', 3, ['givenName', 'nins'], [],
+                                               fast_validation=True))
+        self.assertIsNone(self.context.replica.last_sweep)
+        self.assertIs(self.context.validator, self.context.whitelist_plan.validator)
+        self.assertIn('nins', self.context.validator.checks)
+        # The other process neither uses, nor sweeps into, a replica of another whitelist
+        other.replica.sweep()
+        self.assertIsNone(other.replica.get(self.user_id))
+        self.assertIsNone(self.context.replica.get(self.user_id))
+        self.context.replica.sweep()
+        self.assertEqual(self.context.replica.get(self.user_id)['givenName'], 'Testaren')
+        self.assertIsNone(other.replica.get(self.user_id))
+        other.replica.close()
+        self.context.replica.close()
+
+
+class PrivateDBHealthTests(TestCase):
+
+    def setUp(self):
+        self.health = PrivateDBHealth('eduid_test', failure_threshold=2, retry_after=60)
+        self.calls = 0
+
+    def failing_fetch(self, context, user_id, stats):
+        self.calls += 1
+        raise AutoReconnect('connection refused')
+
+    def test_unhealthy(self):
+        for _ in range(2):
+            with self.assertRaises(AutoReconnect):
+                self.health(self.failing_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(self.health.state, UNHEALTHY)
+        with self.assertRaises(PrivateDBUnavailable):
+            self.health(fake_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.health.metrics()['rejected'], 1)
+
+    def test_probe(self):
+        self.health.retry_after = 0
+        for _ in range(2):
+            with self.assertRaises(AutoReconnect):
+                self.health(self.failing_fetch, FakeContext(), bson.ObjectId(), {})
+        # A failed probe marks the database unhealthy again at once
+        with self.assertRaises(AutoReconnect):
+            self.health(self.failing_fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(self.health.state, UNHEALTHY)
+        self.assertEqual(self.health(fake_fetch, FakeContext(), bson.ObjectId(), {}),
+                         {'$set': {'givenName': 'Testaren'}})
+        self.assertEqual(self.health.state, HEALTHY)
+
+    def test_missing_user_is_healthy(self):
+        def fetch(context, user_id, stats):
+            raise UserDoesNotExist('No user')
+        for _ in range(3):
+            with self.assertRaises(UserDoesNotExist):
+                self.health(fetch, FakeContext(), bson.ObjectId(), {})
+        self.assertEqual(self.health.state, HEALTHY)
+
+    def test_per_plugin(self):
+        am_conf = {'MONGO_URI': 'mongodb://shared', 'MONGO_URIS': {'eduid_security': 'mongodb://security'},
+                   'HEALTH_FAILURE_THRESHOLD': 3}
+        self.assertEqual(plugin_mongo_uri(am_conf, 'eduid_security'), 'mongodb://security')
+        self.assertEqual(plugin_mongo_uri(am_conf, 'eduid_orcid'), 'mongodb://shared')
+        security = configure_context(SecurityAMPContext(None, private_db=InMemoryPrivateDB(FakeUser)), am_conf)
+        email = configure_context(EmailProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser)), am_conf)
+        self.assertIsNot(security.health, email.health)
+        self.assertEqual(security.fetch_hooks, (security.health,))
+        self.assertIsNone(security.health.ping(security))
+
+
+class LargeUserScalingTests(TestCase):
+    """
+    Fetch users with SMALL and LARGE elements per list through every plugin, with the userdb
+    user classes and with fast validation, and the write ledger enabled, and check that time
+    and memory grow about as the document size does. Quadratic work would make them grow
+    SCALE times more.
+    """
+
+    SMALL = 25
+    LARGE = 200
+    SCALE = LARGE // SMALL
+
+    def fetch_cost(self, context_class, user_class, doc, fast_validation=False):
+        context = context_class(None, private_db=InMemoryPrivateDB(user_class))
+        if fast_validation:
+            context.validator = FastValidator(context.WHITELIST_SET_ATTRS)
+        user_id = context.private_db.insert_document(doc)
+        best = None
+        for _ in range(5):
+            context.write_ledger = WriteLedger()
+            start = time.perf_counter()
+            attribute_fetcher(context, user_id)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        context.write_ledger = WriteLedger()
+        tracemalloc.start()
+        try:
+            attribute_fetcher(context, user_id)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return best, peak
+
+    def assertLinear(self, name, small_cost, large_cost):
+        (small_time, small_memory), (large_time, large_memory) = small_cost, large_cost
+        # Fixed costs make small documents relatively expensive, so only an upper bound
+        self.assertLess(large_time, small_time * self.SCALE * 2.5, '{} time grows too fast'.format(name))
+        self.assertLess(large_memory, small_memory * self.SCALE * 2.5, '{} memory grows too fast'.format(name))
+
+    def test_linear_scaling(self):
+        for fast_validation in (False, True):
+            for context_class, user_class in CONTEXTS:
+                small = self.fetch_cost(context_class, user_class, large_user(self.SMALL), fast_validation)
+                large = self.fetch_cost(context_class, user_class, large_user(self.LARGE), fast_validation)
+                name = '{} (fast validation {})'.format(context_class.PLUGIN_NAME, fast_validation)
+                self.assertLinear(name, small, large)
+
+    def test_deep_orcid_scaling(self):
+        # Only the orcid data grows here, at the deepest level of its nesting, so its cost
+        # is not hidden by the other lists
+        def orcid_user(elements):
+            user = large_user(1)
+            id_token = user['orcid']['oidc_authz']['id_token']
+            id_token['aud'] = ['APP-{:016d}'.format(i) for i in range(elements)]
+            id_token['nonce'] = 'n' * elements * 16
+            return user
+
+        for fast_validation in (False, True):
+            small = self.fetch_cost(OrcidAMPContext, ProofingUser, orcid_user(self.SMALL), fast_validation)
+            large = self.fetch_cost(OrcidAMPContext, ProofingUser, orcid_user(self.LARGE), fast_validation)
+            self.assertLinear('orcid (fast validation {})'.format(fast_validation), small, large)
+
+    def test_large_update(self):
+        context = LetterProofingAMPContext(None, private_db=InMemoryPrivateDB(ProofingUser))
+        user_id = context.private_db.insert_document(large_user(self.LARGE))
+        update = attribute_fetcher(context, user_id)
+        self.assertEqual(len(update['$set']['nins']), self.LARGE)
+        self.assertEqual(len(update['$set']['letter_proofing_data']), self.LARGE)
+
+    def test_large_orcid_update(self):
+        context = OrcidAMPContext(None, private_db=InMemoryPrivateDB(ProofingUser))
+        user_id = context.private_db.insert_document(large_user(self.LARGE))
+        update = attribute_fetcher(context, user_id)
+        self.assertEqual(len(update['$set']['orcid']['oidc_authz']['id_token']['aud']), self.LARGE)
+
+
+class TracingTests(TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        self.context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.context.tracer = Tracer([self.exporter])
+        self.context.fetch_hooks = (self.context.tracer,)
+        self.user_id = self.context.private_db.insert_document(dict(deepcopy(USER_DATA), _id=bson.ObjectId()))
+
+    def test_stages(self):
+        attribute_fetcher(self.context, self.user_id)
+        spans = dict((span['name'], span) for span in self.exporter.spans)
+        self.assertEqual(set(spans), {'attribute_fetcher', 'private_db.read', 'user.construct', 'user.to_dict',
+                                      'whitelist.filter'})
+        root = spans['attribute_fetcher']
+        self.assertEqual(root['parentSpanId'], '')
+        attributes = dict((kv['key'], kv['value']) for kv in root['attributes'])
+        self.assertEqual(attributes['eduid.plugin'], {'stringValue': 'eduid_personal_data'})
+        self.assertEqual(attributes['eduid.user_id_hash'], {'stringValue': user_id_hash(self.user_id)})
+        self.assertGreater(int(attributes['eduid.doc_size']['intValue']), 0)
+        for name, span in spans.items():
+            self.assertEqual(span['traceId'], root['traceId'])
+            if name != 'attribute_fetcher':
+                self.assertEqual(span['parentSpanId'], root['spanId'])
+                self.assertLessEqual(int(root['startTimeUnixNano']), int(span['startTimeUnixNano']))
+                self.assertLessEqual(int(span['endTimeUnixNano']), int(root['endTimeUnixNano']))
+
+    def test_attribute_values(self):
+        self.assertEqual(key_values({'b': True, 'i': 3, 'd': 0.5, 's': bson.ObjectId('0' * 24)}), [
+            {'key': 'b', 'value': {'boolValue': True}},
+            {'key': 'd', 'value': {'doubleValue': 0.5}},
+            {'key': 'i', 'value': {'intValue': '3'}},
+            {'key': 's', 'value': {'stringValue': '0' * 24}},
+        ])
+
+    def test_fast_validation(self):
+        self.context.validator = FastValidator(self.context.WHITELIST_SET_ATTRS)
+        attribute_fetcher(self.context, self.user_id)
+        names = [span['name'] for span in self.exporter.spans]
+        self.assertIn('validate', names)
+
+    def test_trace_context(self):
+        traceparent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+        with trace_context(traceparent):
+            attribute_fetcher(self.context, self.user_id)
+        root = [span for span in self.exporter.spans if span['name'] == 'attribute_fetcher'][0]
+        self.assertEqual(root['traceId'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertEqual(root['parentSpanId'], 'b7ad6b7169203331')
+
+        self.exporter.clear()
+        with trace_context('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00'):
+            attribute_fetcher(self.context, self.user_id)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_parse_traceparent(self):
+        self.assertIsNone(parse_traceparent('garbage'))
+        self.assertIsNone(parse_traceparent('00-{}-b7ad6b7169203331-01'.format('0' * 32)))
+        self.assertIsNone(parse_traceparent(None))
+
+    def test_error(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.context, bson.ObjectId())
+        statuses = dict((span['name'], span['status']['code']) for span in self.exporter.spans)
+        self.assertEqual(statuses['attribute_fetcher'], STATUS_ERROR)
+        self.assertEqual(statuses['private_db.read'], STATUS_ERROR)
+
+    def test_not_sampled(self):
+        self.context.tracer.sample_rate = 0
+        attribute_fetcher(self.context, self.user_id)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_file_exporter(self):
+        directory = tempfile.mkdtemp()
+        try:
+            exporter = FileSpanExporter(os.path.join(directory, 'spans.jsonl'))
+            self.context.tracer.exporters = [exporter]
+            attribute_fetcher(self.context, self.user_id)
+            exporter.close()
+            with open(exporter.path) as fd:
+                requests = [json.loads(line) for line in fd]
+            self.assertEqual(len(requests), 5)
+            resource_spans = requests[-1]['resourceSpans'][0]
+            self.assertEqual(resource_spans['resource']['attributes'],
+                             [{'key': 'service.name', 'value': {'stringValue': 'eduid_proofing_amp'}}])
+            self.assertEqual(resource_spans['scopeSpans'][0]['spans'][0]['name'], 'attribute_fetcher')
+        finally:
+            shutil.rmtree(directory)
+
+
+class ConcurrencyTests(TestCase):
+
+    def setUp(self):
+        self.context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.context.validator = FastValidator(self.context.WHITELIST_SET_ATTRS)
+        self.context.write_ledger = WriteLedger()
+        self.exporter = InMemorySpanExporter()
+        self.context.tracer = Tracer([self.exporter])
+        self.context.fetch_hooks = (self.context.tracer,)
+        self.user_ids = []
+        for i in range(200):
+            data = dict(deepcopy(USER_DATA), _id=bson.ObjectId(), givenName='User {}'.format(i))
+            self.user_ids.append(self.context.private_db.insert_document(data))
+        self.fetcher = ThreadedFetcher(max_workers=16)
+
+    def tearDown(self):
+        self.fetcher.shutdown()
+
+    def test_fetch_many(self):
+        results = self.fetcher.fetch_many(self.context, self.user_ids + [bson.ObjectId()])
+        self.assertEqual([user_id for user_id, _, _ in results[:-1]], self.user_ids)
+        for i, (user_id, update, error) in enumerate(results[:-1]):
+            self.assertIsNone(error)
+            self.assertEqual(update['$set']['givenName'], 'User {}'.format(i))
+        self.assertIsInstance(results[-1][2], UserDoesNotExist)
+        self.assertEqual(self.context.validator.accepted + self.context.validator.fallbacks, len(self.user_ids))
+        self.assertEqual(len(self.context.write_ledger), len(self.user_ids) * 4)
+
+    def test_spans_per_thread(self):
+        self.fetcher.fetch_many(self.context, self.user_ids)
+        roots = dict((span['spanId'], span) for span in self.exporter.spans if span['name'] == 'attribute_fetcher')
+        self.assertEqual(len(roots), len(self.user_ids))
+        children = [span for span in self.exporter.spans if span['name'] != 'attribute_fetcher']
+        for span in children:
+            self.assertEqual(span['traceId'], roots[span['parentSpanId']]['traceId'])
+
+    def test_thread_locals_carried_over(self):
+        seen = []
+
+        def hook(fetch, context, user_id, stats):
+            seen.append((current_origin(), current_traceparent()))
+            return fetch(context, user_id, stats)
+        self.context.fetch_hooks = (hook,)
+        traceparent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+        with fetch_origin('resync'), trace_context(traceparent):
+            self.fetcher.fetch_many(self.context, self.user_ids[:10])
+        self.assertEqual(set(seen), {('resync', traceparent)})
+
+    def test_whitelist_swap(self):
+        plans = [WhitelistPlan('eduid_personal_data', version, attrs, [], fast_validation=True)
+                 for version, attrs in enumerate([['givenName'], ['surname', 'displayName']])]
+        self.context.write_ledger = None
+        stop = threading.Event()
+
+        def swap():
+            i = 0
+            while not stop.is_set():
+                apply_plan(self.context, plans[i % 2])
+                i += 1
+        swapper = threading.Thread(target=swap)
+        swapper.start()
+        try:
+            results = self.fetcher.fetch_many(self.context, self.user_ids * 5)
+        finally:
+            stop.set()
+            swapper.join()
+        for _, update, error in results:
+            self.assertIsNone(error)
+            self.assertIn(sorted(update['$set']), [['givenName'], ['displayName', 'surname']])
+
+
+class FakeClient(object):
+    address = ('localhost', 27017)
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.client = FakeClient()
+        self.commands = []
+        self.down = False
+
+    def command(self, name):
+        if self.down:
+            raise AutoReconnect('connection refused')
+        self.commands.append(name)
+        return {'ok': 1}
+
+
+class FakeReadinessCollection(FakeIndexedCollection):
+
+    def __init__(self):
+        super(FakeReadinessCollection, self).__init__()
+        self.database = FakeDatabase()
+        self.queries = []
+
+    def find_one(self, spec, projection=None):
+        self.queries.append(spec)
+        return None
+
+
+class ReadinessTests(TestCase):
+
+    def setUp(self):
+        self.coll = FakeReadinessCollection()
+        userdb = FakeUserDB()
+        userdb._coll = self.coll
+        self.context = SecurityAMPContext(None, private_db=MongoPrivateDB(userdb))
+
+    def test_warm_up(self):
+        self.assertGreaterEqual(self.context.warm_up(connections=4), 0)
+        self.assertEqual(self.coll.database.commands, ['ping'] * 4)
+        self.assertEqual(len(self.coll.queries), 2)
+
+    def test_self_test(self):
+        self.context.health = PrivateDBHealth('eduid_security', failure_threshold=1)
+        result = self.context.self_test(samples=3)
+        self.assertTrue(result['reachable'])
+        self.assertLessEqual(result['round_trip'], result['round_trip_max'])
+        self.assertIsNotNone(result['server_selection'])
+
+        self.coll.database.down = True
+        result = self.context.self_test()
+        self.assertFalse(result['reachable'])
+        self.assertIn('connection refused', result['error'])
+        self.assertEqual(self.context.health.state, UNHEALTHY)
+
+    def test_warm_up_at_init(self):
+        self.coll.database.down = True
+        configure_context(self.context, {'MONGO_URI': 'mongodb://localhost', 'WARM_UP_CONNECTIONS': 2})
+
+    def test_in_memory(self):
+        context = PersonalDataAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        context.validator = FastValidator(context.WHITELIST_SET_ATTRS)
+        context.warm_up()
+        self.assertEqual(context.self_test()['round_trip'], None)
+
+
+class ChangeFilterTests(TestCase):
+
+    def test_plugin_whitelists(self):
+        whitelists = plugin_whitelists()
+        self.assertEqual(len(whitelists), 9)
+        self.assertEqual(whitelists['eduid_phone'], {'set': ['phone'], 'unset': ['phone', 'mobile']})
+
+    def test_whitelists_on_context_class(self):
+        self.assertEqual(PhoneProofingAMPContext.WHITELIST_SET_ATTRS, ['phone'])
+        context = PhoneProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.assertIs(context.WHITELIST_UNSET_ATTRS, PhoneProofingAMPContext.WHITELIST_UNSET_ATTRS)
+
+    def test_change_filter(self):
+        change_filter = ChangeFilter(['nins', 'orcid.id', 'givenName'])
+        self.assertTrue(change_filter(['nins.0.verified']))
+        self.assertTrue(change_filter(['orcid']))
+        self.assertTrue(change_filter(['orcid.id']))
+        self.assertTrue(change_filter(['modified_ts', 'givenName']))
+        self.assertTrue(change_filter(None))
+        self.assertFalse(change_filter(['orcid.oidc_authz.access_token']))
+        self.assertFalse(change_filter(['ninsx', 'givenNames', 'modified_ts']))
+        self.assertFalse(change_filter([]))
+
+    def test_for_context(self):
+        context = LetterProofingAMPContext(None, private_db=InMemoryPrivateDB(FakeUser))
+        self.assertFalse(ChangeFilter.for_context(context)(['proofing_state']))
+        apply_plan(context, WhitelistPlan('eduid_letter_proofing', 1, ['givenName'], []))
+        self.assertFalse(ChangeFilter.for_context(context)(['nins.0.verified']))
+
+    def test_sync_needed(self):
+        self.assertTrue(sync_needed('eduid_letter_proofing', ['letter_proofing_data']))
+        self.assertFalse(sync_needed('eduid_letter_proofing', ['modified_ts', 'proofing_code']))
+        self.assertTrue(sync_needed('eduid_email', ['mail']))
+
+    def test_sync_needed_with_whitelist_config(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'whitelists.json')
+        try:
+            self.assertTrue(sync_needed('eduid_letter_proofing', ['letter_proofing_data'], path))
+            with open(path, 'w') as fd:
+                json.dump({'version': 1, 'plugins': {'eduid_letter_proofing': {'set': ['nins'], 'unset': []}}}, fd)
+            self.assertFalse(sync_needed('eduid_letter_proofing', ['letter_proofing_data'], path))
+            self.assertEqual(plugin_whitelists(path)['eduid_letter_proofing'], {'set': ['nins'], 'unset': []})
+            # Reloaded like in the Attribute Manager
+            with open(path, 'w') as fd:
+                json.dump({'version': 2, 'plugins': {'eduid_letter_proofing': {'set': ['nins', 'letter_proofing_data'],
+                                                                               'unset': []}}}, fd)
+            self.assertTrue(sync_needed('eduid_letter_proofing', ['letter_proofing_data.0.verified'], path))
+            self.assertFalse(sync_needed('eduid_letter_proofing', ['modified_ts'], path))
+            with open(path, 'w') as fd:
+                fd.write('{"version": 3, ')
+            self.assertTrue(sync_needed('eduid_letter_proofing', ['modified_ts'], path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_update_fields(self):
+        self.assertEqual(update_fields({'$set': {'nins.0.verified': True}, '$unset': {'mobile': None},
+                                        '$rename': {'a': 'b'}}), {'nins.0.verified', 'mobile', 'a', 'b'})
+        self.assertIsNone(update_fields({'givenName': 'Testaren'}))
+
+    def test_change_event_fields(self):
+        event = {'operationType': 'update', 'updateDescription': {'updatedFields': {'phone.1.verified': True},
+                                                                  'removedFields': ['terminated']}}
+        self.assertEqual(change_event_fields(event), {'phone.1.verified', 'terminated'})
+        self.assertIsNone(change_event_fields({'operationType': 'replace'}))
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.cluster_time = None
+        self.operation_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def advance_cluster_time(self, cluster_time):
+        self.cluster_time = cluster_time
+
+    def advance_operation_time(self, operation_time):
+        self.operation_time = operation_time
+
+
+class FakeCausalClient(object):
+
+    def __init__(self):
+        self.sessions = []
+
+    def start_session(self, causal_consistency=None):
+        self.causal_consistency = causal_consistency
+        self.sessions.append(FakeSession())
+        return self.sessions[-1]
+
+
+class FakeCausalCollection(object):
+    name = 'profiles'
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.database = FakeDatabase()
+        self.database.name = 'eduid_security'
+        self.database.client = FakeCausalClient()
+        self.options = {}
+        self.reads = []
+
+    def with_options(self, **options):
+        other = FakeCausalCollection(self.docs)
+        other.database = self.database
+        other.options = options
+        other.reads = self.reads
+        return other
+
+    def find_one(self, spec, session=None, **kwargs):
+        self.reads.append((self.options, session, kwargs))
+        return self.docs.get(spec['_id'])
+
+
+class FakeStaleReplica(object):
+    path = ':memory:'
+
+    def __init__(self, user_dict):
+        self.user_dict = user_dict
+
+    def serves(self, origin):
+        return True
+
+    def get(self, user_id):
+        return self.user_dict
+
+
+class CausalReaderTests(TestCase):
+
+    def setUp(self):
+        self.user_id = bson.ObjectId()
+        self.coll = FakeCausalCollection({self.user_id: {'_id': self.user_id, 'givenName': 'Testaren'}})
+        userdb = FakeUserDB()
+        userdb._coll = self.coll
+        self.context = PersonalDataAMPContext(None, private_db=MongoPrivateDB(userdb))
+        self.context.causal_reader = CausalReader(max_time_ms=500)
+        self.token = {'clusterTime': {'clusterTime': 1700000000}, 'operationTime': 1700000000}
+
+    def test_load_token(self):
+        session = FakeSession()
+        session.advance_cluster_time({'clusterTime': 17})
+        session.advance_operation_time(17)
+        self.assertEqual(load_token(session_token(session)), {'clusterTime': {'clusterTime': 17}, 'operationTime': 17})
+        self.assertEqual(load_token(self.token), self.token)
+        with self.assertRaises(ValueError):
+            load_token({'clusterTime': {'clusterTime': 17}})
+
+    def test_causal_read(self):
+        update = attribute_fetcher(self.context, self.user_id, causal_token=self.token)
+        self.assertEqual(update, {'$set': {'givenName': 'Testaren'}})
+        options, session, kwargs = self.coll.reads[0]
+        self.assertTrue(self.coll.database.client.causal_consistency)
+        self.assertEqual(session.operation_time, self.token['operationTime'])
+        self.assertEqual(session.cluster_time, self.token['clusterTime'])
+        self.assertEqual(options['read_concern'].level, 'majority')
+        self.assertEqual(kwargs, {'max_time_ms': 500})
+        self.assertEqual(self.context.causal_reader.metrics(), {'reads': 1, 'fallbacks': 0})
+
+    def test_missing_user(self):
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher(self.context, bson.ObjectId(), causal_token=self.token)
+
+    def test_collection_per_cluster(self):
+        other_id = bson.ObjectId()
+        other_coll = FakeCausalCollection({other_id: {'_id': other_id, 'givenName': 'Other'}})
+        userdb = FakeUserDB()
+        userdb._coll = other_coll
+        reader = self.context.causal_reader
+        reader.get_document(self.context.private_db, self.user_id, self.token)
+        # Same database and collection names, on another cluster
+        doc = reader.get_document(MongoPrivateDB(userdb), other_id, self.token)
+        self.assertEqual(doc['givenName'], 'Other')
+        self.assertEqual((len(self.coll.reads), len(other_coll.reads)), (1, 1))
+
+    def test_skips_replica(self):
+        self.context.replica = FakeStaleReplica({'_id': self.user_id, 'givenName': 'Stale'})
+        update = attribute_fetcher(self.context, self.user_id, causal_token=self.token)
+        self.assertEqual(update, {'$set': {'givenName': 'Testaren'}})
+        self.assertEqual(attribute_fetcher(self.context, self.user_id), {'$set': {'givenName': 'Stale'}})
+
+    def test_not_mongo(self):
+        private_db = InMemoryPrivateDB(FakeUser)
+        private_db.insert_document({'_id': self.user_id, 'givenName': 'Testaren'})
+        self.assertEqual(self.context.causal_reader.get_document(private_db, self.user_id, self.token)['givenName'],
+                         'Testaren')
+        self.assertEqual(self.context.causal_reader.metrics()['fallbacks'], 1)
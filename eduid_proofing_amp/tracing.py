@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+
+from eduid_proofing_amp.profiling import document_size
+
+logger = get_task_logger(__name__)
+
+# W3C Trace Context traceparent header, version 00
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# OTLP/JSON encodes enums by their integer values
+STATUS_OK = 1
+STATUS_ERROR = 2
+SPAN_KIND_INTERNAL = 1
+
+SERVICE_NAME = 'eduid_proofing_amp'
+
+_local = threading.local()
+
+
+@contextmanager
+def trace_context(traceparent):
+    """
+    Make the attribute_fetcher calls made by this thread within the block part of the trace in
+    a W3C traceparent, e.g. the one of the proofing request that triggered the sync:
+
+        with trace_context(task.request.get('traceparent')):
+            attribute_fetcher(context, user_id)
+    """
+    previous = getattr(_local, 'traceparent', None)
+    _local.traceparent = traceparent
+    try:
+        yield
+    finally:
+        _local.traceparent = previous
+
+
+def current_traceparent():
+    """
+    :return: traceparent set with trace_context, or None
+    """
+    return getattr(_local, 'traceparent', None)
+
+
+def parse_traceparent(traceparent):
+    """
+    :return: trace id, parent span id and whether the parent was sampled, or None if not valid
+    :rtype: tuple | None
+    """
+    match = TRACEPARENT_RE.match(traceparent or '')
+    if match is None or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def user_id_hash(user_id, salt=''):
+    """
+    :return: Short hash of a user id, to correlate spans of the same user without exposing the id
+    :rtype: str
+    """
+    return hashlib.sha256('{}{}'.format(salt, user_id).encode('utf-8')).hexdigest()[:16]
+
+
+def attribute_value(value):
+    """
+    :return: value as an OTLP/JSON AnyValue; 64 bit integers are decimal strings
+    :rtype: dict
+    """
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def key_values(attributes):
+    """
+    :return: attributes as a list of OTLP/JSON KeyValues
+    :rtype: list
+    """
+    return [{'key': key, 'value': attribute_value(value)} for key, value in sorted(attributes.items())]
+
+
+class Span(object):
+    """
+    A finished or running span, with the fields of the OpenTelemetry span data model.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_span_id, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.status = STATUS_OK
+        self.start_time = int(time.time() * 1e9)
+        self.end_time = None
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        """
+        :return: The span as an OTLP/JSON Span
+        :rtype: dict
+        """
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_span_id or '',
+            'name': self.name,
+            'kind': SPAN_KIND_INTERNAL,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': key_values(self.attributes),
+            'status': {'code': self.status},
+        }
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end_time = int(time.time() * 1e9)
+        if exc_type is not None:
+            self.status = STATUS_ERROR
+            self.attributes['exception.type'] = exc_type.__name__
+        self.tracer._pop(self)
+        return False
+
+
+class _NoSpan(object):
+    """
+    Span used when tracing is off or the trace is not sampled.
+    """
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class InMemorySpanExporter(object):
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span.to_dict())
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+def export_request(spans):
+    """
+    :param spans: Spans as returned by Span.to_dict
+    :return: An OTLP/JSON ExportTraceServiceRequest of the spans
+    :rtype: dict
+    """
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': key_values({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': list(spans),
+            }],
+        }],
+    }
+
+
+class FileSpanExporter(object):
+    """
+    Appends finished spans to a file, one OTLP/JSON ExportTraceServiceRequest per line, the
+    format the OpenTelemetry Collector's otlpjsonfile receiver reads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(export_request([span.to_dict()])) + '\n'
+        with self._lock:
+            self._fd.write(line)
+            self._fd.flush()
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+
+class Tracer(object):
+    """
+    Creates spans for the stages of attribute_fetcher and hands them to exporters when they
+    end. Used as the outermost fetch hook, it starts the root span of each fetch, a child of
+    the trace context set with trace_context if any. Stages are traced with span().
+
+    New traces are sampled at sample_rate; a trace from the Attribute Manager is traced if
+    its traceparent is sampled.
+    """
+
+    def __init__(self, exporters, sample_rate=1.0, user_id_salt=''):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.user_id_salt = user_id_salt
+        self._local = threading.local()
+
+    @property
+    def current_span(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def _push(self, span):
+        if getattr(self._local, 'stack', None) is None:
+            self._local.stack = []
+        self._local.stack.append(span)
+
+    def _pop(self, span):
+        self._local.stack.remove(span)
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception('Exporting span {} failed'.format(span.name))
+
+    def start_span(self, name, attributes=None):
+        """
+        :return: A child of the current span of this thread, or NO_SPAN if there is none
+        """
+        parent = self.current_span
+        if parent is None:
+            return NO_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    def start_root_span(self, name, attributes=None):
+        """
+        :return: A span in the trace context of this thread, or in a new trace, or NO_SPAN if not sampled
+        """
+        parent = parse_traceparent(current_traceparent())
+        if parent is not None:
+            trace_id, parent_span_id, sampled = parent
+        else:
+            trace_id, parent_span_id = '{:032x}'.format(random.getrandbits(128)), None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return NO_SPAN
+        return Span(self, name, trace_id, parent_span_id, attributes)
+
+    def __call__(self, fetch, context, user_id, stats):
+        attributes = {
+            'eduid.plugin': context.PLUGIN_NAME,
+            'eduid.user_id_hash': user_id_hash(user_id, self.user_id_salt),
+        }
+        with self.start_root_span('attribute_fetcher', attributes) as root:
+            result = fetch(context, user_id, stats)
+            root.set_attribute('eduid.update_size', sum(len(attrs) for attrs in result.values()))
+            return result
+
+
+def span(context, name):
+    """
+    :return: A span for a stage of attribute_fetcher if the context is traced, else NO_SPAN
+    """
+    if context.tracer is None:
+        return NO_SPAN
+    return context.tracer.start_span(name)
+
+
+def set_document_size(context, stats):
+    """
+    Tag the root span of a traced fetch with the size of the private user document.
+    """
+    if context.tracer is not None:
+        current = context.tracer.current_span
+        if current is not None:
+            current.set_attribute('eduid.doc_size', document_size(stats))
+
+
+_tracer = None
+
+
+def get_tracer(am_conf):
+    """
+    Return the tracer shared by all plugin contexts in this process if TRACING_DIR is set,
+    writing spans to a file per process there, or TRACING_IN_MEMORY is True.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: Tracer | None
+    """
+    global _tracer
+    directory = am_conf.get('TRACING_DIR')
+    if not directory and not am_conf.get('TRACING_IN_MEMORY'):
+        return None
+    if _tracer is None:
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            exporter = FileSpanExporter(os.path.join(directory, 'spans-{}.jsonl'.format(os.getpid())))
+        else:
+            exporter = InMemorySpanExporter()
+        _tracer = Tracer([exporter], sample_rate=am_conf.get('TRACING_SAMPLE_RATE', 1.0),
+                         user_id_salt=am_conf.get('TRACING_USER_ID_SALT', ''))
+    return _tracer
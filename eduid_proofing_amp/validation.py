@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import datetime
+import threading
+
+import bson
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+STRING = (str,)
+# The userdb classes turn other values, like True for now, into datetimes, which the raw
+# document would not have. Such documents are left to the user class.
+TIMESTAMP = (datetime.datetime,)
+
+# Top level keys of a private user document in the new userdb format, with the types of the
+# scalar ones. Documents with any other key, e.g. one in the old format, are left to the userdb
+# user class.
+TOP_LEVEL_KEYS = {
+    '_id': (bson.ObjectId,),
+    'eduPersonPrincipalName': STRING,
+    'givenName': STRING,
+    'surname': STRING,
+    'displayName': STRING,
+    'preferredLanguage': STRING,
+    'terminated': TIMESTAMP,
+    'modified_ts': (datetime.datetime,),
+    'mailAliases': None,
+    'phone': None,
+    'nins': None,
+    'passwords': None,
+    'letter_proofing_data': None,
+    'orcid': None,
+}
+
+# Top level keys the userdb user classes require
+REQUIRED_KEYS = ('_id', 'eduPersonPrincipalName')
+
+ELEMENT_META_KEYS = {
+    'created_by': STRING,
+    'created_ts': TIMESTAMP,
+    'modified_ts': TIMESTAMP,
+}
+
+# The userdb element classes fill in these flags when missing, so elements without them are
+# left to the user class too
+VERIFIED_ELEMENT_FLAGS = ('verified',)
+PRIMARY_ELEMENT_FLAGS = ('verified', 'primary')
+
+VERIFIED_ELEMENT_KEYS = dict(ELEMENT_META_KEYS, **{
+    'verified': (bool,),
+    'verified_by': STRING,
+    'verified_ts': TIMESTAMP,
+    'primary': (bool,),
+})
+
+
+def _check_dict(value, keys, required=()):
+    if not isinstance(value, dict):
+        return False
+    for key, item in value.items():
+        types = keys.get(key)
+        if types is None or (item is not None and not isinstance(item, types)):
+            return False
+    return all(value.get(key) is not None for key in required)
+
+
+def primary_element_list(key, required_keys=()):
+    """
+    Validator for lists of elements identified by `key', of which at most one, verified, element
+    is primary, like the userdb PrimaryElementList.
+    """
+    keys = dict(VERIFIED_ELEMENT_KEYS, **{key: STRING})
+    required = (key,) + PRIMARY_ELEMENT_FLAGS + tuple(required_keys)
+
+    def check(value):
+        if not isinstance(value, list):
+            return False
+        seen = set()
+        primary = 0
+        for element in value:
+            if not _check_dict(element, keys, required):
+                return False
+            if element[key] in seen:
+                return False
+            seen.add(element[key])
+            if element.get('primary'):
+                if element.get('verified') is not True:
+                    return False
+                primary += 1
+        return primary <= 1
+    return check
+
+
+def element_list(keys, required=()):
+    """
+    Validator for lists of flat elements.
+    """
+    def check(value):
+        return isinstance(value, list) and all(_check_dict(element, keys, required) for element in value)
+    return check
+
+
+ID_TOKEN_KEYS = {
+    'nonce': STRING, 'sub': STRING, 'iss': STRING, 'created_by': STRING, 'created_ts': TIMESTAMP,
+    'exp': (int,), 'auth_time': (int,), 'iat': (int,), 'aud': (list,),
+}
+OIDC_AUTHZ_KEYS = {
+    'token_type': STRING, 'refresh_token': STRING, 'access_token': STRING, 'expires_in': (int,),
+    'created_by': STRING, 'created_ts': TIMESTAMP, 'id_token': (dict,),
+}
+ORCID_KEYS = dict(VERIFIED_ELEMENT_KEYS, **{
+    'id': STRING, 'name': STRING, 'given_name': STRING, 'family_name': STRING, 'oidc_authz': (dict,),
+})
+
+
+def check_orcid(value):
+    if not _check_dict(value, ORCID_KEYS, required=('id', 'oidc_authz') + VERIFIED_ELEMENT_FLAGS):
+        return False
+    oidc_authz = value['oidc_authz']
+    if not _check_dict(oidc_authz, OIDC_AUTHZ_KEYS, required=('id_token',)):
+        return False
+    id_token = oidc_authz['id_token']
+    return _check_dict(id_token, ID_TOKEN_KEYS) and all(isinstance(aud, STRING) for aud in id_token.get('aud', []))
+
+
+# Validators of the structured attributes. Attributes without a validator, like
+# letter_proofing_data, always take the userdb user class path when whitelisted.
+ATTRIBUTE_VALIDATORS = {
+    'nins': primary_element_list('number'),
+    'mailAliases': primary_element_list('email'),
+    'phone': primary_element_list('number'),
+    'passwords': element_list(dict(ELEMENT_META_KEYS, **{'credential_id': STRING, 'salt': STRING,
+                                                         'is_generated': (bool,)}),
+                              required=('credential_id', 'salt', 'is_generated')),
+    'orcid': check_orcid,
+}
+
+
+class FastValidator(object):
+    """
+    Validates raw private user documents for one plugin, checking the top level keys, that
+    the REQUIRED_KEYS are there, and the shape of the whitelisted attributes, without
+    constructing a userdb user object. Only documents the user class would return unchanged
+    from to_dict() are accepted, as the accepted document is used in place of it.
+
+    A document that is not accepted is not necessarily invalid; the caller must then validate
+    it with the userdb user class, which gives the detailed errors.
+    """
+
+    def __init__(self, whitelist):
+        self.checks = {}
+        self.unsupported = set()
+        for attr in whitelist:
+            top = attr.split('.')[0]
+            if TOP_LEVEL_KEYS.get(top, ()) is not None:
+                continue
+            if top in ATTRIBUTE_VALIDATORS:
+                self.checks[top] = ATTRIBUTE_VALIDATORS[top]
+            else:
+                self.unsupported.add(top)
+        self.accepted = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def validate(self, doc):
+        """
+        :param doc: Raw user document
+        :type doc: dict
+
+        :return: Whether the document is known to be valid for the whitelisted attributes
+        :rtype: bool
+        """
+        for key, value in doc.items():
+            if key not in TOP_LEVEL_KEYS or key in self.unsupported:
+                return False
+            types = TOP_LEVEL_KEYS[key]
+            if types is not None:
+                if value is not None and not isinstance(value, types):
+                    return False
+            elif key in self.checks and value is not None and not self.checks[key](value):
+                return False
+        return all(doc.get(key) is not None for key in REQUIRED_KEYS)
+
+    def __call__(self, doc):
+        """
+        :param doc: Raw user document
+        :return: doc if it is valid, else None
+        :rtype: dict | None
+        """
+        if self.validate(doc):
+            with self._lock:
+                self.accepted += 1
+            return doc
+        with self._lock:
+            self.fallbacks += 1
+        logger.debug('User {} not accepted by fast validator, using user class'.format(doc.get('_id')))
+        return None
+
+
+def get_fast_validator(am_conf, context):
+    """
+    Return a FastValidator for the whitelist of a plugin context if FAST_VALIDATION is True,
+    or a list of plugin names including this plugin.
+
+    :param am_conf: Attribute Manager configuration data.
+    :param context: Plugin context
+
+    :type am_conf: dict
+
+    :rtype: FastValidator | None
+    """
+    enabled = am_conf.get('FAST_VALIDATION', False)
+    if enabled is True or (isinstance(enabled, (list, tuple, set)) and context.PLUGIN_NAME in enabled):
+        return FastValidator(context.WHITELIST_SET_ATTRS)
+    return None
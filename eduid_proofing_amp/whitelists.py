@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import json
+import signal
+import threading
+
+from celery.utils.log import get_task_logger
+
+from eduid_proofing_amp.validation import TOP_LEVEL_KEYS, FastValidator
+
+logger = get_task_logger(__name__)
+
+# Attributes no whitelist may set, whatever the configuration says
+PROTECTED_ATTRS = frozenset(['_id', 'eduPersonPrincipalName', 'modified_ts'])
+
+
+def _check_attrs(plugin_name, kind, attrs, top_level_keys):
+    if not isinstance(attrs, (list, tuple)):
+        raise ValueError('{} whitelist of {} is not a list'.format(kind, plugin_name))
+    if len(set(attrs)) != len(attrs):
+        raise ValueError('{} whitelist of {} has duplicates'.format(kind, plugin_name))
+    for attr in attrs:
+        if not isinstance(attr, str) or not all(attr.split('.')) or attr.startswith('$'):
+            raise ValueError('Invalid attribute {!r} in {} whitelist of {}'.format(attr, kind, plugin_name))
+        if top_level_keys is not None and attr.split('.')[0] not in top_level_keys:
+            raise ValueError('Attribute {!r} can not be whitelisted for {}'.format(attr, plugin_name))
+    for attr in attrs:
+        # MongoDB rejects an update writing both a path and its parent
+        if any(other.startswith(attr + '.') for other in attrs):
+            raise ValueError('Overlapping attributes under {!r} in {} whitelist of {}'.format(attr, kind, plugin_name))
+
+
+class WhitelistPlan(object):
+    """
+    Validated whitelists of a plugin, ready to use by attribute_fetcher: the set and unset
+    attributes, and the fast validator for them if fast validation is enabled.
+
+    A plan is never modified, a context switches to another plan by replacing its
+    whitelist_plan in one assignment, so a fetch sees either the old or the new plan.
+    """
+
+    def __init__(self, plugin_name, version, set_attrs, unset_attrs, fast_validation=False):
+        """
+        :raise ValueError: The whitelists are not valid
+        """
+        _check_attrs(plugin_name, 'set', set_attrs, set(TOP_LEVEL_KEYS) - PROTECTED_ATTRS)
+        # Old format attributes, like norEduPersonNIN, are only ever unset
+        _check_attrs(plugin_name, 'unset', unset_attrs, None)
+        if PROTECTED_ATTRS & set(attr.split('.')[0] for attr in unset_attrs):
+            raise ValueError('Protected attribute in unset whitelist of {}'.format(plugin_name))
+        self.plugin_name = plugin_name
+        self.version = version
+        self.set_attrs = tuple(set_attrs)
+        self.unset_attrs = frozenset(unset_attrs)
+        self.validator = FastValidator(self.set_attrs) if fast_validation else None
+
+    @classmethod
+    def from_context(cls, context, version=None):
+        """
+        :return: The plan for the whitelists a context currently has
+        """
+        return cls(context.PLUGIN_NAME, version, context.WHITELIST_SET_ATTRS, context.WHITELIST_UNSET_ATTRS,
+                   fast_validation=context.validator is not None)
+
+
+def read_whitelist_config(path):
+    """
+    Read a whitelist configuration file:
+
+        {
+            "version": 3,
+            "plugins": {
+                "eduid_security": {"set": ["passwords", "terminated"], "unset": ["passwords", "terminated"]}
+            }
+        }
+
+    Plugins not in the file keep the whitelists they have.
+
+    :raise ValueError: The file is not a valid whitelist configuration
+    :return: Version and the (set, unset) whitelists per plugin name
+    :rtype: tuple
+    """
+    with open(path) as fd:
+        config = json.load(fd)
+    if not isinstance(config, dict) or not isinstance(config.get('version'), int):
+        raise ValueError('Whitelist configuration {} has no integer version'.format(path))
+    plugins = config.get('plugins', {})
+    if not isinstance(plugins, dict) or not all(isinstance(item, dict) for item in plugins.values()):
+        raise ValueError('Whitelist configuration {} has no plugins mapping'.format(path))
+    return config['version'], dict((name, (item.get('set', []), item.get('unset', [])))
+                                   for name, item in plugins.items())
+
+
+def apply_plan(context, plan):
+    """
+    Switch a context to a new whitelist plan. A local replica of the context is emptied first
+    if it holds other attributes than the plan's set attributes, see LocalReplica.use_whitelist.
+    """
+    if context.replica is not None:
+        context.replica.use_whitelist(plan.set_attrs)
+    context.WHITELIST_SET_ATTRS = list(plan.set_attrs)
+    context.WHITELIST_UNSET_ATTRS = sorted(plan.unset_attrs)
+    context.validator = plan.validator
+    context.whitelist_plan = plan
+
+
+class WhitelistReloader(object):
+    """
+    Reloads the whitelists of the registered contexts from a configuration file, see
+    read_whitelist_config, when reload() is called. Only a configuration with a higher
+    version than the one in use is applied.
+
+    All plans are built and validated before any context is switched. A configuration that
+    is not valid is logged and ignored, leaving all contexts as they were.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.contexts = []
+        self._whitelists = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def register(self, context):
+        """
+        Start managing the whitelists of a context, applying the loaded configuration for it.
+        """
+        with self._lock:
+            if self.version is None:
+                # Fail plugin init, rather than run with whitelists other than the configured
+                self.version, self._whitelists = read_whitelist_config(self.path)
+            self.contexts.append(context)
+            plan = self._plan(context, self.version, self._whitelists)
+            apply_plan(context, plan or WhitelistPlan.from_context(context))
+
+    def _plan(self, context, version, whitelists):
+        if context.PLUGIN_NAME not in whitelists:
+            return None
+        set_attrs, unset_attrs = whitelists[context.PLUGIN_NAME]
+        return WhitelistPlan(context.PLUGIN_NAME, version, set_attrs, unset_attrs,
+                             fast_validation=context.validator is not None)
+
+    def reload(self):
+        """
+        :return: Whether a new configuration was applied
+        :rtype: bool
+        """
+        with self._lock:
+            try:
+                version, whitelists = read_whitelist_config(self.path)
+                if self.version is not None and version <= self.version:
+                    return False
+                plans = [(context, self._plan(context, version, whitelists)) for context in self.contexts]
+            except (IOError, ValueError) as e:
+                logger.error('Not reloading whitelists from {}: {}'.format(self.path, e))
+                return False
+            for context, plan in plans:
+                if plan is not None:
+                    apply_plan(context, plan)
+            logger.info('Loaded whitelists version {} from {} (was {})'.format(version, self.path, self.version))
+            self.version = version
+            self._whitelists = whitelists
+            return True
+
+    def wake(self, *args):
+        """
+        Have the reload thread reload now. Safe to use as a signal handler.
+        """
+        self._wake.set()
+
+    def start(self, interval=None, signum=None):
+        """
+        Reload in a daemon thread every `interval' seconds, and when woken by signal `signum'.
+        """
+        if signum is not None:
+            try:
+                signal.signal(signum, self.wake)
+            except ValueError:
+                logger.warning('Can not install whitelist reload signal handler outside the main thread')
+
+        def _run():
+            while True:
+                self._wake.wait(interval)
+                self._wake.clear()
+                try:
+                    self.reload()
+                except Exception:
+                    logger.exception('Reloading whitelists failed')
+        thread = threading.Thread(target=_run, name='amp-whitelist-reload')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+_reloader = None
+
+
+def get_whitelist_reloader(am_conf):
+    """
+    Return the whitelist reloader shared by all plugin contexts in this process, reloading
+    WHITELIST_CONFIG every WHITELIST_RELOAD_INTERVAL seconds and on the signal named by
+    WHITELIST_RELOAD_SIGNAL, e.g. 'SIGUSR2', if set. Pick a signal the worker does not
+    already use; celery handles SIGHUP and SIGUSR1 itself.
+
+    :param am_conf: Attribute Manager configuration data.
+    :type am_conf: dict
+
+    :rtype: WhitelistReloader
+    """
+    global _reloader
+    if _reloader is None:
+        _reloader = WhitelistReloader(am_conf['WHITELIST_CONFIG'])
+        signame = am_conf.get('WHITELIST_RELOAD_SIGNAL')
+        _reloader.start(interval=am_conf.get('WHITELIST_RELOAD_INTERVAL'),
+                        signum=getattr(signal, signame) if signame else None)
+    return _reloader
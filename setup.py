@@ -63,5 +63,15 @@ setup(name='eduid-proofing-amp',
       eduid_security = eduid_proofing_amp:security_plugin_init
       eduid_orcid = eduid_proofing_amp:orcid_plugin_init
       eduid_eidas = eduid_proofing_amp:eidas_plugin_init
+
+      [console_scripts]
+      eduid-proofing-amp-apply-updates = eduid_proofing_amp.export:main
+      eduid-proofing-amp-benchmark = eduid_proofing_amp.benchmark:main
+      eduid-proofing-amp-index-advisor = eduid_proofing_amp.indexes:main
+      eduid-proofing-amp-identity-index = eduid_proofing_amp.identity_index:main
+      eduid-proofing-amp-memory-report = eduid_proofing_amp.memory:main
+      eduid-proofing-amp-replica-sweep = eduid_proofing_amp.replica:main
+      eduid-proofing-amp-self-test = eduid_proofing_amp.readiness:main
+      eduid-proofing-amp-whitelists = eduid_proofing_amp.relevance:main
       """,
       )